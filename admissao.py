@@ -0,0 +1,204 @@
+"""
+Controle de admissão das requisições do app Flask.
+
+Com o SQLite saturado, sem limite nenhum as requisições se acumulam nas
+threads do servidor segurando conexões do db_session até o cliente
+desistir, e a latência de todo mundo dispara junto. Aqui cada requisição
+precisa de uma vaga num de três orçamentos antes de chegar à rota:
+
+- leitura: GET/HEAD;
+- escrita: os demais métodos;
+- login: /login e /cadastrar_users, que gastam CPU no hash da senha.
+
+Sem vaga, a requisição entra numa fila limitada (FIFO) e espera no máximo
+BIBLIOTECA_ADMISSAO_ESPERA_MS, ou menos se o cliente mandar o cabeçalho
+X-Prazo-Ms. Ela é recusada na hora com 503 e Retry-After se a fila está
+cheia ou se a espera estimada (posição na fila x tempo médio de
+atendimento / vagas) já passa do prazo: melhor avisar logo que fazer o
+cliente esperar por uma resposta que chegaria tarde demais. /metrics não
+passa pelo controle, para continuar respondendo durante a sobrecarga, nem
+/eventos, cuja conexão fica aberta e não usa o banco.
+
+Configuração (vagas 0 desliga o orçamento):
+- BIBLIOTECA_ADMISSAO_LEITURA / _ESCRITA / _LOGIN: vagas de cada um;
+- BIBLIOTECA_ADMISSAO_FILA_LEITURA / _ESCRITA / _LOGIN: tamanho da fila;
+- BIBLIOTECA_ADMISSAO_ESPERA_MS: espera máxima na fila.
+
+Vagas, fila, admitidas, recusadas (por motivo) e o tempo de espera saem
+no /metrics.
+"""
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from flask import g, jsonify, request
+
+from metricas import Histograma, LIMITES_LATENCIA, metricas
+from models import PERFIL_ENGINE
+from senhas import WORKERS_HASH
+
+ESPERA_MAXIMA = float(os.environ.get('BIBLIOTECA_ADMISSAO_ESPERA_MS', 1000)) / 1000
+ROTAS_LOGIN = {'/login', '/cadastrar_users'}
+ROTAS_ISENTAS = {'/metrics', '/eventos'}
+# peso da última requisição na média do tempo de atendimento
+PESO_MEDIA = 0.1
+
+
+class ServidorSobrecarregado(Exception):
+    def __init__(self, motivo, retry_after):
+        super().__init__('Servidor sobrecarregado (%s)' % motivo)
+        self.motivo = motivo
+        self.retry_after = retry_after
+
+
+class Orcamento:
+    """Vagas de atendimento com uma fila FIFO limitada na frente."""
+
+    def __init__(self, nome, vagas, fila):
+        self.nome = nome
+        self.vagas = vagas
+        self.tamanho_fila = fila
+        self._lock = threading.Lock()
+        self._em_uso = 0
+        self._fila = deque()
+        self._tempo_medio = 0.05  # segundos, até medir o primeiro atendimento
+        self.admitidas = 0
+        self.recusadas = {'fila_cheia': 0, 'prazo': 0}
+        self.espera = Histograma(LIMITES_LATENCIA)
+
+    def _estimativa(self, posicao):
+        return posicao * self._tempo_medio / self.vagas
+
+    def _recusar(self, motivo, posicao):
+        self.recusadas[motivo] += 1
+        return ServidorSobrecarregado(motivo, max(1, math.ceil(self._estimativa(posicao))))
+
+    def entrar(self, prazo):
+        """Ocupa uma vaga, esperando no máximo "prazo" segundos; sem vaga lança ServidorSobrecarregado."""
+        with self._lock:
+            if self._em_uso < self.vagas and not self._fila:
+                self._em_uso += 1
+                self.admitidas += 1
+                self.espera.observar(0)
+                return
+            posicao = len(self._fila) + 1
+            if posicao > self.tamanho_fila:
+                raise self._recusar('fila_cheia', posicao)
+            if self._estimativa(posicao) > prazo:
+                raise self._recusar('prazo', posicao)
+            vez = threading.Event()
+            self._fila.append(vez)
+
+        inicio = time.perf_counter()
+        vez.wait(prazo)
+        with self._lock:
+            # "sair" pode ter passado a vaga logo depois do timeout
+            if not vez.is_set():
+                self._fila.remove(vez)
+                raise self._recusar('prazo', len(self._fila) + 1)
+            self.admitidas += 1
+            self.espera.observar(time.perf_counter() - inicio)
+
+    def sair(self, duracao):
+        """Libera a vaga, passando-a direto para o primeiro da fila."""
+        with self._lock:
+            self._tempo_medio += PESO_MEDIA * (duracao - self._tempo_medio)
+            if self._fila:
+                self._fila.popleft().set()
+            else:
+                self._em_uso -= 1
+
+    def estado(self):
+        with self._lock:
+            return self._em_uso, len(self._fila)
+
+
+def _vagas(nome, padrao):
+    return int(os.environ.get('BIBLIOTECA_ADMISSAO_%s' % nome.upper(), padrao))
+
+
+def _fila(nome, padrao):
+    return int(os.environ.get('BIBLIOTECA_ADMISSAO_FILA_%s' % nome.upper(), padrao))
+
+
+# leituras até o tamanho do pool de leitura; as escritas já são serializadas
+# pela conexão única de escrita, então poucas vagas bastam; o login, uma por
+# processo de hash
+ORCAMENTOS = {
+    nome: Orcamento(nome, vagas, _fila(nome, fila))
+    for nome, vagas, fila in (
+        ('leitura', _vagas('leitura', PERFIL_ENGINE['pool_leitura'] + PERFIL_ENGINE['pool_overflow_leitura']), 64),
+        ('escrita', _vagas('escrita', PERFIL_ENGINE['pool_escrita'] + 1), 32),
+        ('login', _vagas('login', max(WORKERS_HASH, 1)), 16),
+    )
+    if vagas > 0
+}
+
+
+def orcamento_da_requisicao(metodo, caminho):
+    if caminho in ROTAS_ISENTAS:
+        return None
+    if caminho in ROTAS_LOGIN:
+        return ORCAMENTOS.get('login')
+    if metodo in ('GET', 'HEAD'):
+        return ORCAMENTOS.get('leitura')
+    return ORCAMENTOS.get('escrita')
+
+
+def prazo_da_requisicao(prazo_cliente):
+    """A espera máxima, encurtada pelo X-Prazo-Ms do cliente."""
+    try:
+        return min(ESPERA_MAXIMA, max(float(prazo_cliente) / 1000, 0))
+    except (TypeError, ValueError):
+        return ESPERA_MAXIMA
+
+
+# ---------------------------------------------------------------------------
+# Flask
+
+def _admitir():
+    orcamento = orcamento_da_requisicao(request.method, request.path)
+    if orcamento is None:
+        return None
+    try:
+        orcamento.entrar(prazo_da_requisicao(request.headers.get('X-Prazo-Ms')))
+    except ServidorSobrecarregado as e:
+        return jsonify({'erro': 'servidor ocupado, tente novamente'}), 503, {'Retry-After': str(e.retry_after)}
+    g.admissao = (orcamento, time.perf_counter())
+    return None
+
+
+def _liberar(exception=None):
+    admissao = g.pop('admissao', None)
+    if admissao is not None:
+        orcamento, inicio = admissao
+        orcamento.sair(time.perf_counter() - inicio)
+
+
+def metricas_admissao():
+    estados = {nome: orcamento.estado() for nome, orcamento in ORCAMENTOS.items()}
+    linhas = []
+    for metrica, tipo, valor in (
+            ('vagas', 'gauge', lambda nome, orcamento: orcamento.vagas),
+            ('em_uso', 'gauge', lambda nome, orcamento: estados[nome][0]),
+            ('fila', 'gauge', lambda nome, orcamento: estados[nome][1]),
+            ('admitidas_total', 'counter', lambda nome, orcamento: orcamento.admitidas)):
+        linhas.append('# TYPE biblioteca_admissao_%s %s' % (metrica, tipo))
+        linhas += ['biblioteca_admissao_%s{orcamento="%s"} %d' % (metrica, nome, valor(nome, orcamento))
+                   for nome, orcamento in ORCAMENTOS.items()]
+    linhas.append('# TYPE biblioteca_admissao_recusadas_total counter')
+    for nome, orcamento in ORCAMENTOS.items():
+        linhas += ['biblioteca_admissao_recusadas_total{orcamento="%s",motivo="%s"} %d' % (nome, motivo, total)
+                   for motivo, total in orcamento.recusadas.items()]
+    linhas.append('# TYPE biblioteca_admissao_espera_segundos histogram')
+    for nome, orcamento in ORCAMENTOS.items():
+        linhas.extend(orcamento.espera.linhas('biblioteca_admissao_espera_segundos', 'orcamento="%s",' % nome))
+    return linhas
+
+
+def instrumentar_app(app):
+    app.before_request(_admitir)
+    app.teardown_request(_liberar)
+    metricas.registrar_coletor(metricas_admissao)
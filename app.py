@@ -1,52 +1,324 @@
 
+import click
+import csv
+import io
+import json
 import sqlalchemy
 from dateutil.relativedelta import relativedelta
-from flask import Flask, jsonify, redirect, request
+from flask import Flask, jsonify, redirect, request, Response, send_from_directory, stream_with_context
 from flask_pydantic_spec import FlaskPydanticSpec
-from datetime import date
+from datetime import date, datetime
 from functools import wraps
-from models import Livro, Usuario, Emprestimo, db_session, User
+from models import (Livro, Usuario, Emprestimo, Exemplar, FORMATO_CODIGO_BARRAS, db_session, db_session_leitura,
+                    User, reconstruir_busca_livros, reconstruir_contadores_exemplares, engine, engine_leitura)
+import admissao
+import compressao
+import eventos
+import exportacao
+from estatisticas import (EstatisticaLivro, EstatisticaUsuario, EstatisticaAutor, EstatisticaMes,
+                          reconstruir_estatisticas, verificar_estatisticas)
+from metricas import metricas
+from migracoes import migrar, pendentes
+from provedor_json import criar_provedor_json
+from cache import cache, cache_catalogo, incrementar_versao, quer_stream
+from idempotencia import idempotente
+from senhas import FilaHashCheia
 from datetime import date
 # from dateutil.relativedelta import relativedelta
-from sqlalchemy import select
-from flask_jwt_extended import get_jwt_identity, JWTManager, create_access_token, jwt_required
+from sqlalchemy import select, insert, exists, literal, table, column, text, func, tuple_, cast, Integer, and_, case
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import selectinload
+from flask_jwt_extended import get_jwt, JWTManager, create_access_token, jwt_required, verify_jwt_in_request
+from autorizacao import eh_admin, guardar_versao, token_valido
 app = Flask(__name__)
+app.json = criar_provedor_json(app)
 spec = FlaskPydanticSpec('Flask',
                          title='Flask API',
                          version='1.0.0')
 spec.register(app)
 app.config['JWT_SECRET_KEY'] = 'senha'
 jwt = JWTManager(app)
+metricas.instrumentar_app(app)
+admissao.instrumentar_app(app)
+compressao.instrumentar_app(app)
+metricas.instrumentar_engine(engine)
+metricas.instrumentar_engine(engine_leitura)
+
+
+@app.teardown_appcontext
+def remover_sessoes(exception=None):
+    # devolve as conexões ao pool ao fim de cada requisição
+    db_session.remove()
+    db_session_leitura.remove()
+
+@jwt.token_in_blocklist_loader
+def token_revogado(jwt_header, jwt_payload):
+    return not token_valido(jwt_payload)
+
 
 def admin_required(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        current_user = get_jwt_identity()
-        print(current_user)
-
-        try:
-            user = db_session.execute(select(User).where(User.email == current_user)).scalar()
-            print(user)
-            if user and user.papel == "gerente":
-                return fn(*args, **kwargs)
-
-            return jsonify({'error':'usuario não possui permissão de administrador'})
-        finally:
-            db_session.close()
+        # o papel vem da claim assinada no login; tokens revogados (versão
+        # diferente da de users.versao_token, guardada em memória) já são
+        # barrados no verify
+        verify_jwt_in_request()
+        if eh_admin(get_jwt()):
+            return fn(*args, **kwargs)
+
+        return jsonify({'error':'usuario não possui permissão de administrador'}), 403
     return wrapper
 
+
+LIMITE_PADRAO = 100
+LIMITE_MAXIMO = 1000
+
+
+def livro_para_dict(livro):
+    livro_data = livro.serialize_livro()
+    livro_data["id_livro"] = livro.id_livro
+    return livro_data
+
+
+def usuario_para_dict(usuario):
+    usuario_data = usuario.serialize_usuario()
+    usuario_data["id_usuario"] = usuario.id_usuario
+    return usuario_data
+
+
+def emprestimo_para_dict(emprestimo):
+    emprestimo_data = emprestimo.serialize_emprestimo()
+    emprestimo_data["id_emprestimo"] = emprestimo.id_emprestimo
+    return emprestimo_data
+
+
+# Colunas das listagens, com o mesmo nome usado no JSON dos serialize_*.
+# As listagens selecionam só essas colunas (linhas Core, sem montar objetos
+# do ORM) e "?fields=" escolhe um subconjunto delas.
+CAMPOS_LIVRO = {
+    'id_livro': Livro.id_livro,
+    'titulo': Livro.titulo,
+    'autor': Livro.autor,
+    'isbn': Livro.ISBN,
+    'resumo': Livro.resumo,
+    # contadores mantidos por trigger: a disponibilidade sai sem juntar com os empréstimos
+    'exemplares': Livro.exemplares_total,
+    'disponiveis': Livro.exemplares_disponiveis,
+}
+CAMPOS_USUARIO = {
+    'id_usuario': Usuario.id_usuario,
+    'nome': Usuario.nome,
+    'cpf': Usuario.CPF,
+    'endereco': Usuario.endereco,
+}
+CAMPOS_EMPRESTIMO = {
+    'id_emprestimo': Emprestimo.id_emprestimo,
+    'data de emprestimo': Emprestimo.data_emprestimo,
+    'data de devolucao': Emprestimo.data_devolucao,
+    'data de retorno': Emprestimo.returned_at,
+    'usuario': Emprestimo.id_usuario,
+    'livro': Emprestimo.id_livro,
+    'exemplar': Emprestimo.id_exemplar,
+}
+
+
+def colunas_projecao(campos, coluna_id, args=None):
+    """
+    Lê "?fields=titulo,autor" e devolve as colunas rotuladas a selecionar.
+
+    O id da listagem sempre vem junto, porque é o cursor da paginação.
+    "args" é a query string (padrão: request.args); o app_async passa a dele.
+    """
+    args = request.args if args is None else args
+    nomes = [nome.strip() for nome in args.get('fields', '').split(',') if nome.strip()]
+    invalidos = [nome for nome in nomes if nome not in campos]
+    if invalidos:
+        raise ValueError('fields inválido: %s (use %s)' % (', '.join(invalidos), ', '.join(campos)))
+    nomes = nomes or list(campos)
+    if coluna_id.key not in nomes:
+        nomes.insert(0, coluna_id.key)
+    return [campos[nome].label(nome) for nome in nomes]
+
+
+EXPANSOES_EMPRESTIMO = {
+    'livro': (Emprestimo.livro, livro_para_dict),
+    'usuario': (Emprestimo.usuario, usuario_para_dict),
+}
+
+
+def parametros_expand(args=None):
+    """
+    Lê "?expand=livro,usuario" e devolve a consulta a aplicar e o serializador.
+
+    Cada relação pedida é carregada com um único SELECT ... IN (selectinload)
+    por página, em vez de uma consulta por empréstimo. No JSON, o id em
+    "livro"/"usuario" é trocado pelo objeto completo.
+    """
+    args = request.args if args is None else args
+    nomes = [nome.strip() for nome in args.get('expand', '').split(',') if nome.strip()]
+    invalidos = [nome for nome in nomes if nome not in EXPANSOES_EMPRESTIMO]
+    if invalidos:
+        raise ValueError('expand inválido: %s (use livro e/ou usuario)' % ', '.join(invalidos))
+
+    if not nomes:
+        return None, None
+    if args.get('fields'):
+        raise ValueError('expand e fields não podem ser usados juntos')
+    opcoes = [selectinload(EXPANSOES_EMPRESTIMO[nome][0]) for nome in nomes]
+
+    def serializar(emprestimo):
+        emprestimo_data = emprestimo_para_dict(emprestimo)
+        for nome in nomes:
+            relacao, para_dict = EXPANSOES_EMPRESTIMO[nome]
+            relacionado = getattr(emprestimo, relacao.key)
+            emprestimo_data[nome] = para_dict(relacionado) if relacionado is not None else None
+        return emprestimo_data
+
+    return opcoes, serializar
+
+
+def consulta_emprestimos(args):
+    """Empréstimos como objetos com as relações de "expand" ou como linhas Core com "fields"."""
+    opcoes, serializar = parametros_expand(args)
+    if serializar:
+        return select(Emprestimo).options(*opcoes), serializar
+    return select(*colunas_projecao(CAMPOS_EMPRESTIMO, Emprestimo.id_emprestimo, args)), None
+
+
+def parametros_paginacao(args=None):
+    """
+    Lê os parâmetros de paginação por cursor da query string.
+
+    "limit": quantidade máxima de registros (padrão 100, máximo 1000).
+    "after": retorna apenas registros com id maior que este valor.
+    """
+    args = request.args if args is None else args
+    limite = args.get('limit', LIMITE_PADRAO, type=int)
+    depois = args.get('after', 0, type=int)
+    return max(1, min(limite, LIMITE_MAXIMO)), depois
+
+
+def pagina_keyset(sql, coluna_id, args=None):
+    """Aplica limit/after em "sql"; o limite vem junto para montar o "proximo"."""
+    limite, depois = parametros_paginacao(args)
+    return sql.where(coluna_id > depois).order_by(coluna_id), limite
+
+
+def fatiar_pagina(registros, limite, chave_id):
+    """Separa a linha extra pedida além do limite e devolve (registros, proximo)."""
+    if len(registros) > limite:
+        registros = registros[:limite]
+        return registros, registros[-1][chave_id]
+    return registros, None
+
+
+def linhas_listagem(resultado, serializar=None):
+    """Linhas Core viram dicts direto; objetos do ORM passam por "serializar"."""
+    if serializar is None:
+        return map(dict, resultado.mappings())
+    return map(serializar, resultado.scalars())
+
+
+def resposta_stream(sql, chave, serializar=None):
+    """Escreve a lista em JSON conforme as linhas saem do cursor, sem montar tudo em memória."""
+    def gerar():
+        yield '{"%s": [' % chave
+        resultado = db_session_leitura.execute(sql.execution_options(yield_per=500))
+        for i, registro in enumerate(linhas_listagem(resultado, serializar)):
+            yield (',' if i else '') + app.json.dumps(registro)
+        yield ']}'
+
+    return Response(stream_with_context(gerar()), mimetype='application/json')
+
+
+def listar_paginado(sql, coluna_id, chave, serializar=None):
+    """
+    Pagina "sql" por keyset na coluna "coluna_id" (limit/after).
+
+    "sql" seleciona colunas rotuladas (ver colunas_projecao) ou, com
+    "serializar", objetos do ORM. Em ambos os casos o id precisa sair com o
+    nome da coluna, que é o valor de "proximo".
+
+    Com "?stream=1" a resposta é enviada em streaming; nesse modo o "limit"
+    é opcional e, sem ele, todos os registros depois de "after" são enviados.
+    """
+    sql, limite = pagina_keyset(sql, coluna_id)
+
+    if quer_stream(request.args):
+        if 'limit' in request.args:
+            sql = sql.limit(limite)
+        return resposta_stream(sql, chave, serializar)
+
+    registros = list(linhas_listagem(db_session_leitura.execute(sql.limit(limite + 1)), serializar))
+    registros, proximo = fatiar_pagina(registros, limite, coluna_id.key)
+    return jsonify({chave: registros, 'proximo': proximo})
+
 @app.route('/')
 def index():
     return redirect('/consultar_livros')
 
 
+def metricas_cache():
+    estatisticas = cache.estatisticas()
+    return [
+        '# TYPE biblioteca_cache_itens gauge',
+        'biblioteca_cache_itens %d' % estatisticas['itens'],
+        '# TYPE biblioteca_cache_acertos_total counter',
+        'biblioteca_cache_acertos_total %d' % estatisticas['acertos'],
+        '# TYPE biblioteca_cache_erros_total counter',
+        'biblioteca_cache_erros_total %d' % estatisticas['erros'],
+        '# TYPE biblioteca_cache_remocoes_total counter',
+        'biblioteca_cache_remocoes_total %d' % estatisticas['remocoes'],
+    ]
+
+
+metricas.registrar_coletor(metricas_cache)
+
+
+@app.route('/metrics', methods=['GET'])
+def exportar_metricas():
+    """
+    Métricas da API no formato de texto do Prometheus.
+
+    Endpoint:
+    /metrics
+    """
+    return metricas.resposta()
+
+
+@app.route('/cache/estatisticas', methods=['GET'])
+def estatisticas_cache():
+    """
+    Retorna os contadores do cache das listagens do catálogo.
+
+    Endpoint:
+    /cache/estatisticas
+
+    Respostas (JSON):
+    ```json
+    {
+        "itens": 12,
+        "max_itens": 256,
+        "ttl": 30,
+        "acertos": 340,
+        "erros": 25,
+        "remocoes": 3
+    }
+    ```
+    """
+    return jsonify(cache.estatisticas())
+
+
 @app.route('/cadastrar_users', methods=['POST'])
 def cadastrar_user():
-    dados = request.get_json()
-    nome = dados['nome']
-    email = dados['email']
+    # corpo ausente, malformado ou que não é um objeto: o mesmo 400 de campo faltando
+    dados = request.get_json(silent=True)
+    dados = dados if isinstance(dados, dict) else {}
+    nome = dados.get('nome')
+    email = dados.get('email')
     papel = dados.get('papel', 'usuario')
-    senha = dados['senha']
+    senha = dados.get('senha')
 
     if not nome or not email or not senha:
         return jsonify({"msg": "Nome de usuário e senha são obrigatórios"}), 400
@@ -65,34 +337,56 @@ def cadastrar_user():
 
         user_id = novo_usuario.id
         return jsonify({"sucesso": user_id}), 201
+    except FilaHashCheia:
+        db_session.rollback()
+        return jsonify({"error": "servidor ocupado, tente novamente"}), 503, {'Retry-After': '1'}
     except Exception as e:
         db_session.rollback()
-        return jsonify({"error": {str(e)}}), 500
+        return jsonify({"error": str(e)}), 500
     finally:
         db_session.close()
 
 @app.route('/login', methods=['POST'])
 def login():
-    dados = request.get_json()
+    dados = request.get_json(silent=True)
+    if not isinstance(dados, dict) or not dados.get('email') or not dados.get('senha'):
+        return jsonify({'error': 'Email e senha são obrigatórios'}), 400
     email = dados['email']
     senha = dados['senha']
     try:
         user = db_session.execute(select(User).where(User.email == email)).scalar()
         if user and user.check_password(senha):
-            access_token = create_access_token(identity=email)
+            # hash gerado com parâmetros antigos: regrava com o fator de trabalho atual
+            if user.precisa_rehash():
+                user.set_senha_hash(senha)
+                db_session.commit()
+            access_token = create_access_token(
+                identity=email,
+                additional_claims={'papel': user.papel, 'ver': user.versao_token}
+            )
+            guardar_versao(email, user.versao_token)
             return jsonify(access_token=access_token)
         return jsonify({'error': 'Senha incorreto'})
+    except FilaHashCheia:
+        return jsonify({'error': 'servidor ocupado, tente novamente'}), 503, {'Retry-After': '1'}
     finally:
         db_session.close()
 
 @app.route('/livros', methods=['GET'])
+@cache_catalogo(Livro.__tablename__, Emprestimo.__tablename__)
 def get_livros():
     """
-    Retorna uma lista de todos os livros cadastrados.
+    Retorna uma lista paginada dos livros cadastrados.
 
     Endpoint:
     /livros
 
+    Parâmetros (query string):
+    "limit": quantidade de livros por página (padrão 100, máximo 1000).
+    "after": id_livro do último livro da página anterior.
+    "stream": se "1", envia a lista em streaming (exportação completa).
+    "fields": campos a retornar, ex.: "titulo,disponiveis" (o id_livro sempre vem).
+
     Respostas (JSON):
     ```json
     {
@@ -102,11 +396,19 @@ def get_livros():
                 "titulo": "titulooooo",
                 "autor": " Gabriele",
                 "ISBN": "9788533302273",
-                "resumo": "lalala"
+                "resumo": "lalala",
+                "exemplares": 3,
+                "disponiveis": 1
             }
-        ]
+        ],
+        "proximo": 1
     }
     ```
+    "exemplares" é quantos exemplares o livro tem e "disponiveis" quantos
+    não estão emprestados.
+    "proximo" é o valor a ser enviado em "after" para a próxima página
+    (null quando não há mais livros).
+
     Erros possíveis (JSON):
     ```json
     {
@@ -115,19 +417,37 @@ def get_livros():
     ```
     """
     try:
-        sql_livros = select(Livro)
-        resultado_livros = db_session.execute(sql_livros).scalars()
-        lista_livros = []
-        for livro in resultado_livros:
-            livro_data = livro.serialize_livro()
-            livro_data["id_livro"] = livro.id_livro
-            lista_livros.append(livro_data)
-        return jsonify({'livros': lista_livros})
+        colunas = colunas_projecao(CAMPOS_LIVRO, Livro.id_livro)
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    try:
+        return listar_paginado(select(*colunas), Livro.id_livro, 'livros')
     except Exception as e:
         return jsonify({'erro': str(e)}), 500
 
 
+def validar_livro(dados):
+    """
+    Aplica as regras de cadastro de livro e retorna (campos, erro).
+
+    "campos" já vem com os nomes das colunas de Livro; "erro" é None quando
+    os dados são válidos.
+    """
+    if not isinstance(dados, dict):
+        return None, "Linha inválida"
+    isbn_value = dados.get('isbn') or dados.get('ISBN')
+    if not all([dados.get('titulo'), dados.get('autor'), isbn_value, dados.get('resumo')]):
+        return None, "Campos obrigatórios (titulo, autor, ISBN/isbn, resumo) não podem ser vazios"
+    return {
+        'titulo': dados['titulo'],
+        'autor': dados['autor'],
+        'ISBN': isbn_value,
+        'resumo': dados['resumo'],
+    }, None
+
+
 @app.route('/novo_livro', methods=['POST'])
+@idempotente
 def cadastrar_livro():
     """
     Cadastra um novo livro no sistema.
@@ -135,15 +455,22 @@ def cadastrar_livro():
     Endpoint:
     /novo_livro
 
+    Com o cabeçalho Idempotency-Key, repetições com a mesma chave recebem a
+    resposta da primeira execução (ver idempotencia.py).
+
     Corpo da Requisição (JSON):
     ```json
     {
         "titulo": "Nome do Livro",
         "autor": "Nome do Autor",
         "isbn": "11111111111",
-        "resumo": "Resumoo"
+        "resumo": "Resumoo",
+        "exemplares": 2
     }
     ```
+    "exemplares": quantos exemplares cadastrar junto (padrão 1), com código
+    de barras gerado; ou "codigos_barras": ["789...", "789..."] com os
+    códigos de cada exemplar.
 
     Respostas (JSON):
     ```json
@@ -152,7 +479,9 @@ def cadastrar_livro():
         "titulo": "Nome do Livro",
         "autor": "Nome do Autor",
         "ISBN": "11111111111",
-        "resumo": "Resumoo"
+        "resumo": "Resumoo",
+        "exemplares": 2,
+        "disponiveis": 2
     }
     ```
     Status: 201 Created
@@ -164,26 +493,219 @@ def cadastrar_livro():
     }
     ```
     Status: 400 Bad Request
+    ```json
+    {
+        "erro": "Mensagem de erro"
+    }
+    ```
+    Status: 500 Internal Server Error (falha do banco, ex.: banco travado; pode ser repetida com a mesma Idempotency-Key)
     """
     dados = request.get_json()
     try:
-        isbn_value = dados.get('isbn') or dados.get('ISBN')
-        if not all([dados.get('titulo'), dados.get('autor'), isbn_value, dados.get('resumo')]):
-            return jsonify({'erro': "Campos obrigatórios (titulo, autor, ISBN/isbn, resumo) não podem ser vazios"}), 400
-
-        novo_livro = Livro(
-            titulo=dados['titulo'],
-            autor=dados['autor'],
-            ISBN=isbn_value,
-            resumo=dados['resumo']
-        )
-        novo_livro.save()
+        campos, erro = validar_livro(dados)
+        if not erro:
+            codigos, quantidade, erro = ler_exemplares(dados)
+        if erro:
+            return jsonify({'erro': erro}), 400
+
+        # o livro e os exemplares na mesma transação
+        novo_livro = Livro(**campos)
+        db_session.add(novo_livro)
+        db_session.flush()
+        db_session.add_all(Exemplar(**linha) for linha in linhas_exemplares(novo_livro.id_livro, codigos, quantidade))
+        db_session.commit()
+        incrementar_versao(Livro.__tablename__)
         livro_response = novo_livro.serialize_livro()
         livro_response["id_livro"] = novo_livro.id_livro
         return jsonify(livro_response), 201
+    except SQLAlchemyError as e:
+        # 5xx: o idempotente não guarda, e a repetição executa de novo
+        db_session.rollback()
+        return jsonify({'erro': str(e)}), 500
     except Exception as e:
+        db_session.rollback()
         return jsonify({'erro': str(e)}), 400
 
+
+def ler_exemplares(dados, padrao=1):
+    """
+    Lê "codigos_barras" (lista de códigos) ou "exemplares" (quantidade) do
+    corpo e devolve (codigos, quantidade, erro). Sem códigos, os exemplares
+    recebem o código de FORMATO_CODIGO_BARRAS (ver linhas_exemplares).
+    """
+    codigos = dados.get('codigos_barras')
+    if codigos is not None:
+        if not isinstance(codigos, list) or not all(isinstance(c, str) and c.strip() for c in codigos):
+            return None, 0, 'codigos_barras deve ser uma lista de códigos'
+        if len(set(codigos)) != len(codigos):
+            return None, 0, 'Código de barras repetido'
+        return codigos, len(codigos), None
+    quantidade = dados.get('exemplares', padrao)
+    if not isinstance(quantidade, int) or isinstance(quantidade, bool) or not 0 <= quantidade <= LIMITE_MAXIMO:
+        return None, 0, 'exemplares deve ser um número entre 0 e %d' % LIMITE_MAXIMO
+    return None, quantidade, None
+
+
+def linhas_exemplares(id_livro, codigos, quantidade, primeiro=1):
+    """Linhas de EXEMPLARES do livro; sem "codigos", numeradas a partir de "primeiro"."""
+    if codigos is None:
+        codigos = [FORMATO_CODIGO_BARRAS % (id_livro, numero) for numero in range(primeiro, primeiro + quantidade)]
+    return [{'id_livro': id_livro, 'codigo_barras': codigo} for codigo in codigos]
+
+
+def consulta_proximo_numero_exemplar(id_livro):
+    """
+    Primeiro número livre para os códigos gerados do livro: o maior já usado
+    no formato dele + 1. Contar os exemplares não basta, porque um exemplar
+    removido ou um código informado no mesmo formato fariam o código gerado
+    colidir com um existente.
+    """
+    prefixo = (FORMATO_CODIGO_BARRAS % (id_livro, 0)).rsplit('-', 1)[0] + '-'
+    # GLOB (e não LIKE) diferencia maiúsculas e usa o índice único de codigo_barras
+    return (select(func.coalesce(func.max(cast(func.substr(Exemplar.codigo_barras, len(prefixo) + 1), Integer)), 0) + 1)
+            .where(Exemplar.codigo_barras.op('GLOB')(prefixo + '[0-9]*')))
+
+
+TAMANHO_LOTE_PADRAO = 500
+TAMANHO_LOTE_MAXIMO = 5000
+
+
+def ler_linhas_importacao():
+    """Lê o corpo da requisição aos poucos e gera (numero_da_linha, dados)."""
+    texto = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    if request.mimetype == 'text/csv':
+        leitor = csv.DictReader(texto)
+        for dados in leitor:
+            yield leitor.line_num, dados
+        return
+
+    for numero, linha in enumerate(texto, 1):
+        if not linha.strip():
+            continue
+        try:
+            yield numero, json.loads(linha)
+        except ValueError:
+            yield numero, None
+
+
+def inserir_lote_livros(lote, erros):
+    """
+    Insere o lote (lista de (linha, campos)) numa única transação.
+
+    Títulos repetidos (já cadastrados ou repetidos dentro do lote) são
+    reportados em "erros" e não interrompem a inserção dos demais.
+    """
+    titulos = [campos['titulo'] for _, campos in lote]
+    existentes = set(db_session.execute(select(Livro.titulo).where(Livro.titulo.in_(titulos))).scalars())
+
+    validos = []
+    for linha, campos in lote:
+        if campos['titulo'] in existentes:
+            erros.append({'linha': linha, 'erro': 'Título já cadastrado'})
+            continue
+        existentes.add(campos['titulo'])
+        validos.append((linha, campos))
+
+    if not validos:
+        return 0
+    try:
+        # executemany; o ON CONFLICT protege contra inserções concorrentes do mesmo título
+        ids_livros = db_session.execute(
+            sqlite_insert(Livro.__table__).on_conflict_do_nothing(index_elements=['titulo']).returning(Livro.id_livro),
+            [campos for _, campos in validos]
+        ).scalars().all()
+        # um exemplar para cada livro importado
+        if ids_livros:
+            db_session.execute(insert(Exemplar.__table__),
+                               [linha for id_livro in ids_livros for linha in linhas_exemplares(id_livro, None, 1)])
+        db_session.commit()
+        incrementar_versao(Livro.__tablename__)
+        return len(ids_livros)
+    except Exception as e:
+        db_session.rollback()
+        erros.extend({'linha': linha, 'erro': str(e)} for linha, _ in validos)
+        return 0
+
+
+@app.route('/livros/bulk', methods=['POST'])
+@admin_required
+def importar_livros():
+    """
+    Importa vários livros de uma vez, em lotes. Requer o token de um gerente
+    (Authorization: Bearer <token>).
+
+    Endpoint:
+    /livros/bulk
+
+    Parâmetros (query string):
+    "lote": quantidade de livros inseridos por transação (padrão 500, máximo 5000).
+
+    Corpo da Requisição:
+    NDJSON (Content-Type: application/x-ndjson), um livro por linha:
+    ```
+    {"titulo": "Livro 1", "autor": "Autor", "isbn": "111", "resumo": "Resumo"}
+    {"titulo": "Livro 2", "autor": "Autor", "isbn": "222", "resumo": "Resumo"}
+    ```
+    ou CSV (Content-Type: text/csv) com cabeçalho:
+    ```
+    titulo,autor,isbn,resumo
+    Livro 1,Autor,111,Resumo
+    ```
+    Cada linha é validada com as mesmas regras de /novo_livro e cada livro
+    importado ganha um exemplar.
+
+    Respostas (JSON):
+    ```json
+    {
+        "linhas": 2,
+        "inseridos": 1,
+        "erros": [
+            {"linha": 2, "erro": "Título já cadastrado"}
+        ]
+    }
+    ```
+    Status: 200 OK
+
+    Erros possíveis (JSON):
+    ```json
+    {
+        "msg": "Missing Authorization Header"
+    }
+    ```
+    Status: 401 Unauthorized (sem token, token inválido ou revogado)
+    ```json
+    {
+        "error": "usuario não possui permissão de administrador"
+    }
+    ```
+    Status: 403 Forbidden
+    """
+    tamanho_lote = request.args.get('lote', TAMANHO_LOTE_PADRAO, type=int)
+    tamanho_lote = max(1, min(tamanho_lote, TAMANHO_LOTE_MAXIMO))
+
+    linhas = 0
+    inseridos = 0
+    erros = []
+    lote = []
+    try:
+        for linha, dados in ler_linhas_importacao():
+            linhas += 1
+            campos, erro = validar_livro(dados)
+            if erro:
+                erros.append({'linha': linha, 'erro': erro})
+                continue
+            lote.append((linha, campos))
+            if len(lote) >= tamanho_lote:
+                inseridos += inserir_lote_livros(lote, erros)
+                lote = []
+        if lote:
+            inseridos += inserir_lote_livros(lote, erros)
+    except Exception as e:
+        return jsonify({'erro': str(e), 'linhas': linhas, 'inseridos': inseridos, 'erros': erros}), 400
+
+    return jsonify({'linhas': linhas, 'inseridos': inseridos, 'erros': erros})
+
+
 @app.route('/editar_livro/<int:id>', methods=['PUT'])
 def editar_livro(id):
     """
@@ -260,34 +782,46 @@ def editar_livro(id):
     except Exception as e:
         return jsonify({'erro': str(e)}), 400
 
-@app.route('/livro_status', methods=['GET'])
-def livro_status():
+
+def consulta_exemplares(id_livro):
+    """Exemplares do livro com o empréstimo em aberto de cada um (pelo índice único, sem varrer o histórico)."""
+    return (select(Exemplar.id_exemplar, Exemplar.codigo_barras, Emprestimo.id_emprestimo)
+            .outerjoin(Emprestimo, (Emprestimo.id_exemplar == Exemplar.id_exemplar) & Emprestimo.returned_at.is_(None))
+            .where(Exemplar.id_livro == id_livro)
+            .order_by(Exemplar.id_exemplar))
+
+
+def montar_exemplares(livro, linhas):
+    return {
+        'id_livro': livro.id_livro,
+        'exemplares': livro.exemplares_total,
+        'disponiveis': livro.exemplares_disponiveis,
+        'lista': [{
+            'id_exemplar': linha.id_exemplar,
+            'codigo_barras': linha.codigo_barras,
+            'emprestado': linha.id_emprestimo is not None,
+            'id_emprestimo': linha.id_emprestimo,
+        } for linha in linhas],
+    }
+
+
+@app.route('/livros/<int:id>/exemplares', methods=['GET'])
+def listar_exemplares(id):
     """
-    Retorna o status dos livros, separando-os entre emprestados e disponíveis.
+    Lista os exemplares de um livro e quais estão emprestados.
 
     Endpoint:
-    /livro_status
+    /livros/<id>/exemplares
 
     Respostas (JSON):
     ```json
     {
-        "livros_emprestados": [
-            {
-                "id_livro": 1,
-                "titulo": "Livro Emprestado 1",
-                "autor": "Autor 1",
-                "ISBN": "11441778745",
-                "resumo": "Resumo 1"
-            }
-        ],
-        "livros_disponiveis": [
-            {
-                "id_livro": 2,
-                "titulo": "Livro Disponível 1",
-                "autor": "Autor 2",
-                "ISBN": "111111147778",
-                "resumo": "Resumooooooooooooo 2"
-            }
+        "id_livro": 1,
+        "exemplares": 2,
+        "disponiveis": 1,
+        "lista": [
+            {"id_exemplar": 1, "codigo_barras": "L0000001-01", "emprestado": true, "id_emprestimo": 7},
+            {"id_exemplar": 5, "codigo_barras": "L0000001-02", "emprestado": false, "id_emprestimo": null}
         ]
     }
     ```
@@ -295,129 +829,462 @@ def livro_status():
     Erros possíveis (JSON):
     ```json
     {
-        "erro": "Mensagem de erro"
+        "erro": "Livro não encontrado"
     }
     ```
-    Status: 400 Bad Request
+    Status: 404 Not Found
     """
     try:
-        emprestimos_livro_ids = {e.id_livro for e in db_session.execute(select(Emprestimo)).scalars()}
-        todos_livros = db_session.execute(select(Livro)).scalars().all()
-
-        emprestados = []
-        disponiveis = []
-
-        for livro in todos_livros:
-            livro_data = livro.serialize_livro()
-            livro_data["id_livro"] = livro.id_livro
-            if livro.id_livro in emprestimos_livro_ids:
-                emprestados.append(livro_data)
-            else:
-                disponiveis.append(livro_data)
-
-        return jsonify({
-            "livros_emprestados": emprestados,
-            "livros_disponiveis": disponiveis
-        })
+        livro = db_session_leitura.execute(
+            select(Livro.id_livro, Livro.exemplares_total, Livro.exemplares_disponiveis)
+            .where(Livro.id_livro == id)).first()
+        if not livro:
+            return jsonify({'erro': 'Livro não encontrado'}), 404
+        return jsonify(montar_exemplares(livro, db_session_leitura.execute(consulta_exemplares(id)).all()))
     except Exception as e:
-        return jsonify({'erro': str(e)}), 400
-
+        return jsonify({'erro': str(e)}), 500
 
 
-@app.route('/usuarios', methods=['GET'])
-def get_usuarios():
+@app.route('/livros/<int:id>/exemplares', methods=['POST'])
+@admin_required
+def cadastrar_exemplares(id):
     """
-    Retorna uma lista de todos os usuários cadastrados.
+    Cadastra novos exemplares de um livro. Requer o token de um gerente
+    (Authorization: Bearer <token>).
 
     Endpoint:
-    /usuarios
+    /livros/<id>/exemplares
+
+    Corpo da Requisição (JSON):
+    ```json
+    {
+        "codigos_barras": ["7891234567890", "7891234567891"]
+    }
+    ```
+    ou {"exemplares": 2} para gerar os códigos.
 
     Respostas (JSON):
     ```json
     {
-        "usuarios": [
-            {
-                "id_usuario": 1,
-                "nome": "João Silva",
-                "CPF": "114444447777",
-                "endereco": "Ruaaaaaaaaaaaaaaaaaaaa",
-            }
+        "exemplares": [
+            {"id_exemplar": 8, "livro": 1, "codigo_barras": "7891234567890"},
+            {"id_exemplar": 9, "livro": 1, "codigo_barras": "7891234567891"}
         ]
     }
     ```
+    Status: 201 Created
+
     Erros possíveis (JSON):
     ```json
     {
-        "erro": "Mensagem de erro"
+        "erro": "Livro não encontrado"
     }
     ```
-    """
-    try:
-        sql_usuarios = select(Usuario)
-        resultado_usuarios = db_session.execute(sql_usuarios).scalars()
-        lista_usuarios = []
-        for usuario in resultado_usuarios:
-            usuario_data = usuario.serialize_usuario()
-            usuario_data["id_usuario"] = usuario.id_usuario
-            lista_usuarios.append(usuario_data)
-        return jsonify({'usuarios': lista_usuarios})
-    except Exception as e:
-        return jsonify({'erro': str(e)}), 500
-
-@app.route('/novo_usuario', methods=['POST'])
-def cadastrar_usuario():
-    """
-    Cadastra um novo usuário no sistema.
-
-    Endpoint:
-    /novo_usuario
-
-    Corpo da Requisição (JSON):
+    Status: 404 Not Found
     ```json
     {
-        "nome": "Maria Souza",
-        "cpf": "11114444787",
-        "endereco": "casa luciano professor"
+        "erro": "Código de barras já cadastrado"
     }
     ```
-
-    Respostas (JSON):
+    Status: 409 Conflict
     ```json
     {
-        "status": true,
-        "mensagem": "usuario cadastrado com sucesso!"
+        "erro": "Mensagem de erro"
     }
     ```
-    Status: 201 Created
-
-    Erros possíveis (JSON):
+    Status: 400 Bad Request
     ```json
     {
-        "status": false,
-        "erro": "Campos não podem ser vazios"
+        "msg": "Missing Authorization Header"
     }
     ```
-    Status: 400 Bad Request
+    Status: 401 Unauthorized (sem token, token inválido ou revogado)
+    ```json
+    {
+        "error": "usuario não possui permissão de administrador"
+    }
+    ```
+    Status: 403 Forbidden
     """
+    dados = request.get_json()
     try:
-        dados = request.get_json()
-        if not all([dados.get('nome'), dados.get('cpf'), dados.get('endereco')]):
-            return jsonify({'status': False, 'erro': "Campos obrigatórios (nome, cpf, endereco) não podem ser vazios"}), 400
+        codigos, quantidade, erro = ler_exemplares(dados if isinstance(dados, dict) else {})
+        if erro:
+            return jsonify({'erro': erro}), 400
+        livro = db_session.execute(select(Livro).where(Livro.id_livro == id)).scalar()
+        if not livro:
+            return jsonify({'erro': 'Livro não encontrado'}), 404
 
-        novo_usuario = Usuario(
-            nome=dados['nome'],
-            CPF=dados['cpf'],
-            endereco=dados['endereco']
-        )
-        novo_usuario.save()
-        return jsonify({
-            "status": True,
-            "mensagem": "usuario cadastrado com sucesso!"
-        }), 201
+        primeiro = db_session.execute(consulta_proximo_numero_exemplar(id)).scalar() if codigos is None else 1
+        novos = [Exemplar(**linha) for linha in linhas_exemplares(id, codigos, quantidade, primeiro)]
+        db_session.add_all(novos)
+        try:
+            db_session.commit()
+        except IntegrityError:
+            db_session.rollback()
+            return jsonify({'erro': 'Código de barras já cadastrado'}), 409
+        incrementar_versao(Livro.__tablename__)
+        return jsonify({'exemplares': [exemplar.serialize_exemplar() for exemplar in novos]}), 201
     except Exception as e:
-        return jsonify({
-            "status": False,
-            "erro": str(e)
+        db_session.rollback()
+        return jsonify({'erro': str(e)}), 400
+
+@app.route('/livro_status', methods=['GET'])
+@cache_catalogo(Livro.__tablename__, Emprestimo.__tablename__)
+def livro_status():
+    """
+    Retorna o status dos livros, separando-os entre emprestados e disponíveis.
+
+    Um livro está disponível enquanto tem ao menos um exemplar que não está
+    emprestado, e emprestado quando todos os exemplares estão; livros sem
+    nenhum exemplar cadastrado vêm à parte. A separação lê os contadores do
+    próprio livro.
+
+    Endpoint:
+    /livro_status
+
+    Parâmetros (query string):
+    "status": "disponivel", "emprestado" ou "sem_exemplares" para retornar apenas um dos grupos.
+    "limit": quantidade de livros por página (padrão 100, máximo 1000).
+    "after": id_livro do último livro da página anterior.
+    "fields": campos a retornar, ex.: "titulo,autor" (o id_livro sempre vem).
+
+    Respostas (JSON):
+    ```json
+    {
+        "livros_emprestados": [
+            {
+                "id_livro": 1,
+                "titulo": "Livro Emprestado 1",
+                "autor": "Autor 1",
+                "ISBN": "11441778745",
+                "resumo": "Resumo 1",
+                "exemplares": 1,
+                "disponiveis": 0
+            }
+        ],
+        "livros_disponiveis": [
+            {
+                "id_livro": 2,
+                "titulo": "Livro Disponível 1",
+                "autor": "Autor 2",
+                "ISBN": "111111147778",
+                "resumo": "Resumooooooooooooo 2",
+                "exemplares": 3,
+                "disponiveis": 2
+            }
+        ],
+        "livros_sem_exemplares": [
+            {
+                "id_livro": 3,
+                "titulo": "Livro Sem Exemplares",
+                "autor": "Autor 3",
+                "ISBN": "978000000003",
+                "resumo": "Resumo 3",
+                "exemplares": 0,
+                "disponiveis": 0
+            }
+        ],
+        "proximo": null
+    }
+    ```
+
+    Erros possíveis (JSON):
+    ```json
+    {
+        "erro": "Mensagem de erro"
+    }
+    ```
+    Status: 400 Bad Request
+    """
+    try:
+        sql, limite = consulta_livro_status(request.args)
+        linhas = db_session_leitura.execute(sql).mappings().all()
+        return jsonify(montar_livro_status(linhas, limite))
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 400
+
+
+SITUACOES_LIVRO = ('emprestado', 'disponivel', 'sem_exemplares')
+
+
+def consulta_livro_status(args):
+    status = args.get('status')
+    if status not in (None, *SITUACOES_LIVRO):
+        raise ValueError('status deve ser "disponivel", "emprestado" ou "sem_exemplares"')
+
+    # os contadores de exemplares ficam na própria linha do livro
+    condicoes = {
+        'disponivel': Livro.exemplares_disponiveis > 0,
+        'emprestado': and_(Livro.exemplares_total > 0, Livro.exemplares_disponiveis == 0),
+        'sem_exemplares': Livro.exemplares_total == 0,
+    }
+    situacao = case(*((condicao, situacao) for situacao, condicao in condicoes.items()))
+    colunas = colunas_projecao(CAMPOS_LIVRO, Livro.id_livro, args)
+    sql, limite = pagina_keyset(select(*colunas, situacao.label('situacao')), Livro.id_livro, args)
+    if status is not None:
+        sql = sql.where(condicoes[status])
+    return sql.limit(limite + 1), limite
+
+
+def montar_livro_status(linhas, limite):
+    linhas, proximo = fatiar_pagina(linhas, limite, 'id_livro')
+    grupos = {situacao: [] for situacao in SITUACOES_LIVRO}
+    for linha in linhas:
+        livro = dict(linha)
+        grupos[livro.pop('situacao')].append(livro)
+    return {
+        "livros_emprestados": grupos['emprestado'],
+        "livros_disponiveis": grupos['disponivel'],
+        "livros_sem_exemplares": grupos['sem_exemplares'],
+        "proximo": proximo
+    }
+
+
+
+livros_fts = table('LIVROS_FTS', column('rowid'))
+
+
+def consulta_fts(q):
+    """Transforma o texto digitado numa consulta FTS5: cada palavra vira um prefixo entre aspas."""
+    return ' '.join('"%s"*' % termo.replace('"', '""') for termo in q.split())
+
+
+@app.route('/buscar_livros', methods=['GET'])
+def buscar_livros():
+    """
+    Busca livros por palavras no título, autor ou resumo, ordenados por relevância.
+
+    Endpoint:
+    /buscar_livros?q=<texto>
+
+    Parâmetros (query string):
+    "q": palavras a buscar (todas precisam aparecer; o fim de cada palavra é livre).
+    "limit": quantidade de livros por página (padrão 100, máximo 1000).
+    "offset": posição inicial no resultado (use o "proximo" da página anterior).
+    "fields": campos a retornar, ex.: "titulo,autor" (o id_livro sempre vem).
+
+    Respostas (JSON):
+    ```json
+    {
+        "livros": [
+            {
+                "id_livro": 1,
+                "titulo": "Dom Casmurro",
+                "autor": "Machado de Assis",
+                "ISBN": "9788533302273",
+                "resumo": "lalala",
+                "exemplares": 2,
+                "disponiveis": 2
+            }
+        ],
+        "proximo": null
+    }
+    ```
+
+    Erros possíveis (JSON):
+    ```json
+    {
+        "erro": "Parâmetro q é obrigatório"
+    }
+    ```
+    Status: 400 Bad Request
+    """
+    try:
+        if not request.args.get('q', '').strip():
+            return jsonify({'erro': 'Parâmetro q é obrigatório'}), 400
+        sql, parametros, limite, offset = consulta_busca_livros(request.args)
+        livros = db_session_leitura.execute(sql, parametros).mappings().all()
+        return jsonify(montar_busca_livros(livros, limite, offset))
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 400
+
+
+def consulta_busca_livros(args):
+    limite, _ = parametros_paginacao(args)
+    offset = max(0, args.get('offset', 0, type=int))
+
+    # "rank" é o bm25 configurado em models.DDL_BUSCA_LIVROS; ordenar por ele
+    # deixa o próprio FTS5 escolher os melhores resultados sem ordenar tudo
+    sql = (select(*colunas_projecao(CAMPOS_LIVRO, Livro.id_livro, args))
+           .select_from(Livro)
+           .join(livros_fts, livros_fts.c.rowid == Livro.id_livro)
+           .where(text('"LIVROS_FTS" MATCH :consulta'))
+           .order_by(text('"LIVROS_FTS".rank'))
+           .limit(limite + 1)
+           .offset(offset))
+    return sql, {'consulta': consulta_fts(args.get('q', ''))}, limite, offset
+
+
+def montar_busca_livros(livros, limite, offset):
+    proximo = None
+    if len(livros) > limite:
+        livros = livros[:limite]
+        proximo = offset + limite
+    return {'livros': [dict(livro) for livro in livros], 'proximo': proximo}
+
+
+@app.route('/eventos', methods=['GET'])
+def eventos_sse():
+    """
+    Feed de mudanças do catálogo em Server-Sent Events (text/event-stream),
+    para acompanhar a disponibilidade sem consultar /livro_status de novo.
+
+    Endpoint:
+    /eventos?livros=1,2,3
+
+    Parâmetros de consulta:
+    - livros: só os eventos desses livros (opcional);
+    - desde: id do último evento recebido (opcional; o cabeçalho
+      Last-Event-ID, enviado pelo EventSource ao reconectar, tem
+      precedência). Sem ele, só chegam os eventos novos.
+
+    Eventos (livro_criado, livro_atualizado, livro_removido,
+    emprestimo_aberto, emprestimo_fechado):
+    ```
+    id: 1042
+    event: emprestimo_aberto
+    data: {"id_livro":2,"disponiveis":0,"em":"2024-05-01T12:00:00.000Z","id_emprestimo":7,"id_exemplar":4}
+    ```
+    Se os eventos depois de "desde" já foram descartados, chega o evento
+    "reiniciar" ({"ultimo": 1042}): recarregue os livros acompanhados e
+    siga a partir dele. Ver eventos.py.
+
+    Erros possíveis (JSON):
+    ```json
+    {
+        "erro": "desde/Last-Event-ID e livros devem ser números"
+    }
+    ```
+    Status: 400 Bad Request
+    """
+    try:
+        depois_de, livros, erro = eventos.parametros_eventos(request.headers.get('Last-Event-ID'), request.args)
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
+    if erro:
+        return jsonify({'erro': erro}), 400
+    return Response(eventos.transmitir(depois_de, livros), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/usuarios', methods=['GET'])
+@cache_catalogo(Usuario.__tablename__)
+def get_usuarios():
+    """
+    Retorna uma lista paginada dos usuários cadastrados.
+
+    Endpoint:
+    /usuarios
+
+    Parâmetros (query string):
+    "limit": quantidade de usuários por página (padrão 100, máximo 1000).
+    "after": id_usuario do último usuário da página anterior.
+    "stream": se "1", envia a lista em streaming (exportação completa).
+    "fields": campos a retornar, ex.: "nome,cpf" (o id_usuario sempre vem).
+
+    Respostas (JSON):
+    ```json
+    {
+        "usuarios": [
+            {
+                "id_usuario": 1,
+                "nome": "João Silva",
+                "CPF": "114444447777",
+                "endereco": "Ruaaaaaaaaaaaaaaaaaaaa",
+            }
+        ],
+        "proximo": null
+    }
+    ```
+    Erros possíveis (JSON):
+    ```json
+    {
+        "erro": "Mensagem de erro"
+    }
+    ```
+    """
+    try:
+        colunas = colunas_projecao(CAMPOS_USUARIO, Usuario.id_usuario)
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    try:
+        return listar_paginado(select(*colunas), Usuario.id_usuario, 'usuarios')
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
+
+@app.route('/novo_usuario', methods=['POST'])
+@idempotente
+def cadastrar_usuario():
+    """
+    Cadastra um novo usuário no sistema.
+
+    Endpoint:
+    /novo_usuario
+
+    Com o cabeçalho Idempotency-Key, repetições com a mesma chave recebem a
+    resposta da primeira execução (ver idempotencia.py).
+
+    Corpo da Requisição (JSON):
+    ```json
+    {
+        "nome": "Maria Souza",
+        "cpf": "11114444787",
+        "endereco": "casa luciano professor"
+    }
+    ```
+
+    Respostas (JSON):
+    ```json
+    {
+        "status": true,
+        "mensagem": "usuario cadastrado com sucesso!"
+    }
+    ```
+    Status: 201 Created
+
+    Erros possíveis (JSON):
+    ```json
+    {
+        "status": false,
+        "erro": "Campos não podem ser vazios"
+    }
+    ```
+    Status: 400 Bad Request
+    ```json
+    {
+        "status": false,
+        "erro": "Mensagem de erro"
+    }
+    ```
+    Status: 500 Internal Server Error (falha do banco, ex.: banco travado; pode ser repetida com a mesma Idempotency-Key)
+    """
+    try:
+        dados = request.get_json()
+        if not isinstance(dados, dict) or not all([dados.get('nome'), dados.get('cpf'), dados.get('endereco')]):
+            return jsonify({'status': False, 'erro': "Campos obrigatórios (nome, cpf, endereco) não podem ser vazios"}), 400
+
+        novo_usuario = Usuario(
+            nome=dados['nome'],
+            CPF=dados['cpf'],
+            endereco=dados['endereco']
+        )
+        novo_usuario.save()
+        return jsonify({
+            "status": True,
+            "mensagem": "usuario cadastrado com sucesso!"
+        }), 201
+    except SQLAlchemyError as e:
+        # 5xx: o idempotente não guarda, e a repetição executa de novo
+        db_session.rollback()
+        return jsonify({
+            "status": False,
+            "erro": str(e)
+        }), 500
+    except Exception as e:
+        return jsonify({
+            "status": False,
+            "erro": str(e)
         }), 400
 
 @app.route('/editar_usuario/<int:id>', methods=['PUT'])
@@ -495,11 +1362,20 @@ def editar_usuario(id):
 @app.route('/emprestimos', methods=['GET'])
 def get_emprestimos():
     """
-    Retorna uma lista de todos os empréstimos registrados.
+    Retorna uma lista paginada dos empréstimos em aberto (livros ainda não devolvidos).
 
     Endpoint:
     /emprestimos
 
+    Parâmetros (query string):
+    "limit": quantidade de empréstimos por página (padrão 100, máximo 1000).
+    "after": id_emprestimo do último empréstimo da página anterior.
+    "stream": se "1", envia a lista em streaming (exportação completa).
+    "expand": "livro", "usuario" ou "livro,usuario"; troca o id pelo objeto
+              relacionado (uma consulta extra por relação, não por empréstimo).
+    "fields": campos a retornar, ex.: "livro,data de devolucao" (o id_emprestimo
+              sempre vem; não combina com "expand").
+
     Respostas (JSON):
     ```json
     {
@@ -511,7 +1387,8 @@ def get_emprestimos():
                 "data_emprestimo": "2024-01-01",
                 "data_devolucao": "2024-01-15"
             }
-        ]
+        ],
+        "proximo": null
     }
     ```
     Erros possíveis (JSON):
@@ -522,19 +1399,142 @@ def get_emprestimos():
     ```
     """
     try:
-        sql_emprestimos = select(Emprestimo)
-        resultado_emprestimos = db_session.execute(sql_emprestimos).scalars()
-        lista_emprestimos = []
-        for emprestimo in resultado_emprestimos:
-            emprestimo_data = emprestimo.serialize_emprestimo()
-            emprestimo_data["id_emprestimo"] = emprestimo.id_emprestimo
-            lista_emprestimos.append(emprestimo_data)
-        return jsonify({'emprestimos': lista_emprestimos})
+        sql, serializar = consulta_emprestimos(request.args)
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    try:
+        return listar_paginado(sql.where(Emprestimo.returned_at.is_(None)),
+                               Emprestimo.id_emprestimo, 'emprestimos', serializar)
     except Exception as e:
         return jsonify({'erro': str(e)}), 500
 
 
+def datas_emprestimo():
+    """Retorna (data_emprestimo, data_devolucao) de um empréstimo feito hoje: prazo de 4 semanas."""
+    data_emprestimo = date.today()
+    return data_emprestimo, data_emprestimo + relativedelta(weeks=4)
+
+
+@app.route('/emprestimos/atrasados', methods=['GET'])
+def emprestimos_atrasados():
+    """
+    Retorna os empréstimos em aberto com data de devolução vencida.
+
+    Endpoint:
+    /emprestimos/atrasados
+
+    Parâmetros (query string):
+    "data": data de referência AAAA-MM-DD (padrão: hoje).
+    "agrupar": "usuario" para retornar a quantidade de atrasos por usuário.
+    "limit": quantidade de registros por página (padrão 100, máximo 1000).
+    "after": valor de "proximo" da página anterior.
+
+    Respostas (JSON):
+    ```json
+    {
+        "emprestimos_atrasados": [
+            {
+                "id_emprestimo": 1,
+                "usuario": 1,
+                "livro": 1,
+                "data de emprestimo": "2025-01-01",
+                "data de devolucao": "2025-01-29"
+            }
+        ],
+        "proximo": "2025-01-29,1,1"
+    }
+    ```
+    Com "agrupar=usuario":
+    ```json
+    {
+        "atrasados_por_usuario": [
+            {
+                "id_usuario": 1,
+                "quantidade": 2,
+                "devolucao_mais_antiga": "2025-01-29"
+            }
+        ],
+        "proximo": 1
+    }
+    ```
+
+    Erros possíveis (JSON):
+    ```json
+    {
+        "erro": "Mensagem de erro"
+    }
+    ```
+    Status: 400 Bad Request
+    """
+    try:
+        sql, limite, agrupado = consulta_atrasados(request.args)
+        resultado = db_session_leitura.execute(sql)
+        linhas = resultado.all() if agrupado else resultado.scalars().all()
+        return jsonify(montar_atrasados(linhas, limite, agrupado))
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 400
+
+
+def consulta_atrasados(args):
+    referencia = date.fromisoformat(args['data']) if args.get('data') else date.today()
+    limite, _ = parametros_paginacao(args)
+    depois = args.get('after')
+
+    if args.get('agrupar') == 'usuario':
+        sql = (select(Emprestimo.id_usuario,
+                      func.count().label('quantidade'),
+                      func.min(Emprestimo.data_devolucao).label('devolucao_mais_antiga'))
+               .where(Emprestimo.data_devolucao < referencia, Emprestimo.returned_at.is_(None))
+               .group_by(Emprestimo.id_usuario)
+               .order_by(Emprestimo.id_usuario)
+               .limit(limite + 1))
+        if depois:
+            sql = sql.where(Emprestimo.id_usuario > int(depois))
+        return sql, limite, True
+
+    # mesma ordem do índice parcial (data_devolucao, id_usuario, rowid): sem ordenação extra
+    ordem = (Emprestimo.data_devolucao, Emprestimo.id_usuario, Emprestimo.id_emprestimo)
+    sql = (select(Emprestimo)
+           .where(Emprestimo.data_devolucao < referencia, Emprestimo.returned_at.is_(None))
+           .order_by(*ordem)
+           .limit(limite + 1))
+    if depois:
+        data_cursor, usuario_cursor, id_cursor = depois.split(',')
+        sql = sql.where(tuple_(*ordem) >
+                        tuple_(date.fromisoformat(data_cursor), int(usuario_cursor), int(id_cursor)))
+    return sql, limite, False
+
+
+def montar_atrasados(linhas, limite, agrupado):
+    proximo = None
+    if agrupado:
+        if len(linhas) > limite:
+            linhas = linhas[:limite]
+            proximo = linhas[-1].id_usuario
+        return {
+            'atrasados_por_usuario': [{
+                'id_usuario': linha.id_usuario,
+                'quantidade': linha.quantidade,
+                'devolucao_mais_antiga': linha.devolucao_mais_antiga.isoformat(),
+            } for linha in linhas],
+            'proximo': proximo
+        }
+
+    if len(linhas) > limite:
+        linhas = linhas[:limite]
+        ultimo = linhas[-1]
+        proximo = '%s,%d,%d' % (ultimo.data_devolucao.isoformat(), ultimo.id_usuario, ultimo.id_emprestimo)
+    return {
+        'emprestimos_atrasados': [emprestimo_para_dict(e) for e in linhas],
+        'proximo': proximo
+    }
+
+
+VARIOS_EXEMPLARES_EMPRESTADOS = 'Mais de um exemplar do livro está emprestado: informe id_exemplar ou codigo_barras'
+
+
 @app.route('/realizar_emprestimo', methods=['POST'])
+@idempotente
 def cadastrar_emprestimo():
     """
     Realiza um novo empréstimo de livro para um usuário.
@@ -542,24 +1542,29 @@ def cadastrar_emprestimo():
     Endpoint:
     /realizar_emprestimo
 
+    Com o cabeçalho Idempotency-Key, repetições com a mesma chave recebem a
+    resposta da primeira execução (ver idempotencia.py).
+
     Corpo da Requisição (JSON):
     ```json
     {
         "id_usuario": 1,
-        "id_livro": 2,
-        "data_emprestimo": "xx-xx-xx",
-        "data_devolucao": "xx-xx-xx",
+        "id_livro": 2
     }
     ```
+    Com "id_livro" é emprestado qualquer exemplar disponível do livro; para
+    um exemplar específico envie "id_exemplar" ou "codigo_barras" no lugar.
 
     Respostas (JSON):
     ```json
     {
         "id_emprestimo": 1,
-        "id_usuario": 1,
-        "id_livro": 2,
-        "data_emprestimo": "xx-xx-xx",
-        "data_devolucao": "xx-xx-xx",
+        "usuario": 1,
+        "livro": 2,
+        "exemplar": 4,
+        "data de emprestimo": "xx-xx-xx",
+        "data de devolucao": "xx-xx-xx",
+        "data de retorno": null
     }
     ```
     Status: 201 Created
@@ -582,62 +1587,362 @@ def cadastrar_emprestimo():
         "erro": "Livro não encontrado"
     }
     ```
-    Status: 404 Not Found
+    Status: 404 Not Found (ou "Exemplar não encontrado")
+    ```json
+    {
+        "erro": "Nenhum exemplar disponível"
+    }
+    ```
+    Status: 409 Conflict (ou "Exemplar já está emprestado")
     ```json
     {
         "erro": "Mensagem de erro"
     }
     ```
     Status: 400 Bad Request
+    ```json
+    {
+        "erro": "Mensagem de erro"
+    }
+    ```
+    Status: 500 Internal Server Error (falha do banco, ex.: banco travado; pode ser repetida com a mesma Idempotency-Key)
     """
     dados = request.get_json()
     try:
-        if not all([dados.get('id_usuario'),
-                    dados.get('id_livro'),]):
-            return jsonify({'erro': "Campos obrigatórios (id_usuario, id_livro, data_emprestimo, data_devolucao) estão ausentes"}), 400
-
-        usuario_existente = db_session.execute(select(Usuario).where(Usuario.id_usuario == dados['id_usuario'])).scalar()
-        livro_existente = db_session.execute(select(Livro).where(Livro.id_livro == dados['id_livro'])).scalar()
+        alvo = alvo_emprestimo(dados) if isinstance(dados, dict) else None
+        if not alvo or not dados.get('id_usuario'):
+            return jsonify({'erro': "Campos obrigatórios (id_usuario e id_livro, id_exemplar ou codigo_barras) estão ausentes"}), 400
+        condicao, existe, erro_nao_encontrado, erro_indisponivel = alvo
 
+        usuario_existente = db_session.execute(select(Usuario.id_usuario).where(Usuario.id_usuario == dados['id_usuario'])).scalar()
         if not usuario_existente:
             return jsonify({'erro': 'Usuário não encontrado'}), 404
-        if not livro_existente:
-            return jsonify({'erro': 'Livro não encontrado'}), 404
-        data_emprestimo = date.today()
-        data_de_devolucao = data_emprestimo + relativedelta(weeks=4)
-        novo_emprestimo = Emprestimo(
+        if db_session.execute(existe).first() is None:
+            return jsonify({'erro': erro_nao_encontrado}), 404
+
+        data_emprestimo, data_de_devolucao = datas_emprestimo()
+        criado = db_session.execute(
+            sql_novos_emprestimos(dados['id_usuario'], data_emprestimo, data_de_devolucao, condicao)).first()
+        if criado is None:
+            db_session.rollback()
+            return jsonify({'erro': erro_indisponivel}), 409
+        db_session.commit()
+        incrementar_versao(Emprestimo.__tablename__)
+        return jsonify(emprestimo_para_dict(Emprestimo(
+            id_emprestimo=criado.id_emprestimo,
             id_usuario=dados['id_usuario'],
-            id_livro=dados['id_livro'],
-            data_emprestimo=str(data_emprestimo),
-            data_devolucao=str(data_de_devolucao),
-        )
-        novo_emprestimo.save()
-        emprestimo_response = novo_emprestimo.serialize_emprestimo()
-        emprestimo_response["id_emprestimo"] = novo_emprestimo.id_emprestimo
-        return jsonify(emprestimo_response), 201
+            id_livro=criado.id_livro,
+            id_exemplar=criado.id_exemplar,
+            data_emprestimo=data_emprestimo,
+            data_devolucao=data_de_devolucao,
+        ))), 201
+    except SQLAlchemyError as e:
+        # 5xx: o idempotente não guarda, e a repetição executa de novo
+        db_session.rollback()
+        return jsonify({'erro': str(e)}), 500
     except Exception as e:
+        db_session.rollback()
         return jsonify({'erro': str(e)}), 400
+
+
 @app.route("/devolver_livro", methods=["POST"])
+@idempotente
 def devolver_livro():
     try:
-        print('teste')
         dados = request.get_json()
-        id_livro = dados['id_livro']
-        emprestimo_encontrado = db_session.execute(select(Emprestimo).filter_by(id_livro=id_livro)).scalar()
-        if not emprestimo_encontrado:
+        filtro = filtro_devolucao(dados) if isinstance(dados, dict) else None
+        if filtro is None:
+            return jsonify({'erro': "Campo obrigatório (id_livro, id_exemplar ou codigo_barras) está ausente"}), 400
+        emprestimos = db_session.execute(
+            select(Emprestimo).where(filtro, Emprestimo.returned_at.is_(None)).limit(2)).scalars().all()
+        if not emprestimos:
             return jsonify({'error':'emprestimo nao encontrado'}), 404
-        emprestimo_encontrado.delete()
+        if len(emprestimos) > 1:
+            return jsonify({'erro': VARIOS_EXEMPLARES_EMPRESTADOS}), 409
+        emprestimos[0].devolver()
         return jsonify({'id_emprestimo': 'livro devolvido com sucesso'}), 200
     except Exception as e:
         return jsonify({'erro': str(e)}), 500
+
+
+def ids_do_lote(dados, campo):
+    ids = dados.get(campo) if isinstance(dados, dict) else None
+    if not isinstance(ids, list) or not ids or not all(isinstance(i, int) for i in ids):
+        return None
+    return ids
+
+
+def alvo_emprestimo(dados):
+    """
+    Qual exemplar emprestar: o do "codigo_barras", o do "id_exemplar" ou
+    qualquer disponível do "id_livro".
+
+    Devolve (condição em EXEMPLARES, consulta que confirma que o alvo existe,
+    erro se não existe, erro se não há exemplar disponível), ou None sem
+    nenhum dos campos.
+    """
+    if dados.get('id_livro') and not (dados.get('codigo_barras') or dados.get('id_exemplar')):
+        return (Exemplar.id_livro == dados['id_livro'], select(Livro.id_livro).where(Livro.id_livro == dados['id_livro']),
+                'Livro não encontrado', 'Nenhum exemplar disponível')
+    if dados.get('codigo_barras'):
+        condicao = Exemplar.codigo_barras == str(dados['codigo_barras'])
+    elif dados.get('id_exemplar'):
+        condicao = Exemplar.id_exemplar == dados['id_exemplar']
+    else:
+        return None
+    return (condicao, select(Exemplar.id_exemplar).where(condicao),
+            'Exemplar não encontrado', 'Exemplar já está emprestado')
+
+
+def filtro_devolucao(dados):
+    """O empréstimo a devolver pelo "codigo_barras", "id_exemplar" ou "id_livro"."""
+    if dados.get('codigo_barras'):
+        return Emprestimo.id_exemplar == (select(Exemplar.id_exemplar)
+                                          .where(Exemplar.codigo_barras == str(dados['codigo_barras']))
+                                          .scalar_subquery())
+    if dados.get('id_exemplar'):
+        return Emprestimo.id_exemplar == dados['id_exemplar']
+    if dados.get('id_livro'):
+        return Emprestimo.id_livro == dados['id_livro']
+    return None
+
+
+def sql_novos_emprestimos(id_usuario, data_emprestimo, data_devolucao, condicao):
+    """
+    INSERT ... SELECT ... ON CONFLICT DO NOTHING RETURNING que empresta, de
+    cada livro, o primeiro exemplar disponível entre os de "condicao".
+
+    Escolher o exemplar e inserir é um único comando, executado com o lock
+    de escrita, então dois terminais nunca pegam o mesmo exemplar; o índice
+    único de empréstimos em aberto é a segunda barreira. Livros sem exemplar
+    disponível simplesmente não voltam no RETURNING, sem abortar o resto do
+    lote.
+    """
+    em_aberto = exists().where(Emprestimo.id_exemplar == Exemplar.id_exemplar, Emprestimo.returned_at.is_(None))
+    escolhidos = (select(literal(id_usuario), Exemplar.id_livro, func.min(Exemplar.id_exemplar),
+                         literal(data_emprestimo, Emprestimo.data_emprestimo.type),
+                         literal(data_devolucao, Emprestimo.data_devolucao.type))
+                  .where(condicao, ~em_aberto)
+                  .group_by(Exemplar.id_livro))
+    return (sqlite_insert(Emprestimo.__table__)
+            .from_select(['id_usuario', 'id_livro', 'id_exemplar', 'data_emprestimo', 'data_devolucao'], escolhidos)
+            .on_conflict_do_nothing(index_elements=[Emprestimo.id_exemplar],
+                                    index_where=Emprestimo.returned_at.is_(None))
+            .returning(Emprestimo.id_livro, Emprestimo.id_emprestimo, Emprestimo.id_exemplar))
+
+
+def completar_lote_emprestimos(novos, resultados, criados):
+    """
+    Preenche os resultados 201 do lote com o empréstimo criado ("criados":
+    id_livro -> (id_emprestimo, id_exemplar)), ou 409 se o livro não tinha
+    exemplar disponível.
+    """
+    for linha, resultado in zip(novos, [r for r in resultados if r['status'] == 201]):
+        criado = criados.get(linha['id_livro'])
+        if criado is None:
+            resultado.update(status=409, erro='Nenhum exemplar disponível')
+        else:
+            resultado['emprestimo'] = emprestimo_para_dict(
+                Emprestimo(id_emprestimo=criado[0], id_exemplar=criado[1], **linha))
+
+
+def lote_devolucao(dados):
+    """(coluna, ids) da devolução em lote: "exemplares" pelo id_exemplar ou "livros" pelo id_livro."""
+    ids_exemplares = ids_do_lote(dados, 'exemplares')
+    if ids_exemplares is not None:
+        return Emprestimo.id_exemplar, ids_exemplares
+    ids_livros = ids_do_lote(dados, 'livros')
+    if ids_livros is not None:
+        return Emprestimo.id_livro, ids_livros
+    return None
+
+
+def marcar_devolucoes(emprestimos, ids, chave, agora):
+    """
+    Marca a devolução do empréstimo em aberto de cada id do lote ("chave":
+    id_livro ou id_exemplar) e devolve os resultados. Um livro com mais de
+    um exemplar emprestado recebe 409: é preciso dizer qual exemplar voltou.
+    """
+    por_id = {}
+    for emprestimo in emprestimos:
+        por_id.setdefault(getattr(emprestimo, chave), []).append(emprestimo)
+    resultados = []
+    for id_lote in ids:
+        abertos = por_id.pop(id_lote, None)
+        if not abertos:
+            resultados.append({chave: id_lote, 'status': 404, 'erro': 'emprestimo nao encontrado'})
+        elif len(abertos) > 1:
+            resultados.append({chave: id_lote, 'status': 409, 'erro': VARIOS_EXEMPLARES_EMPRESTADOS})
+        else:
+            abertos[0].returned_at = agora
+            resultados.append({chave: id_lote, 'status': 200, 'id_emprestimo': abertos[0].id_emprestimo})
+    return resultados
+
+
+@app.route('/realizar_emprestimo/lote', methods=['POST'])
+def cadastrar_emprestimos_lote():
+    """
+    Empresta vários livros para um mesmo usuário numa única transação.
+
+    Endpoint:
+    /realizar_emprestimo/lote
+
+    Corpo da Requisição (JSON):
+    ```json
+    {
+        "id_usuario": 1,
+        "livros": [2, 3, 99]
+    }
+    ```
+
+    Respostas (JSON):
+    ```json
+    {
+        "resultados": [
+            {"id_livro": 2, "status": 201, "emprestimo": {"id_emprestimo": 7, "...": "..."}},
+            {"id_livro": 3, "status": 409, "erro": "Nenhum exemplar disponível"},
+            {"id_livro": 99, "status": 404, "erro": "Livro não encontrado"}
+        ]
+    }
+    ```
+    Status: 200 OK
+
+    Erros possíveis (JSON):
+    ```json
+    {
+        "erro": "Campos obrigatórios (id_usuario, livros) estão ausentes"
+    }
+    ```
+    Status: 400 Bad Request
+    ```json
+    {
+        "erro": "Usuário não encontrado"
+    }
+    ```
+    Status: 404 Not Found
+    """
+    dados = request.get_json()
+    try:
+        ids_livros = ids_do_lote(dados, 'livros')
+        if not isinstance(dados, dict) or not dados.get('id_usuario') or ids_livros is None:
+            return jsonify({'erro': "Campos obrigatórios (id_usuario, livros) estão ausentes"}), 400
+
+        usuario_existente = db_session.execute(
+            select(Usuario.id_usuario).where(Usuario.id_usuario == dados['id_usuario'])).scalar()
+        if not usuario_existente:
+            return jsonify({'erro': 'Usuário não encontrado'}), 404
+
+        livros_existentes = set(db_session.execute(
+            select(Livro.id_livro).where(Livro.id_livro.in_(ids_livros))).scalars())
+
+        data_emprestimo, data_de_devolucao = datas_emprestimo()
+        resultados = []
+        novos = []
+        vistos = set()
+        for id_livro in ids_livros:
+            if id_livro not in livros_existentes:
+                resultados.append({'id_livro': id_livro, 'status': 404, 'erro': 'Livro não encontrado'})
+            elif id_livro in vistos:
+                resultados.append({'id_livro': id_livro, 'status': 400, 'erro': 'Livro repetido no lote'})
+            else:
+                vistos.add(id_livro)
+                novos.append({
+                    'id_usuario': dados['id_usuario'],
+                    'id_livro': id_livro,
+                    'data_emprestimo': data_emprestimo,
+                    'data_devolucao': data_de_devolucao,
+                })
+                resultados.append({'id_livro': id_livro, 'status': 201})
+
+        if novos:
+            criados = {linha.id_livro: (linha.id_emprestimo, linha.id_exemplar) for linha in db_session.execute(
+                sql_novos_emprestimos(dados['id_usuario'], data_emprestimo, data_de_devolucao,
+                                      Exemplar.id_livro.in_([linha['id_livro'] for linha in novos])))}
+            db_session.commit()
+            incrementar_versao(Emprestimo.__tablename__)
+            completar_lote_emprestimos(novos, resultados, criados)
+        return jsonify({'resultados': resultados})
+    except Exception as e:
+        db_session.rollback()
+        return jsonify({'erro': str(e)}), 400
+
+
+@app.route('/devolver_livro/lote', methods=['POST'])
+def devolver_livros_lote():
+    """
+    Devolve vários livros numa única transação.
+
+    Endpoint:
+    /devolver_livro/lote
+
+    Corpo da Requisição (JSON):
+    ```json
+    {
+        "livros": [2, 3, 99]
+    }
+    ```
+    ou {"exemplares": [4, 9]} com os ids dos exemplares devolvidos.
+
+    Respostas (JSON):
+    ```json
+    {
+        "resultados": [
+            {"id_livro": 2, "status": 200, "id_emprestimo": 7},
+            {"id_livro": 3, "status": 409, "erro": "Mais de um exemplar do livro está emprestado: ..."},
+            {"id_livro": 99, "status": 404, "erro": "emprestimo nao encontrado"}
+        ]
+    }
+    ```
+    Status: 200 OK
+
+    Erros possíveis (JSON):
+    ```json
+    {
+        "erro": "Campo obrigatório (livros ou exemplares) está ausente"
+    }
+    ```
+    Status: 400 Bad Request
+    """
+    dados = request.get_json()
+    try:
+        lote = lote_devolucao(dados)
+        if lote is None:
+            return jsonify({'erro': "Campo obrigatório (livros ou exemplares) está ausente"}), 400
+        coluna, ids = lote
+
+        emprestimos = db_session.execute(
+            select(Emprestimo).where(coluna.in_(ids), Emprestimo.returned_at.is_(None))).scalars().all()
+        resultados = marcar_devolucoes(emprestimos, ids, coluna.key, datetime.now())
+
+        db_session.commit()
+        incrementar_versao(Emprestimo.__tablename__)
+        return jsonify({'resultados': resultados})
+    except Exception as e:
+        db_session.rollback()
+        return jsonify({'erro': str(e)}), 500
+
+
 @app.route('/consulta_historico_emprestimo', methods=['GET'])
+@cache_catalogo(Emprestimo.__tablename__, Livro.__tablename__, Usuario.__tablename__)
 def historico_emprestimo():
     """
-    Retorna o histórico de todos os empréstimos.
+    Retorna o histórico de empréstimos (em aberto e devolvidos), paginado.
 
     Endpoint:
     /consulta_historico_emprestimo
 
+    Parâmetros (query string):
+    "id_usuario": apenas empréstimos deste usuário.
+    "id_livro": apenas empréstimos deste livro.
+    "de" / "ate": faixa de data_emprestimo (AAAA-MM-DD, inclusive).
+    "limit": quantidade de empréstimos por página (padrão 100, máximo 1000).
+    "after": id_emprestimo do último empréstimo da página anterior.
+    "stream": se "1", envia o histórico em streaming (exportação completa).
+    "expand": "livro", "usuario" ou "livro,usuario"; troca o id pelo objeto
+              relacionado (uma consulta extra por relação, não por empréstimo).
+    "fields": campos a retornar, ex.: "livro,data de devolucao" (o id_emprestimo
+              sempre vem; não combina com "expand").
+
     Respostas (JSON):
     ```json
     {
@@ -647,8 +1952,173 @@ def historico_emprestimo():
                 "id_usuario": 1,
                 "id_livro": 1,
                 "data_emprestimo": "01-01-2025",
-                "data_devolucao": "01-15-2025"
+                "data_devolucao": "01-15-2025",
+                "data de retorno": "2025-01-10T14:32:05"
+            }
+        ],
+        "proximo": null
+    }
+    ```
+    Erros possíveis (JSON):
+    ```json
+    {
+        "erro": "Mensagem de erro"
+    }
+    ```
+    """
+    try:
+        sql, serializar = consulta_emprestimos(request.args)
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    try:
+        return listar_paginado(filtros_historico(sql, request.args),
+                               Emprestimo.id_emprestimo, 'historico_de_emprestimo', serializar)
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
+
+
+def filtros_historico(sql, args):
+    if args.get('id_usuario'):
+        sql = sql.where(Emprestimo.id_usuario == args.get('id_usuario', type=int))
+    if args.get('id_livro'):
+        sql = sql.where(Emprestimo.id_livro == args.get('id_livro', type=int))
+    if args.get('de'):
+        sql = sql.where(Emprestimo.data_emprestimo >= date.fromisoformat(args['de']))
+    if args.get('ate'):
+        sql = sql.where(Emprestimo.data_emprestimo <= date.fromisoformat(args['ate']))
+    return sql
+
+
+# relatórios de circulação: leem as tabelas de resumo do estatisticas.py
+RANKINGS = {
+    # tipo: (modelo de estatística, chave, colunas extras, tabela relacionada, id na tabela relacionada)
+    'livros': (EstatisticaLivro, EstatisticaLivro.id_livro, (Livro.titulo, Livro.autor), Livro, Livro.id_livro),
+    'usuarios': (EstatisticaUsuario, EstatisticaUsuario.id_usuario, (Usuario.nome,), Usuario, Usuario.id_usuario),
+    'autores': (EstatisticaAutor, EstatisticaAutor.autor, (), None, None),
+}
+
+
+def consulta_ranking(tipo, args):
+    """
+    (sql, limite) do ranking "tipo", do mais emprestado para o menos.
+    O cursor "after" é "emprestimos,chave" da última linha da página.
+    """
+    modelo, chave, extras, relacionada, id_relacionada = RANKINGS[tipo]
+    limite, _ = parametros_paginacao(args)
+    # mesma ordem do índice (emprestimos, chave), lido de trás para frente
+    ordem = (modelo.emprestimos, chave)
+    sql = select(chave, *extras, modelo.emprestimos, modelo.devolucoes,
+                 (modelo.emprestimos - modelo.devolucoes).label('em_aberto'))
+    if relacionada is not None:
+        sql = sql.outerjoin(relacionada, id_relacionada == chave)
+    sql = sql.where(modelo.emprestimos > 0).order_by(*(coluna.desc() for coluna in ordem)).limit(limite + 1)
+    depois = args.get('after')
+    if depois:
+        emprestimos, valor = depois.split(',', 1)
+        sql = sql.where(tuple_(*ordem) < tuple_(int(emprestimos), valor if tipo == 'autores' else int(valor)))
+    return sql, limite
+
+
+def montar_ranking(linhas, limite, tipo):
+    registros = [dict(linha) for linha in linhas]
+    proximo = None
+    if len(registros) > limite:
+        registros = registros[:limite]
+        ultimo = registros[-1]
+        proximo = '%d,%s' % (ultimo['emprestimos'], ultimo[RANKINGS[tipo][1].key])
+    return {tipo: registros, 'proximo': proximo}
+
+
+def consulta_meses(args):
+    sql = select(EstatisticaMes.mes, EstatisticaMes.emprestimos, EstatisticaMes.devolucoes).order_by(EstatisticaMes.mes)
+    for parametro in ('de', 'ate'):
+        valor = args.get(parametro)
+        if not valor:
+            continue
+        try:
+            datetime.strptime(valor, '%Y-%m')
+        except ValueError:
+            raise ValueError('"%s" deve estar no formato AAAA-MM' % parametro)
+        sql = sql.where(EstatisticaMes.mes >= valor if parametro == 'de' else EstatisticaMes.mes <= valor)
+    return sql
+
+
+@app.route('/relatorios/<any(livros, usuarios, autores):tipo>', methods=['GET'])
+@cache_catalogo(Emprestimo.__tablename__, Livro.__tablename__, Usuario.__tablename__)
+def relatorio_ranking(tipo):
+    """
+    Ranking de circulação: livros, usuários ou autores com mais empréstimos.
+
+    Lê as tabelas de estatísticas, atualizadas a cada empréstimo e devolução,
+    então o custo é o do tamanho da página, não o do histórico.
+
+    Endpoint:
+    /relatorios/livros
+    /relatorios/usuarios
+    /relatorios/autores
+
+    Parâmetros (query string):
+    "limit": quantidade de linhas (top N; padrão 100, máximo 1000).
+    "after": valor de "proximo" da página anterior.
+
+    Respostas (JSON):
+    ```json
+    {
+        "livros": [
+            {
+                "id_livro": 7,
+                "titulo": "Dom Casmurro",
+                "autor": "Machado de Assis",
+                "emprestimos": 42,
+                "devolucoes": 40,
+                "em_aberto": 2
             }
+        ],
+        "proximo": "42,7"
+    }
+    ```
+    Em /relatorios/usuarios cada linha traz "id_usuario" e "nome"; em
+    /relatorios/autores, só "autor".
+
+    Erros possíveis (JSON):
+    ```json
+    {
+        "erro": "Mensagem de erro"
+    }
+    ```
+    Status: 400 Bad Request
+    """
+    try:
+        sql, limite = consulta_ranking(tipo, request.args)
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    try:
+        return jsonify(montar_ranking(db_session_leitura.execute(sql).mappings(), limite, tipo))
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
+
+
+@app.route('/relatorios/meses', methods=['GET'])
+@cache_catalogo(Emprestimo.__tablename__)
+def relatorio_meses():
+    """
+    Empréstimos e devoluções por mês.
+
+    Empréstimos contam no mês da data_emprestimo e devoluções no mês em que
+    o livro voltou.
+
+    Endpoint:
+    /relatorios/meses
+
+    Parâmetros (query string):
+    "de" / "ate": faixa de meses (AAAA-MM, inclusive).
+
+    Respostas (JSON):
+    ```json
+    {
+        "meses": [
+            {"mes": "2025-01", "emprestimos": 310, "devolucoes": 295},
+            {"mes": "2025-02", "emprestimos": 287, "devolucoes": 301}
         ]
     }
     ```
@@ -658,19 +2128,180 @@ def historico_emprestimo():
         "erro": "Mensagem de erro"
     }
     ```
+    Status: 400 Bad Request
     """
     try:
-        sql = select(Emprestimo)
-        emprestimos = db_session.execute(sql).scalars()
-        lista = []
-        for e in emprestimos:
-            emprestimo_data = e.serialize_emprestimo()
-            emprestimo_data["id_emprestimo"] = e.id_emprestimo
-            lista.append(emprestimo_data)
-        return jsonify({'historico_de_emprestimo': lista})
+        sql = consulta_meses(request.args)
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    try:
+        return jsonify({'meses': [dict(linha) for linha in db_session_leitura.execute(sql).mappings()]})
     except Exception as e:
         return jsonify({'erro': str(e)}), 500
 
 
+@app.route('/exportacoes/ultima', methods=['GET'])
+@admin_required
+def exportacao_ultima():
+    """
+    Manifesto do último snapshot gerado por "flask exportar": o jeito de
+    baixar o catálogo e o histórico inteiros sem consultar o banco. Requer o
+    token de um gerente (Authorization: Bearer <token>), como os arquivos.
+
+    Endpoint:
+    /exportacoes/ultima
+
+    Respostas (JSON):
+    ```json
+    {
+        "snapshot": "20240501T030000000000Z",
+        "gerado_em": "2024-05-01T03:00:00+00:00",
+        "formato": "ndjson",
+        "compressao": "gzip",
+        "arquivos": [
+            {"tabela": "LIVROS", "arquivo": "livros.ndjson.gz", "linhas": 20000, "bytes": 812345,
+             "sha256": "9f86d0...", "url": "/exportacoes/20240501T030000000000Z/livros.ndjson.gz"}
+        ]
+    }
+    ```
+    Status: 200 OK
+
+    Os arquivos são baixados pela "url" (aceita Range para retomar) e não
+    mudam depois de gerados; ver exportacao.py.
+
+    Erros possíveis (JSON):
+    ```json
+    {
+        "erro": "Nenhuma exportação disponível"
+    }
+    ```
+    Status: 404 Not Found
+    ```json
+    {
+        "msg": "Missing Authorization Header"
+    }
+    ```
+    Status: 401 Unauthorized (sem token, token inválido ou revogado)
+    ```json
+    {
+        "error": "usuario não possui permissão de administrador"
+    }
+    ```
+    Status: 403 Forbidden
+    """
+    dados = exportacao.manifesto_com_urls()
+    if dados is None:
+        return jsonify({'erro': 'Nenhuma exportação disponível'}), 404
+    resposta = jsonify(dados)
+    resposta.headers['Cache-Control'] = 'no-cache'
+    return resposta
+
+
+@app.route('/exportacoes/<nome>/<arquivo>', methods=['GET'])
+@admin_required
+def exportacao_arquivo(nome, arquivo):
+    """
+    Um arquivo de um snapshot (ou o manifesto.json dele), servido do disco
+    com send_file: aceita Range e If-None-Match e, com gunicorn, vai por
+    sendfile. Requer o token de um gerente.
+
+    Endpoint:
+    /exportacoes/<snapshot>/<arquivo>
+
+    Erros possíveis (JSON):
+    ```json
+    {
+        "erro": "Arquivo não encontrado"
+    }
+    ```
+    Status: 404 Not Found
+    ```json
+    {
+        "msg": "Missing Authorization Header"
+    }
+    ```
+    Status: 401 Unauthorized (sem token, token inválido ou revogado)
+    ```json
+    {
+        "error": "usuario não possui permissão de administrador"
+    }
+    ```
+    Status: 403 Forbidden
+    """
+    diretorio = exportacao.arquivo_do_snapshot(nome, arquivo)
+    if diretorio is None:
+        return jsonify({'erro': 'Arquivo não encontrado'}), 404
+    resposta = send_from_directory(diretorio, arquivo, max_age=exportacao.MAX_AGE_ARQUIVOS,
+                                   mimetype=None if arquivo == exportacao.ARQUIVO_MANIFESTO else 'application/gzip')
+    # exige token: só o cache do cliente pode guardar
+    resposta.cache_control.public = False
+    resposta.cache_control.private = True
+    return resposta
+
+
+@app.cli.command('reconstruir-busca')
+def reconstruir_busca():
+    """Recria o índice de busca textual a partir da tabela LIVROS."""
+    reconstruir_busca_livros()
+    print('Índice de busca reconstruído')
+
+
+@app.cli.command('reconstruir-exemplares')
+def reconstruir_exemplares():
+    """Recalcula os contadores de exemplares dos livros a partir de EXEMPLARES e EMPRÉSTIMOS."""
+    reconstruir_contadores_exemplares()
+    print('Contadores de exemplares reconstruídos')
+
+
+@app.cli.command('reconciliar-estatisticas')
+@click.option('--so-verificar', is_flag=True, help='só compara, sem reconstruir')
+def reconciliar_estatisticas(so_verificar):
+    """Confere as estatísticas de circulação com EMPRÉSTIMOS e reconstrói os resumos."""
+    divergencias = verificar_estatisticas()
+    for tabela, linhas in divergencias.items():
+        print('%s: %d divergência(s)' % (tabela, len(linhas)))
+        for chave, resumo, historico in linhas[:10]:
+            print('  %s: resumo %s, histórico %s' % (chave, resumo, historico))
+    if not divergencias:
+        print('Estatísticas conferem com o histórico')
+    if so_verificar:
+        if divergencias:
+            raise SystemExit(1)
+        return
+
+    reconstruir_estatisticas()
+    if verificar_estatisticas():
+        print('Estatísticas ainda divergem depois de reconstruir')
+        raise SystemExit(1)
+    print('Estatísticas reconstruídas')
+
+
+@app.cli.command('exportar')
+@click.option('--formato', type=click.Choice(exportacao.FORMATOS), default='ndjson', show_default=True)
+def exportar_snapshot(formato):
+    """Gera um snapshot de LIVROS, USUARIOS e EMPRÉSTIMOS em arquivos comprimidos (ver exportacao.py)."""
+    nome, dados = exportacao.exportar(formato)
+    for item in dados['arquivos']:
+        print('%s: %d linhas, %d bytes' % (item['arquivo'], item['linhas'], item['bytes']))
+    print('Snapshot %s gerado em %s' % (nome, exportacao.DIRETORIO))
+
+
+@app.cli.command('migrar')
+@click.option('--ate', type=int, help='aplica só até esta versão')
+@click.option('--listar', is_flag=True, help='só lista as migrações pendentes')
+def migrar_banco(ate, listar):
+    """Cria ou atualiza o schema do banco aplicando as migrações pendentes."""
+    if listar:
+        for numero, nome in pendentes():
+            print('pendente: %d %s' % (numero, nome))
+        return
+    aplicadas = migrar(ate=ate)
+    for numero, nome in aplicadas:
+        print('migração %d aplicada: %s' % (numero, nome))
+    if not aplicadas:
+        print('Banco já está na versão mais recente')
+
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
+    migrar()
+    app.run(debug=True, host='0.0.0.0', port=5001)
@@ -0,0 +1,904 @@
+"""
+Versão assíncrona (ASGI) da API, com as mesmas rotas e respostas do app.py.
+
+Roda em Starlette sobre a AsyncEngine do SQLAlchemy (aiosqlite) e
+AsyncSession: enquanto uma requisição espera o SQLite (inclusive pelo lock
+de escrita, dentro do busy_timeout), o event loop atende as outras, em vez
+de cada requisição prender uma thread. O hash de senhas vai para o mesmo
+pool de processos do app.py, pelas funções *_async do senhas.py.
+
+Validação, montagem das consultas e formato das respostas vêm do app.py;
+aqui ficam só a leitura da requisição e a execução assíncrona. A
+documentação de cada rota está no app.py.
+
+Uso:
+    uvicorn app_async:app --workers 4
+
+Depende de starlette, uvicorn e aiosqlite (requirements.txt).
+"""
+import asyncio
+import codecs
+import csv
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from functools import wraps
+
+from flask_jwt_extended import create_access_token, decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt import PyJWTError
+from sqlalchemy import select, insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, RedirectResponse, Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import http_date, parse_date, parse_etags
+
+from app import (app as app_flask, CAMPOS_LIVRO, CAMPOS_USUARIO, TAMANHO_LOTE_PADRAO, TAMANHO_LOTE_MAXIMO,
+                 colunas_projecao, consulta_emprestimos, consulta_livro_status, montar_livro_status,
+                 consulta_busca_livros, montar_busca_livros, consulta_atrasados, montar_atrasados,
+                 filtros_historico, pagina_keyset, fatiar_pagina, linhas_listagem, validar_livro,
+                 datas_emprestimo, ids_do_lote, emprestimo_para_dict, sql_novos_emprestimos, completar_lote_emprestimos,
+                 ler_exemplares, linhas_exemplares, consulta_proximo_numero_exemplar, consulta_exemplares,
+                 montar_exemplares, alvo_emprestimo, filtro_devolucao, lote_devolucao, marcar_devolucoes,
+                 VARIOS_EXEMPLARES_EMPRESTADOS,
+                 RANKINGS, consulta_ranking, montar_ranking, consulta_meses)
+from autorizacao import eh_admin, guardar_versao, sql_versao, versao_confere, versao_guardada, FALTA_VERSAO
+from cache import (cache, versao, incrementar_versao, modificacao_conhecida, quer_stream, registrar_modificacoes,
+                   sql_modificacoes, ultima_modificacao)
+import compressao
+import exportacao
+import eventos
+import idempotencia
+from metricas import metricas
+from models import Livro, Usuario, Emprestimo, Exemplar, User, criar_engine
+from senhas import FilaHashCheia, gerar_hash_async, verificar_senha_async, precisa_rehash_async
+
+engine_async = criar_engine(assincrona=True)
+engine_async_leitura = criar_engine(somente_leitura=True, assincrona=True)
+# sem expirar no commit: depois do commit os atributos continuam legíveis
+# sem um novo SELECT (que numa AsyncSession precisaria de await)
+Sessao = async_sessionmaker(engine_async, expire_on_commit=False)
+SessaoLeitura = async_sessionmaker(engine_async_leitura)
+metricas.instrumentar_engine(engine_async)
+metricas.instrumentar_engine(engine_async_leitura)
+
+RESPOSTA_OCUPADO = ({'error': 'servidor ocupado, tente novamente'}, 503, {'Retry-After': '1'})
+
+
+def resposta_json(dados, status=200, headers=None):
+    return Response(app_flask.json.dumps_bytes(dados), status, headers, media_type='application/json')
+
+
+def argumentos(request):
+    """Query string como MultiDict do werkzeug, o mesmo tipo do request.args usado pelo app.py."""
+    return MultiDict(request.query_params.multi_items())
+
+
+async def corpo_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def cache_catalogo_async(*tabelas):
+    """O cache_catalogo do cache.py (mesmas chaves, ETag, Last-Modified e 304) para rotas do Starlette."""
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(request):
+            if quer_stream(request.query_params):
+                return await fn(request)
+
+            chave = (request.url.path, request.scope['query_string'], tuple(versao(t) for t in tabelas))
+            item = cache.buscar(chave)
+            if item is None:
+                async with SessaoLeitura() as sessao:
+                    registrar_modificacoes((await sessao.execute(sql_modificacoes(tabelas))).all())
+                modificado = modificacao_conhecida(tabelas)
+                resposta = await fn(request)
+                if resposta.status_code != 200 or isinstance(resposta, StreamingResponse):
+                    return resposta
+                item = cache.guardar(chave, resposta.body, modificado)
+
+            corpo, etag, _, instante = item
+            modificado = ultima_modificacao(instante)
+            cabecalhos = {'ETag': '"%s"' % etag}
+            if modificado is not None:
+                cabecalhos['Last-Modified'] = http_date(modificado)
+            # como no Werkzeug: If-Modified-Since só conta sem If-None-Match
+            if 'if-none-match' in request.headers:
+                inalterado = parse_etags(request.headers['if-none-match']).contains_weak(etag)
+            else:
+                desde = parse_date(request.headers.get('if-modified-since'))
+                inalterado = desde is not None and modificado is not None and modificado <= desde
+            if inalterado:
+                return Response(status_code=304, headers=cabecalhos)
+            return Response(corpo, media_type='application/json', headers=cabecalhos)
+        return wrapper
+    return decorator
+
+
+def admin_required_async(fn):
+    """O admin_required do app.py: token de gerente, com a versão conferida como no token_valido."""
+    @wraps(fn)
+    async def wrapper(request):
+        esquema, _, token = request.headers.get('Authorization', '').partition(' ')
+        if esquema != 'Bearer' or not token:
+            return resposta_json({'msg': 'Missing Authorization Header'}, 401)
+        try:
+            with app_flask.app_context():
+                claims = decode_token(token)
+        except (PyJWTError, JWTExtendedException) as e:
+            return resposta_json({'msg': str(e)}, 401)
+        versao_token = versao_guardada(claims)
+        if versao_token is FALTA_VERSAO:
+            async with SessaoLeitura() as sessao:
+                versao_token = (await sessao.execute(sql_versao(claims.get('sub')))).scalar()
+            guardar_versao(claims.get('sub'), versao_token)
+        if not versao_confere(claims, versao_token):
+            return resposta_json({'msg': 'Token has been revoked'}, 401)
+        if not eh_admin(claims):
+            return resposta_json({'error': 'usuario não possui permissão de administrador'}, 403)
+        return await fn(request)
+    return wrapper
+
+
+def idempotente_async(fn):
+    """O decorator idempotente do idempotencia.py (mesmo cache, chaves e respostas) para rotas do Starlette."""
+    @wraps(fn)
+    async def wrapper(request):
+        valor = request.headers.get(idempotencia.CABECALHO)
+        if valor is None:
+            return await fn(request)
+        chave = idempotencia.chave_da_requisicao(request.url.path, valor)
+        if chave is None:
+            return resposta_json({'erro': idempotencia.ERRO_CHAVE_INVALIDA}, 400)
+        # o corpo fica guardado no request, então a rota ainda consegue lê-lo
+        impressao = idempotencia.impressao_requisicao(request.method, request.url.path, request.scope['query_string'],
+                                                      await request.body())
+        respostas = idempotencia.respostas
+        try:
+            limite = time.monotonic() + idempotencia.ESPERA_MAXIMA
+            while True:
+                guardada, evento = respostas.tentar(chave, impressao)
+                if evento is None:
+                    break
+                # o Event é do threading (compartilhado com o Flask): a espera vai para uma thread
+                if not await asyncio.to_thread(evento.wait, max(limite - time.monotonic(), 0)):
+                    raise respostas.esgotou_espera()
+            if guardada is None and idempotencia.USAR_BANCO:
+                try:
+                    async with SessaoLeitura() as sessao:
+                        linha = (await sessao.execute(idempotencia.sql_buscar(chave))).first()
+                except Exception:
+                    respostas.abandonar(chave)
+                    raise
+                if linha is not None:
+                    guardada = respostas.repetir_do_banco(chave, impressao, idempotencia.RespostaGuardada(*linha))
+        except idempotencia.ChaveEmUso as e:
+            return resposta_json({'erro': str(e)}, 422)
+        except idempotencia.AindaEmAndamento as e:
+            return resposta_json({'erro': str(e)}, 409, {'Retry-After': '1'})
+        if guardada is not None:
+            return Response(guardada.corpo, guardada.status, {'Idempotent-Replayed': 'true'},
+                            media_type=guardada.tipo)
+
+        try:
+            resposta = await fn(request)
+        except BaseException:
+            respostas.abandonar(chave)
+            raise
+        if not idempotencia.guardar_status(resposta.status_code) or isinstance(resposta, StreamingResponse):
+            respostas.abandonar(chave)
+            return resposta
+        guardada = idempotencia.nova_resposta(impressao, resposta.status_code, resposta.body,
+                                              resposta.headers.get('content-type'))
+        if idempotencia.USAR_BANCO:
+            try:
+                async with Sessao() as sessao:
+                    for comando in idempotencia.sqls_guardar(chave, guardada):
+                        await sessao.execute(comando)
+                    await sessao.commit()
+            except Exception:
+                idempotencia.logger.exception('não foi possível guardar a resposta idempotente no banco')
+        respostas.concluir(chave, guardada)
+        return resposta
+    return wrapper
+
+
+def resposta_stream(sql, chave, serializar=None):
+    """Igual ao resposta_stream do app.py: um pedaço de JSON por partição do cursor."""
+    async def gerar():
+        yield '{"%s": [' % chave
+        separador = ''
+        async with SessaoLeitura() as sessao:
+            resultado = await sessao.stream(sql.execution_options(yield_per=500))
+            linhas = resultado.mappings() if serializar is None else resultado.scalars()
+            async for particao in linhas.partitions():
+                pedaco = ','.join(app_flask.json.dumps(dict(r) if serializar is None else serializar(r))
+                                  for r in particao)
+                yield separador + pedaco
+                separador = ','
+        yield ']}'
+
+    return StreamingResponse(gerar(), media_type='application/json')
+
+
+async def listar_paginado(request, sql, coluna_id, chave, serializar=None):
+    args = argumentos(request)
+    sql, limite = pagina_keyset(sql, coluna_id, args)
+
+    if quer_stream(args):
+        if 'limit' in args:
+            sql = sql.limit(limite)
+        return resposta_stream(sql, chave, serializar)
+
+    async with SessaoLeitura() as sessao:
+        registros = list(linhas_listagem(await sessao.execute(sql.limit(limite + 1)), serializar))
+    registros, proximo = fatiar_pagina(registros, limite, coluna_id.key)
+    return resposta_json({chave: registros, 'proximo': proximo})
+
+
+# ---------------------------------------------------------------------------
+# rotas
+
+async def index(request):
+    return RedirectResponse('/consultar_livros', status_code=302)
+
+
+async def exportar_metricas(request):
+    return Response(metricas.texto_prometheus(), media_type='text/plain; version=0.0.4')
+
+
+async def estatisticas_cache(request):
+    return resposta_json(cache.estatisticas())
+
+
+async def cadastrar_user(request):
+    # corpo ausente, malformado ou que não é um objeto: o mesmo 400 de campo faltando
+    dados = await corpo_json(request)
+    dados = dados if isinstance(dados, dict) else {}
+    nome = dados.get('nome')
+    email = dados.get('email')
+    papel = dados.get('papel', 'usuario')
+    senha = dados.get('senha')
+
+    if not nome or not email or not senha:
+        return resposta_json({"msg": "Nome de usuário e senha são obrigatórios"}, 400)
+    try:
+        async with Sessao() as sessao:
+            if (await sessao.execute(select(User.id).where(User.email == email))).scalar():
+                return resposta_json({"mensagem": "Usuário já existe!!!"}, 400)
+
+            novo_usuario = User(nome=nome, email=email, papel=papel, senha_hash=await gerar_hash_async(senha))
+            sessao.add(novo_usuario)
+            await sessao.commit()
+            return resposta_json({"sucesso": novo_usuario.id}, 201)
+    except FilaHashCheia:
+        return resposta_json(*RESPOSTA_OCUPADO)
+    except Exception as e:
+        return resposta_json({"error": str(e)}, 500)
+
+
+async def login(request):
+    dados = await corpo_json(request)
+    if not isinstance(dados, dict) or not dados.get('email') or not dados.get('senha'):
+        return resposta_json({'error': 'Email e senha são obrigatórios'}, 400)
+    email = dados['email']
+    senha = dados['senha']
+    try:
+        async with Sessao() as sessao:
+            user = (await sessao.execute(select(User).where(User.email == email))).scalar()
+            if user and await verificar_senha_async(user.senha_hash, senha):
+                if await precisa_rehash_async(user.senha_hash):
+                    user.senha_hash = await gerar_hash_async(senha)
+                    await sessao.commit()
+                    # o trigger de users mudou a versao_token no commit
+                    await sessao.refresh(user, ['versao_token'])
+                # mesmo token do app.py: mesma chave, mesmas claims
+                with app_flask.app_context():
+                    access_token = create_access_token(
+                        identity=email,
+                        additional_claims={'papel': user.papel, 'ver': user.versao_token}
+                    )
+                guardar_versao(email, user.versao_token)
+                return resposta_json({'access_token': access_token})
+            return resposta_json({'error': 'Senha incorreto'})
+    except FilaHashCheia:
+        return resposta_json(*RESPOSTA_OCUPADO)
+
+
+@cache_catalogo_async(Livro.__tablename__, Emprestimo.__tablename__)
+async def get_livros(request):
+    try:
+        colunas = colunas_projecao(CAMPOS_LIVRO, Livro.id_livro, argumentos(request))
+    except ValueError as e:
+        return resposta_json({'erro': str(e)}, 400)
+    try:
+        return await listar_paginado(request, select(*colunas), Livro.id_livro, 'livros')
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 500)
+
+
+@idempotente_async
+async def cadastrar_livro(request):
+    dados = await corpo_json(request)
+    try:
+        campos, erro = validar_livro(dados)
+        if not erro:
+            codigos, quantidade, erro = ler_exemplares(dados)
+        if erro:
+            return resposta_json({'erro': erro}, 400)
+
+        async with Sessao() as sessao:
+            novo_livro = Livro(**campos)
+            sessao.add(novo_livro)
+            await sessao.flush()
+            sessao.add_all(Exemplar(**linha) for linha in linhas_exemplares(novo_livro.id_livro, codigos, quantidade))
+            await sessao.commit()
+            # como o save() do app.py, a resposta sai com os valores gravados (ex.: ISBN inteiro)
+            await sessao.refresh(novo_livro)
+        incrementar_versao(Livro.__tablename__)
+        livro_response = novo_livro.serialize_livro()
+        livro_response["id_livro"] = novo_livro.id_livro
+        return resposta_json(livro_response, 201)
+    except SQLAlchemyError as e:
+        # 5xx: o idempotente_async não guarda, e a repetição executa de novo
+        return resposta_json({'erro': str(e)}, 500)
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 400)
+
+
+async def linhas_do_corpo(request):
+    """Linhas do corpo em UTF-8 conforme os pedaços chegam, sem ler o corpo inteiro antes."""
+    decodificador = codecs.getincrementaldecoder('utf-8')()
+    resto = ''
+    async for pedaco in request.stream():
+        resto += decodificador.decode(pedaco)
+        *linhas, resto = resto.split('\n')
+        for linha in linhas:
+            yield linha + '\n'
+    resto += decodificador.decode(b'', final=True)
+    if resto:
+        yield resto
+
+
+async def ler_linhas_importacao(request):
+    """Mesmos formatos do ler_linhas_importacao do app.py (NDJSON ou CSV com cabeçalho)."""
+    numero = 0
+    if request.headers.get('content-type', '').split(';')[0].strip() == 'text/csv':
+        cabecalho = None
+        registro = ''
+        async for linha in linhas_do_corpo(request):
+            numero += 1
+            registro += linha
+            # campo entre aspas pode ter quebra de linha: o registro só acaba com as aspas fechadas
+            if registro.count('"') % 2:
+                continue
+            valores = next(csv.reader([registro]), [])
+            registro = ''
+            if not valores:
+                continue
+            if cabecalho is None:
+                cabecalho = valores
+                continue
+            yield numero, dict(zip(cabecalho, valores))
+        return
+
+    async for linha in linhas_do_corpo(request):
+        numero += 1
+        if not linha.strip():
+            continue
+        try:
+            yield numero, json.loads(linha)
+        except ValueError:
+            yield numero, None
+
+
+async def inserir_lote_livros(lote, erros):
+    titulos = [campos['titulo'] for _, campos in lote]
+    async with Sessao() as sessao:
+        existentes = set((await sessao.execute(select(Livro.titulo).where(Livro.titulo.in_(titulos)))).scalars())
+
+        validos = []
+        for linha, campos in lote:
+            if campos['titulo'] in existentes:
+                erros.append({'linha': linha, 'erro': 'Título já cadastrado'})
+                continue
+            existentes.add(campos['titulo'])
+            validos.append((linha, campos))
+
+        if not validos:
+            return 0
+        try:
+            ids_livros = (await sessao.execute(
+                sqlite_insert(Livro.__table__).on_conflict_do_nothing(index_elements=['titulo']).returning(Livro.id_livro),
+                [campos for _, campos in validos]
+            )).scalars().all()
+            if ids_livros:
+                await sessao.execute(insert(Exemplar.__table__),
+                                     [linha for id_livro in ids_livros for linha in linhas_exemplares(id_livro, None, 1)])
+            await sessao.commit()
+            incrementar_versao(Livro.__tablename__)
+            return len(ids_livros)
+        except Exception as e:
+            await sessao.rollback()
+            erros.extend({'linha': linha, 'erro': str(e)} for linha, _ in validos)
+            return 0
+
+
+@admin_required_async
+async def importar_livros(request):
+    tamanho_lote = argumentos(request).get('lote', TAMANHO_LOTE_PADRAO, type=int)
+    tamanho_lote = max(1, min(tamanho_lote, TAMANHO_LOTE_MAXIMO))
+
+    linhas = 0
+    inseridos = 0
+    erros = []
+    lote = []
+    try:
+        async for linha, dados in ler_linhas_importacao(request):
+            linhas += 1
+            campos, erro = validar_livro(dados)
+            if erro:
+                erros.append({'linha': linha, 'erro': erro})
+                continue
+            lote.append((linha, campos))
+            if len(lote) >= tamanho_lote:
+                inseridos += await inserir_lote_livros(lote, erros)
+                lote = []
+        if lote:
+            inseridos += await inserir_lote_livros(lote, erros)
+    except Exception as e:
+        return resposta_json({'erro': str(e), 'linhas': linhas, 'inseridos': inseridos, 'erros': erros}, 400)
+
+    return resposta_json({'linhas': linhas, 'inseridos': inseridos, 'erros': erros})
+
+
+async def editar_livro(request):
+    dados = await corpo_json(request)
+    try:
+        async with Sessao() as sessao:
+            livro = (await sessao.execute(
+                select(Livro).where(Livro.id_livro == request.path_params['id']))).scalar()
+            if not livro:
+                return resposta_json({'erro': 'Livro não encontrado'}, 404)
+
+            updated = False
+            for campo, atributo in (('titulo', 'titulo'), ('autor', 'autor'), ('isbn', 'ISBN'), ('resumo', 'resumo')):
+                if campo in dados and dados[campo] is not None:
+                    setattr(livro, atributo, dados[campo])
+                    updated = True
+
+            if updated:
+                await sessao.commit()
+                await sessao.refresh(livro)
+                incrementar_versao(Livro.__tablename__)
+        livro_response = livro.serialize_livro()
+        livro_response["id_livro"] = livro.id_livro
+        return resposta_json(livro_response)
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 400)
+
+
+async def listar_exemplares(request):
+    try:
+        id_livro = request.path_params['id']
+        async with SessaoLeitura() as sessao:
+            livro = (await sessao.execute(
+                select(Livro.id_livro, Livro.exemplares_total, Livro.exemplares_disponiveis)
+                .where(Livro.id_livro == id_livro))).first()
+            if not livro:
+                return resposta_json({'erro': 'Livro não encontrado'}, 404)
+            linhas = (await sessao.execute(consulta_exemplares(id_livro))).all()
+        return resposta_json(montar_exemplares(livro, linhas))
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 500)
+
+
+@admin_required_async
+async def cadastrar_exemplares(request):
+    dados = await corpo_json(request)
+    try:
+        codigos, quantidade, erro = ler_exemplares(dados if isinstance(dados, dict) else {})
+        if erro:
+            return resposta_json({'erro': erro}, 400)
+        id_livro = request.path_params['id']
+        async with Sessao() as sessao:
+            livro = (await sessao.execute(select(Livro).where(Livro.id_livro == id_livro))).scalar()
+            if not livro:
+                return resposta_json({'erro': 'Livro não encontrado'}, 404)
+
+            primeiro = 1
+            if codigos is None:
+                primeiro = (await sessao.execute(consulta_proximo_numero_exemplar(id_livro))).scalar()
+            novos = [Exemplar(**linha) for linha in linhas_exemplares(id_livro, codigos, quantidade, primeiro)]
+            sessao.add_all(novos)
+            try:
+                await sessao.commit()
+            except IntegrityError:
+                await sessao.rollback()
+                return resposta_json({'erro': 'Código de barras já cadastrado'}, 409)
+        incrementar_versao(Livro.__tablename__)
+        return resposta_json({'exemplares': [exemplar.serialize_exemplar() for exemplar in novos]}, 201)
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 400)
+
+
+@cache_catalogo_async(Livro.__tablename__, Emprestimo.__tablename__)
+async def livro_status(request):
+    try:
+        sql, limite = consulta_livro_status(argumentos(request))
+        async with SessaoLeitura() as sessao:
+            linhas = (await sessao.execute(sql)).mappings().all()
+        return resposta_json(montar_livro_status(linhas, limite))
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 400)
+
+
+async def buscar_livros(request):
+    try:
+        args = argumentos(request)
+        if not args.get('q', '').strip():
+            return resposta_json({'erro': 'Parâmetro q é obrigatório'}, 400)
+        sql, parametros, limite, offset = consulta_busca_livros(args)
+        async with SessaoLeitura() as sessao:
+            livros = (await sessao.execute(sql, parametros)).mappings().all()
+        return resposta_json(montar_busca_livros(livros, limite, offset))
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 400)
+
+
+async def eventos_sse(request):
+    try:
+        depois_de, livros, erro = await asyncio.to_thread(
+            eventos.parametros_eventos, request.headers.get('last-event-id'), argumentos(request))
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 500)
+    if erro:
+        return resposta_json({'erro': erro}, 400)
+
+    async def transmitir(depois_de):
+        # como o eventos.transmitir, mas esperando com asyncio.sleep sobre o
+        # cursor em memória, sem prender uma thread por conexão
+        yield 'retry: %d\n\n' % eventos.RECONEXAO_MS
+        parado = 0
+        while True:
+            if eventos.feed.ultimo != depois_de:
+                texto, depois_de = await asyncio.to_thread(eventos.feed.proximos, depois_de, livros)
+                if texto:
+                    yield texto
+                    parado = 0
+                    continue
+            await asyncio.sleep(eventos.feed.intervalo)
+            parado += eventos.feed.intervalo
+            if parado >= eventos.MANTER_VIVO:
+                yield ': \n\n'
+                parado = 0
+
+    return StreamingResponse(transmitir(depois_de), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@cache_catalogo_async(Usuario.__tablename__)
+async def get_usuarios(request):
+    try:
+        colunas = colunas_projecao(CAMPOS_USUARIO, Usuario.id_usuario, argumentos(request))
+    except ValueError as e:
+        return resposta_json({'erro': str(e)}, 400)
+    try:
+        return await listar_paginado(request, select(*colunas), Usuario.id_usuario, 'usuarios')
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 500)
+
+
+@idempotente_async
+async def cadastrar_usuario(request):
+    try:
+        dados = await corpo_json(request)
+        if not isinstance(dados, dict) or not all([dados.get('nome'), dados.get('cpf'), dados.get('endereco')]):
+            return resposta_json({'status': False,
+                                  'erro': "Campos obrigatórios (nome, cpf, endereco) não podem ser vazios"}, 400)
+
+        async with Sessao() as sessao:
+            sessao.add(Usuario(nome=dados['nome'], CPF=dados['cpf'], endereco=dados['endereco']))
+            await sessao.commit()
+        incrementar_versao(Usuario.__tablename__)
+        return resposta_json({"status": True, "mensagem": "usuario cadastrado com sucesso!"}, 201)
+    except SQLAlchemyError as e:
+        return resposta_json({"status": False, "erro": str(e)}, 500)
+    except Exception as e:
+        return resposta_json({"status": False, "erro": str(e)}, 400)
+
+
+async def editar_usuario(request):
+    dados = await corpo_json(request)
+    try:
+        async with Sessao() as sessao:
+            usuario = (await sessao.execute(
+                select(Usuario).where(Usuario.id_usuario == request.path_params['id']))).scalar()
+            if not usuario:
+                return resposta_json({'erro': 'Usuário não encontrado'}, 404)
+
+            updated = False
+            for campo, atributo in (('nome', 'nome'), ('cpf', 'CPF'), ('endereco', 'endereco')):
+                if campo in dados and dados[campo] is not None:
+                    setattr(usuario, atributo, dados[campo])
+                    updated = True
+
+            if updated:
+                await sessao.commit()
+                await sessao.refresh(usuario)
+                incrementar_versao(Usuario.__tablename__)
+        usuario_response = usuario.serialize_usuario()
+        usuario_response["id_usuario"] = usuario.id_usuario
+        return resposta_json(usuario_response)
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 400)
+
+
+async def get_emprestimos(request):
+    try:
+        sql, serializar = consulta_emprestimos(argumentos(request))
+    except ValueError as e:
+        return resposta_json({'erro': str(e)}, 400)
+    try:
+        return await listar_paginado(request, sql.where(Emprestimo.returned_at.is_(None)),
+                                     Emprestimo.id_emprestimo, 'emprestimos', serializar)
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 500)
+
+
+async def emprestimos_atrasados(request):
+    try:
+        sql, limite, agrupado = consulta_atrasados(argumentos(request))
+        async with SessaoLeitura() as sessao:
+            resultado = await sessao.execute(sql)
+            linhas = resultado.all() if agrupado else resultado.scalars().all()
+        return resposta_json(montar_atrasados(linhas, limite, agrupado))
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 400)
+
+
+@idempotente_async
+async def cadastrar_emprestimo(request):
+    dados = await corpo_json(request)
+    try:
+        alvo = alvo_emprestimo(dados) if isinstance(dados, dict) else None
+        if not alvo or not dados.get('id_usuario'):
+            return resposta_json({'erro': "Campos obrigatórios (id_usuario e id_livro, id_exemplar ou codigo_barras) estão ausentes"}, 400)
+        condicao, existe, erro_nao_encontrado, erro_indisponivel = alvo
+
+        async with Sessao() as sessao:
+            usuario_existente = (await sessao.execute(
+                select(Usuario.id_usuario).where(Usuario.id_usuario == dados['id_usuario']))).scalar()
+            if not usuario_existente:
+                return resposta_json({'erro': 'Usuário não encontrado'}, 404)
+            if (await sessao.execute(existe)).first() is None:
+                return resposta_json({'erro': erro_nao_encontrado}, 404)
+
+            data_emprestimo, data_de_devolucao = datas_emprestimo()
+            criado = (await sessao.execute(
+                sql_novos_emprestimos(dados['id_usuario'], data_emprestimo, data_de_devolucao, condicao))).first()
+            if criado is None:
+                await sessao.rollback()
+                return resposta_json({'erro': erro_indisponivel}, 409)
+            await sessao.commit()
+        incrementar_versao(Emprestimo.__tablename__)
+        return resposta_json(emprestimo_para_dict(Emprestimo(
+            id_emprestimo=criado.id_emprestimo,
+            id_usuario=dados['id_usuario'],
+            id_livro=criado.id_livro,
+            id_exemplar=criado.id_exemplar,
+            data_emprestimo=data_emprestimo,
+            data_devolucao=data_de_devolucao,
+        )), 201)
+    except SQLAlchemyError as e:
+        return resposta_json({'erro': str(e)}, 500)
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 400)
+
+
+@idempotente_async
+async def devolver_livro(request):
+    try:
+        dados = await corpo_json(request)
+        filtro = filtro_devolucao(dados) if isinstance(dados, dict) else None
+        if filtro is None:
+            return resposta_json({'erro': "Campo obrigatório (id_livro, id_exemplar ou codigo_barras) está ausente"}, 400)
+        async with Sessao() as sessao:
+            emprestimos = (await sessao.execute(
+                select(Emprestimo).where(filtro, Emprestimo.returned_at.is_(None)).limit(2))).scalars().all()
+            if not emprestimos:
+                return resposta_json({'error': 'emprestimo nao encontrado'}, 404)
+            if len(emprestimos) > 1:
+                return resposta_json({'erro': VARIOS_EXEMPLARES_EMPRESTADOS}, 409)
+            emprestimos[0].returned_at = datetime.now()
+            await sessao.commit()
+        incrementar_versao(Emprestimo.__tablename__)
+        return resposta_json({'id_emprestimo': 'livro devolvido com sucesso'}, 200)
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 500)
+
+
+async def cadastrar_emprestimos_lote(request):
+    dados = await corpo_json(request)
+    async with Sessao() as sessao:
+        try:
+            ids_livros = ids_do_lote(dados, 'livros')
+            if not isinstance(dados, dict) or not dados.get('id_usuario') or ids_livros is None:
+                return resposta_json({'erro': "Campos obrigatórios (id_usuario, livros) estão ausentes"}, 400)
+
+            usuario_existente = (await sessao.execute(
+                select(Usuario.id_usuario).where(Usuario.id_usuario == dados['id_usuario']))).scalar()
+            if not usuario_existente:
+                return resposta_json({'erro': 'Usuário não encontrado'}, 404)
+
+            livros_existentes = set((await sessao.execute(
+                select(Livro.id_livro).where(Livro.id_livro.in_(ids_livros)))).scalars())
+
+            data_emprestimo, data_de_devolucao = datas_emprestimo()
+            resultados = []
+            novos = []
+            vistos = set()
+            for id_livro in ids_livros:
+                if id_livro not in livros_existentes:
+                    resultados.append({'id_livro': id_livro, 'status': 404, 'erro': 'Livro não encontrado'})
+                elif id_livro in vistos:
+                    resultados.append({'id_livro': id_livro, 'status': 400, 'erro': 'Livro repetido no lote'})
+                else:
+                    vistos.add(id_livro)
+                    novos.append({
+                        'id_usuario': dados['id_usuario'],
+                        'id_livro': id_livro,
+                        'data_emprestimo': data_emprestimo,
+                        'data_devolucao': data_de_devolucao,
+                    })
+                    resultados.append({'id_livro': id_livro, 'status': 201})
+
+            if novos:
+                criados = {linha.id_livro: (linha.id_emprestimo, linha.id_exemplar) for linha in await sessao.execute(
+                    sql_novos_emprestimos(dados['id_usuario'], data_emprestimo, data_de_devolucao,
+                                          Exemplar.id_livro.in_([linha['id_livro'] for linha in novos])))}
+                await sessao.commit()
+                incrementar_versao(Emprestimo.__tablename__)
+                completar_lote_emprestimos(novos, resultados, criados)
+            return resposta_json({'resultados': resultados})
+        except Exception as e:
+            await sessao.rollback()
+            return resposta_json({'erro': str(e)}, 400)
+
+
+async def devolver_livros_lote(request):
+    dados = await corpo_json(request)
+    async with Sessao() as sessao:
+        try:
+            lote = lote_devolucao(dados)
+            if lote is None:
+                return resposta_json({'erro': "Campo obrigatório (livros ou exemplares) está ausente"}, 400)
+            coluna, ids = lote
+
+            emprestimos = (await sessao.execute(
+                select(Emprestimo).where(coluna.in_(ids), Emprestimo.returned_at.is_(None)))).scalars().all()
+            resultados = marcar_devolucoes(emprestimos, ids, coluna.key, datetime.now())
+
+            await sessao.commit()
+            incrementar_versao(Emprestimo.__tablename__)
+            return resposta_json({'resultados': resultados})
+        except Exception as e:
+            await sessao.rollback()
+            return resposta_json({'erro': str(e)}, 500)
+
+
+@cache_catalogo_async(Emprestimo.__tablename__, Livro.__tablename__, Usuario.__tablename__)
+async def historico_emprestimo(request):
+    args = argumentos(request)
+    try:
+        sql, serializar = consulta_emprestimos(args)
+    except ValueError as e:
+        return resposta_json({'erro': str(e)}, 400)
+    try:
+        return await listar_paginado(request, filtros_historico(sql, args),
+                                     Emprestimo.id_emprestimo, 'historico_de_emprestimo', serializar)
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 500)
+
+
+@cache_catalogo_async(Emprestimo.__tablename__, Livro.__tablename__, Usuario.__tablename__)
+async def relatorio_ranking(request):
+    tipo = request.path_params['tipo']
+    if tipo not in RANKINGS:
+        raise HTTPException(404)
+    try:
+        sql, limite = consulta_ranking(tipo, argumentos(request))
+    except ValueError as e:
+        return resposta_json({'erro': str(e)}, 400)
+    try:
+        async with SessaoLeitura() as sessao:
+            linhas = (await sessao.execute(sql)).mappings().all()
+        return resposta_json(montar_ranking(linhas, limite, tipo))
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 500)
+
+
+@cache_catalogo_async(Emprestimo.__tablename__)
+async def relatorio_meses(request):
+    try:
+        sql = consulta_meses(argumentos(request))
+    except ValueError as e:
+        return resposta_json({'erro': str(e)}, 400)
+    try:
+        async with SessaoLeitura() as sessao:
+            linhas = (await sessao.execute(sql)).mappings().all()
+        return resposta_json({'meses': [dict(linha) for linha in linhas]})
+    except Exception as e:
+        return resposta_json({'erro': str(e)}, 500)
+
+
+@admin_required_async
+async def exportacao_ultima(request):
+    dados = await asyncio.to_thread(exportacao.manifesto_com_urls)
+    if dados is None:
+        return resposta_json({'erro': 'Nenhuma exportação disponível'}, 404)
+    return resposta_json(dados, headers={'Cache-Control': 'no-cache'})
+
+
+@admin_required_async
+async def exportacao_arquivo(request):
+    nome, arquivo = request.path_params['nome'], request.path_params['arquivo']
+    diretorio = await asyncio.to_thread(exportacao.arquivo_do_snapshot, nome, arquivo)
+    if diretorio is None:
+        return resposta_json({'erro': 'Arquivo não encontrado'}, 404)
+    # o FileResponse também atende Range
+    return FileResponse(os.path.join(diretorio, arquivo),
+                        media_type='application/json' if arquivo == exportacao.ARQUIVO_MANIFESTO else 'application/gzip',
+                        headers={'Cache-Control': 'private, max-age=%d' % exportacao.MAX_AGE_ARQUIVOS})
+
+
+@asynccontextmanager
+async def ciclo_de_vida(app):
+    yield
+    # fecha as conexões do aiosqlite (cada uma tem uma thread própria)
+    await engine_async.dispose()
+    await engine_async_leitura.dispose()
+
+
+rotas = [
+    Route('/', index),
+    Route('/metrics', exportar_metricas, methods=['GET']),
+    Route('/cache/estatisticas', estatisticas_cache, methods=['GET']),
+    Route('/cadastrar_users', cadastrar_user, methods=['POST']),
+    Route('/login', login, methods=['POST']),
+    Route('/livros', get_livros, methods=['GET']),
+    Route('/novo_livro', cadastrar_livro, methods=['POST']),
+    Route('/livros/bulk', importar_livros, methods=['POST']),
+    Route('/editar_livro/{id:int}', editar_livro, methods=['PUT']),
+    Route('/livros/{id:int}/exemplares', listar_exemplares, methods=['GET']),
+    Route('/livros/{id:int}/exemplares', cadastrar_exemplares, methods=['POST']),
+    Route('/livro_status', livro_status, methods=['GET']),
+    Route('/buscar_livros', buscar_livros, methods=['GET']),
+    Route('/eventos', eventos_sse, methods=['GET']),
+    Route('/usuarios', get_usuarios, methods=['GET']),
+    Route('/novo_usuario', cadastrar_usuario, methods=['POST']),
+    Route('/editar_usuario/{id:int}', editar_usuario, methods=['PUT']),
+    Route('/emprestimos', get_emprestimos, methods=['GET']),
+    Route('/emprestimos/atrasados', emprestimos_atrasados, methods=['GET']),
+    Route('/realizar_emprestimo', cadastrar_emprestimo, methods=['POST']),
+    Route('/devolver_livro', devolver_livro, methods=['POST']),
+    Route('/realizar_emprestimo/lote', cadastrar_emprestimos_lote, methods=['POST']),
+    Route('/devolver_livro/lote', devolver_livros_lote, methods=['POST']),
+    Route('/consulta_historico_emprestimo', historico_emprestimo, methods=['GET']),
+    Route('/relatorios/meses', relatorio_meses, methods=['GET']),
+    Route('/relatorios/{tipo}', relatorio_ranking, methods=['GET']),
+    Route('/exportacoes/ultima', exportacao_ultima, methods=['GET']),
+    Route('/exportacoes/{nome}/{arquivo}', exportacao_arquivo, methods=['GET']),
+]
+
+app = metricas.instrumentar_asgi(compressao.comprimir_asgi(Starlette(routes=rotas, lifespan=ciclo_de_vida)))
@@ -0,0 +1,85 @@
+"""
+Revogação de tokens JWT.
+
+Cada usuário tem uma versão (users.versao_token). O token emitido no login
+leva a versão daquele momento na claim "ver"; quando papel, senha ou email
+mudam, um trigger do SQLite soma 1 à versão e os tokens antigos deixam de
+ser aceitos. Usuário removido (ou com outro email) também invalida o token.
+
+A versão fica no banco, então uma revogação vale em todos os workers e
+continua valendo depois de reiniciar o servidor. Cada processo guarda em
+memória a versão lida de cada usuário por até BIBLIOTECA_TOKEN_VERSAO_TTL
+segundos, e a requisição autenticada só é conferida contra essa cópia,
+sem ir ao banco. A cópia é relida quando vence, quando chega um token
+mais novo que ela (login em outro worker) e quando o próprio processo
+altera ou remove o User; uma revogação feita por outro worker leva no
+máximo o TTL para valer aqui.
+"""
+import os
+import time
+
+from sqlalchemy import event, inspect, select
+
+from models import User, db_session_leitura
+
+PAPEL_ADMIN = 'gerente'
+TTL_VERSAO = float(os.environ.get('BIBLIOTECA_TOKEN_VERSAO_TTL', 5))
+MAXIMO_VERSOES = 10000
+
+# email -> (versão, instante da leitura); versão None: o usuário não existe
+_versoes = {}
+FALTA_VERSAO = object()
+
+
+def sql_versao(email):
+    return select(User.versao_token).where(User.email == email)
+
+
+def versao_confere(claims, versao):
+    """Compara a claim "ver" com a versão do usuário (None: o usuário não existe mais)."""
+    return versao is not None and claims.get('ver', 0) == versao
+
+
+def versao_guardada(claims):
+    """Versão em memória do dono do token, ou FALTA_VERSAO quando precisa ser lida do banco."""
+    item = _versoes.get(claims.get('sub'))
+    if item is None:
+        return FALTA_VERSAO
+    versao, lido_em = item
+    if time.monotonic() - lido_em > TTL_VERSAO:
+        return FALTA_VERSAO
+    # token mais novo que a cópia: houve login depois da leitura
+    if versao is not None and claims.get('ver', 0) > versao:
+        return FALTA_VERSAO
+    return versao
+
+
+def guardar_versao(email, versao):
+    if len(_versoes) >= MAXIMO_VERSOES:
+        _versoes.clear()
+    _versoes[email] = (versao, time.monotonic())
+
+
+def esquecer_usuario(email):
+    _versoes.pop(email, None)
+
+
+def token_valido(claims):
+    versao = versao_guardada(claims)
+    if versao is FALTA_VERSAO:
+        versao = db_session_leitura.execute(sql_versao(claims.get('sub'))).scalar()
+        guardar_versao(claims.get('sub'), versao)
+    return versao_confere(claims, versao)
+
+
+def eh_admin(claims):
+    return claims.get('papel') == PAPEL_ADMIN
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_alterado(mapper, connection, target):
+    # o trigger já mudou a versão no banco; a próxima conferência relê
+    esquecer_usuario(target.email)
+    for email in inspect(target).attrs.email.history.deleted:
+        esquecer_usuario(email)
@@ -0,0 +1,238 @@
+"""
+Benchmark WSGI x ASGI: app.py (Flask, uma thread por conexão) contra
+app_async.py (Starlette + AsyncEngine) com muitos terminais simultâneos.
+
+Cada servidor roda num processo próprio (um processo, sem workers extras)
+sobre o mesmo banco sintético do carga.py. Os terminais são clientes
+asyncio com conexão keep-alive que fazem uma requisição, esperam
+"--pausa-ms" (o operador no balcão) e repetem, numa mistura de leituras
+do catálogo e empréstimos/devoluções. Com "--trava-ms" uma conexão à
+parte segura o lock de escrita do SQLite de tempos em tempos, como um
+lote pesado rodando junto: as escritas ficam esperando o busy_timeout.
+
+Para cada modo são gravados p50/p95/p99, vazão, status, pico de threads e
+de RSS do processo do servidor e a vazão por segundo de CPU do servidor.
+
+Uso:
+    python benchmarks/asgi.py --banco /tmp/bench.sqlite3 --terminais 500 --duracao 30 \\
+        --pausa-ms 50 --trava-ms 50 --saida asgi.json
+
+Precisa de starlette, uvicorn, aiosqlite e httpx.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PALAVRAS = ('amor', 'guerra mar', 'sert', 'memórias vida', 'autor')
+
+
+# ---------------------------------------------------------------------------
+# servidor (roda no processo filho)
+
+def servir(modo, porta):
+    if modo == 'wsgi':
+        import logging
+        from werkzeug.serving import make_server
+        from app import app
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        make_server('127.0.0.1', porta, app, threaded=True).serve_forever()
+    else:
+        import uvicorn
+        from app_async import app
+        uvicorn.run(app, host='127.0.0.1', port=porta, log_level='warning', access_log=False)
+
+
+def porta_livre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def ler_proc(pid):
+    """(threads, rss em KiB, segundos de CPU) do processo."""
+    threads = rss = 0
+    with open('/proc/%d/status' % pid) as arquivo:
+        for linha in arquivo:
+            if linha.startswith('Threads:'):
+                threads = int(linha.split()[1])
+            elif linha.startswith('VmRSS:'):
+                rss = int(linha.split()[1])
+    with open('/proc/%d/stat' % pid) as arquivo:
+        campos = arquivo.read().rsplit(')', 1)[1].split()
+    cpu = (int(campos[11]) + int(campos[12])) / os.sysconf('SC_CLK_TCK')
+    return threads, rss, cpu
+
+
+# ---------------------------------------------------------------------------
+# clientes
+
+def pedido(rnd, livros, usuarios, escritas):
+    if rnd.random() < escritas:
+        if rnd.random() < 0.5:
+            return 'POST', '/realizar_emprestimo', {'id_usuario': rnd.randint(1, usuarios),
+                                                   'id_livro': rnd.randint(1, livros)}
+        return 'POST', '/devolver_livro', {'id_livro': rnd.randint(1, livros)}
+    return 'GET', rnd.choice((
+        '/livros?limit=50&after=%d' % rnd.randint(0, livros),
+        '/livro_status?limit=50&after=%d' % rnd.randint(0, livros),
+        '/buscar_livros?limit=20&q=%s' % urllib.parse.quote(rnd.choice(PALAVRAS)),
+        '/emprestimos/atrasados?limit=50',
+        '/consulta_historico_emprestimo?limit=50&id_usuario=%d' % rnd.randint(1, usuarios),
+    )), None
+
+
+async def terminal(cliente, numero, args, fim, latencias, status):
+    rnd = random.Random(args.semente * 100000 + numero)
+    while time.perf_counter() < fim:
+        metodo, caminho, corpo = pedido(rnd, args.livros, args.usuarios, args.escritas)
+        inicio = time.perf_counter()
+        try:
+            resposta = await cliente.request(metodo, caminho, json=corpo)
+            codigo = resposta.status_code
+        except Exception as erro:
+            codigo = type(erro).__name__
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        status.append(codigo)
+        await asyncio.sleep(args.pausa_ms / 1000)
+
+
+async def rodar_terminais(url_base, args):
+    import httpx
+    latencias, status = [], []
+    limites = httpx.Limits(max_connections=args.terminais, max_keepalive_connections=args.terminais)
+    async with httpx.AsyncClient(base_url=url_base, limits=limites, timeout=args.timeout) as cliente:
+        inicio = time.perf_counter()
+        fim = inicio + args.duracao
+        await asyncio.gather(*(terminal(cliente, i, args, fim, latencias, status)
+                               for i in range(args.terminais)))
+        return latencias, status, time.perf_counter() - inicio
+
+
+def segurar_lock(caminho, args, parar):
+    """Pega o lock de escrita por "trava_ms" a cada "intervalo_trava_ms"."""
+    conexao = sqlite3.connect(caminho, isolation_level=None, timeout=30)
+    while not parar.is_set():
+        conexao.execute('BEGIN IMMEDIATE')
+        time.sleep(args.trava_ms / 1000)
+        conexao.execute('COMMIT')
+        parar.wait(args.intervalo_trava_ms / 1000)
+    conexao.close()
+
+
+def medir_modo(modo, caminho, args):
+    from carga import resumo
+
+    porta = porta_livre()
+    ambiente = dict(os.environ, BIBLIOTECA_DB_URL='sqlite:///' + caminho)
+    processo = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--servir', modo,
+                                 '--porta', str(porta)], env=ambiente)
+    url_base = 'http://127.0.0.1:%d' % porta
+    try:
+        import httpx
+        for _ in range(300):
+            try:
+                if httpx.get(url_base + '/cache/estatisticas', timeout=1).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError('servidor %s não respondeu' % modo)
+
+        parar = threading.Event()
+        picos = {'threads': 0, 'rss_kb': 0}
+
+        def amostrar():
+            while not parar.wait(0.2):
+                threads, rss, _ = ler_proc(processo.pid)
+                picos['threads'] = max(picos['threads'], threads)
+                picos['rss_kb'] = max(picos['rss_kb'], rss)
+
+        auxiliares = [threading.Thread(target=amostrar, daemon=True)]
+        if args.trava_ms:
+            auxiliares.append(threading.Thread(target=segurar_lock, args=(caminho, args, parar), daemon=True))
+        for thread in auxiliares:
+            thread.start()
+
+        cpu_antes = ler_proc(processo.pid)[2]
+        latencias, status, duracao = asyncio.run(rodar_terminais(url_base, args))
+        cpu = ler_proc(processo.pid)[2] - cpu_antes
+        parar.set()
+        for thread in auxiliares:
+            thread.join()
+    finally:
+        processo.terminate()
+        processo.wait(timeout=30)
+
+    dados = resumo(latencias, duracao, status)
+    dados.update({
+        'pico_threads_servidor': picos['threads'],
+        'pico_rss_kb_servidor': picos['rss_kb'],
+        'cpu_s_servidor': round(cpu, 2),
+        'requisicoes_por_cpu_s': round(len(latencias) / cpu, 1) if cpu else None,
+    })
+    return dados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--livros', type=int, default=20000)
+    parser.add_argument('--usuarios', type=int, default=5000)
+    parser.add_argument('--emprestimos', type=int, default=100000)
+    parser.add_argument('--banco', help='arquivo SQLite (criado e populado se não existir)')
+    parser.add_argument('--modos', default='wsgi,asgi')
+    parser.add_argument('--terminais', type=int, default=200)
+    parser.add_argument('--duracao', type=float, default=20, help='segundos por modo')
+    parser.add_argument('--pausa-ms', type=float, default=50, help='espera de cada terminal entre requisições')
+    parser.add_argument('--escritas', type=float, default=0.2, help='fração de empréstimos/devoluções')
+    parser.add_argument('--trava-ms', type=float, default=0, help='tempo segurando o lock de escrita')
+    parser.add_argument('--intervalo-trava-ms', type=float, default=200)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--semente', type=int, default=1)
+    parser.add_argument('--saida', help='grava o resultado em JSON neste arquivo')
+    parser.add_argument('--servir', choices=('wsgi', 'asgi'), help=argparse.SUPPRESS)
+    parser.add_argument('--porta', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.servir:
+        servir(args.servir, args.porta)
+        return
+
+    import tempfile
+    caminho = os.path.abspath(args.banco or os.path.join(tempfile.mkdtemp(prefix='bench_asgi_'), 'bench.sqlite3'))
+    if not os.path.exists(caminho):
+        os.environ['BIBLIOTECA_DB_URL'] = 'sqlite:///' + caminho
+        from carga import popular_banco
+        print('populando %s ...' % caminho, file=sys.stderr)
+        popular_banco(caminho, args.livros, args.usuarios, args.emprestimos, args.semente)
+
+    resultado = {
+        'parametros': {k: v for k, v in vars(args).items() if k not in ('servir', 'porta', 'saida')},
+        'modos': {},
+    }
+    for modo in args.modos.split(','):
+        print('medindo %s com %d terminais ...' % (modo, args.terminais), file=sys.stderr)
+        dados = medir_modo(modo, caminho, args)
+        resultado['modos'][modo] = dados
+        print('%-5s %7.1f req/s  p50=%sms p95=%sms p99=%sms  threads=%d  rss=%dKiB  %s req/s de CPU  status=%s' % (
+            modo, dados['vazao_rps'], dados['p50_ms'], dados['p95_ms'], dados['p99_ms'],
+            dados['pico_threads_servidor'], dados['pico_rss_kb_servidor'], dados['requisicoes_por_cpu_s'],
+            dados['status']))
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump(resultado, arquivo, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,472 @@
+"""
+Benchmark de carga de todas as rotas do app.py.
+
+Cria um banco SQLite sintético no tamanho pedido, chama cada rota pelo
+cliente de teste do Flask (sequencial) e por um servidor WSGI de verdade
+com vários clientes concorrentes, e grava p50/p95/p99, vazão, comandos
+SQL por requisição e pico de RSS em JSON. Com --url (servidor externo,
+possivelmente com vários workers) o SQL por requisição não é medido no
+modo servidor.
+
+Toda rota do app.py precisa de um cenário em CENARIOS: se faltar algum, o
+benchmark sai com erro antes de rodar. /eventos (Server-Sent Events) não
+termina; ali a medida vai até o primeiro pedaço da resposta.
+
+Uso:
+    python benchmarks/carga.py --livros 1000000 --usuarios 200000 --emprestimos 5000000 \\
+        --banco /tmp/bench.sqlite3 --saida resultado.json
+
+    # compara com uma execução anterior; sai com código 1 se alguma rota piorou
+    python benchmarks/carga.py --banco /tmp/bench.sqlite3 --saida novo.json \\
+        --comparar resultado.json --tolerancia 0.2
+
+O banco informado em --banco só é populado se ainda não existir, então
+várias execuções podem usar a mesma base (as rotas de escrita alteram um
+pouco os dados a cada execução).
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+EMAIL_BENCH = 'bench@biblioteca'
+SENHA_BENCH = 'bench'
+# enviados em todas as requisições: o token do usuário do benchmark (gerente)
+# para as rotas com admin_required, como /livros/bulk
+CABECALHOS = {}
+TAMANHO_BLOCO = 50000
+
+
+def rss_pico_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentil(valores, p):
+    if not valores:
+        return None
+    valores = sorted(valores)
+    return round(valores[min(len(valores) - 1, int(len(valores) * p / 100))], 3)
+
+
+# ---------------------------------------------------------------------------
+# banco sintético
+
+def popular_banco(caminho, livros, usuarios, emprestimos, semente):
+    """Cria o schema pelo migracoes.migrar() e insere os dados em blocos com executemany."""
+    import cache
+    import estatisticas
+    import eventos
+    import migracoes
+    import models
+    from senhas import gerar_hash
+
+    migracoes.migrar()
+    rnd = random.Random(semente)
+    conexao = sqlite3.connect(caminho)
+    conexao.execute('PRAGMA synchronous=OFF')
+    # o índice de busca, as estatísticas e os contadores de exemplares são
+    # reconstruídos de uma vez no final, bem mais rápido que pelos triggers;
+    # a carga também não gera eventos para o /eventos nem atualiza
+    # MODIFICACOES a cada linha
+    for gatilho in ('LIVROS_FTS_ai', 'LIVROS_FTS_ad', 'LIVROS_FTS_au', *estatisticas.GATILHOS_ESTATISTICAS,
+                    *models.GATILHOS_EXEMPLARES, *eventos.GATILHOS_EVENTOS, *cache.GATILHOS_MODIFICACOES):
+        conexao.execute('DROP TRIGGER IF EXISTS "%s"' % gatilho)
+
+    palavras = ('amor', 'guerra', 'mar', 'sertão', 'cidade', 'noite', 'tempo', 'casa', 'rio', 'vida',
+                'memórias', 'história', 'viagem', 'sonho', 'fogo', 'terra', 'luz', 'sombra')
+    autores = ['Autor %d' % i for i in range(max(1, livros // 20))]
+
+    def inserir(sql, linhas):
+        bloco = []
+        for linha in linhas:
+            bloco.append(linha)
+            if len(bloco) >= TAMANHO_BLOCO:
+                conexao.executemany(sql, bloco)
+                conexao.commit()
+                bloco = []
+        if bloco:
+            conexao.executemany(sql, bloco)
+            conexao.commit()
+
+    inserir('INSERT INTO "LIVROS" (id_livro, titulo, autor, "ISBN", resumo) VALUES (?, ?, ?, ?, ?)', (
+        (i, '%s %s %d' % (rnd.choice(palavras), rnd.choice(palavras), i), rnd.choice(autores),
+         9780000000000 + i, ' '.join(rnd.choice(palavras) for _ in range(12)))
+        for i in range(1, livros + 1)))
+    # um exemplar por livro, com o mesmo id
+    inserir('INSERT INTO "EXEMPLARES" (id_exemplar, id_livro, codigo_barras) VALUES (?, ?, ?)', (
+        (i, i, models.FORMATO_CODIGO_BARRAS % (i, 1)) for i in range(1, livros + 1)))
+    inserir('INSERT INTO "USUARIOS" (id_usuario, nome, "CPF", endereco) VALUES (?, ?, ?, ?)', (
+        (i, 'Usuário %d' % i, '%011d' % i, 'Rua %d, %d' % (rnd.randint(1, 500), rnd.randint(1, 2000)))
+        for i in range(1, usuarios + 1)))
+
+    # ~4% dos empréstimos continuam em aberto, no máximo um por livro
+    em_aberto = set(rnd.sample(range(emprestimos), min(livros, emprestimos // 25))) if livros else set()
+    livros_em_aberto = iter(rnd.sample(range(1, livros + 1), len(em_aberto))) if livros else iter(())
+    hoje = date.today()
+
+    def gerar_emprestimos():
+        for i in range(emprestimos):
+            inicio = hoje - timedelta(days=rnd.randint(0, 730))
+            if i in em_aberto:
+                id_livro = next(livros_em_aberto)
+                devolvido = None
+            else:
+                id_livro = rnd.randint(1, livros)
+                devolvido = datetime.combine(inicio, datetime.min.time()) + timedelta(days=rnd.randint(1, 40))
+            yield (inicio.isoformat(), (inicio + timedelta(weeks=4)).isoformat(),
+                   devolvido.isoformat(' ') if devolvido else None, rnd.randint(1, usuarios), id_livro, id_livro)
+
+    inserir('INSERT INTO "EMPRÉSTIMOS" (data_emprestimo, data_devolucao, returned_at, id_usuario, id_livro, id_exemplar) '
+            'VALUES (?, ?, ?, ?, ?, ?)', gerar_emprestimos())
+
+    conexao.execute('INSERT INTO users (nome, email, senha_hash, papel) VALUES (?, ?, ?, ?)',
+                    ('bench', EMAIL_BENCH, gerar_hash(SENHA_BENCH), 'gerente'))
+    conexao.commit()
+    conexao.execute('ANALYZE')
+    conexao.close()
+    models.reconstruir_busca_livros()
+    models.reconstruir_contadores_exemplares()
+    eventos.criar_gatilhos_eventos()
+    with models.engine.begin() as conexao_engine:
+        cache.criar_gatilhos_modificacoes(conexao_engine)
+    estatisticas.reconstruir_estatisticas()
+
+
+# ---------------------------------------------------------------------------
+# cenários: um por rota do app.py, cada um devolve a requisição a ser feita
+
+class Estado:
+    def __init__(self, livros, usuarios, semente):
+        self.livros = max(livros, 1)
+        self.usuarios = max(usuarios, 1)
+        self.rnd = random.Random(semente)
+        self.sequencia = 0
+        self.lock = threading.Lock()
+        # urls dos arquivos do último snapshot de exportação (preenchidas no main)
+        self.arquivos_exportados = []
+
+    def proximo(self):
+        with self.lock:
+            self.sequencia += 1
+            return '%d-%d' % (os.getpid(), self.sequencia)
+
+    def livro(self):
+        return self.rnd.randint(1, self.livros)
+
+    def usuario(self):
+        return self.rnd.randint(1, self.usuarios)
+
+    def arquivo_exportado(self):
+        return self.rnd.choice(self.arquivos_exportados)
+
+
+def _ndjson(estado, quantidade):
+    return '\n'.join(json.dumps({'titulo': 'bulk %s' % estado.proximo(), 'autor': 'bench',
+                                 'isbn': '1', 'resumo': 'bench'}) for _ in range(quantidade))
+
+
+CENARIOS = {
+    'index': lambda e: ('GET', '/', None, None),
+    'exportar_metricas': lambda e: ('GET', '/metrics', None, None),
+    'estatisticas_cache': lambda e: ('GET', '/cache/estatisticas', None, None),
+    'cadastrar_user': lambda e: ('POST', '/cadastrar_users', {
+        'nome': 'bench', 'email': 'bench-%s@biblioteca' % e.proximo(), 'senha': 'bench'}, None),
+    'login': lambda e: ('POST', '/login', {'email': EMAIL_BENCH, 'senha': SENHA_BENCH}, None),
+    'get_livros': lambda e: ('GET', '/livros?limit=100&after=%d' % e.livro() + e.rnd.choice(('', '&fields=titulo,autor')),
+                             None, None),
+    'cadastrar_livro': lambda e: ('POST', '/novo_livro', {
+        'titulo': 'novo %s' % e.proximo(), 'autor': 'bench', 'isbn': '1', 'resumo': 'bench'}, None),
+    'importar_livros': lambda e: ('POST', '/livros/bulk', _ndjson(e, 50), 'application/x-ndjson'),
+    'editar_livro': lambda e: ('PUT', '/editar_livro/%d' % e.livro(), {'resumo': 'editado %s' % e.proximo()}, None),
+    'listar_exemplares': lambda e: ('GET', '/livros/%d/exemplares' % e.livro(), None, None),
+    'cadastrar_exemplares': lambda e: ('POST', '/livros/%d/exemplares' % e.livro(), {'exemplares': 1}, None),
+    'livro_status': lambda e: ('GET', '/livro_status?limit=100&after=%d' % e.livro(), None, None),
+    'buscar_livros': lambda e: ('GET', '/buscar_livros?q=%s&limit=20' % urllib.parse.quote(e.rnd.choice(
+        ('amor', 'guerra mar', 'sert', 'memórias vida', 'autor'))), None, None),
+    'eventos_sse': lambda e: ('GET', '/eventos' + e.rnd.choice(('', '?livros=%d' % e.livro())), None, None),
+    'get_usuarios': lambda e: ('GET', '/usuarios?limit=100&after=%d' % e.usuario(), None, None),
+    'cadastrar_usuario': lambda e: ('POST', '/novo_usuario', {
+        'nome': 'bench', 'cpf': e.proximo().replace('-', '')[-11:], 'endereco': 'bench'}, None),
+    'editar_usuario': lambda e: ('PUT', '/editar_usuario/%d' % e.usuario(), {'endereco': 'Rua %s' % e.proximo()}, None),
+    'get_emprestimos': lambda e: ('GET', '/emprestimos?limit=100' + e.rnd.choice(('', '&expand=livro,usuario')), None, None),
+    'emprestimos_atrasados': lambda e: ('GET', '/emprestimos/atrasados?limit=100' + e.rnd.choice(('', '&agrupar=usuario')), None, None),
+    'cadastrar_emprestimo': lambda e: ('POST', '/realizar_emprestimo', {'id_usuario': e.usuario(), 'id_livro': e.livro()}, None),
+    'devolver_livro': lambda e: ('POST', '/devolver_livro', {'id_livro': e.livro()}, None),
+    'cadastrar_emprestimos_lote': lambda e: ('POST', '/realizar_emprestimo/lote', {
+        'id_usuario': e.usuario(), 'livros': [e.livro() for _ in range(30)]}, None),
+    'devolver_livros_lote': lambda e: ('POST', '/devolver_livro/lote', {'livros': [e.livro() for _ in range(30)]}, None),
+    'historico_emprestimo': lambda e: ('GET', '/consulta_historico_emprestimo?limit=100&expand=livro&' + e.rnd.choice((
+        'id_usuario=%d' % e.usuario(), 'id_livro=%d' % e.livro(), 'after=%d' % e.livro())), None, None),
+    'relatorio_ranking': lambda e: ('GET', '/relatorios/%s?limit=100' % e.rnd.choice(('livros', 'usuarios', 'autores')),
+                                    None, None),
+    'relatorio_meses': lambda e: ('GET', '/relatorios/meses' + e.rnd.choice(('', '?de=%d-01' % (date.today().year - 1))),
+                                  None, None),
+    'exportacao_ultima': lambda e: ('GET', '/exportacoes/ultima', None, None),
+    'exportacao_arquivo': lambda e: ('GET', e.arquivo_exportado(), None, None),
+}
+
+
+def rotas_do_app(app):
+    """Endpoints definidos no app.py (ignora static e as rotas da documentação)."""
+    return sorted(nome for nome, fn in app.view_functions.items() if getattr(fn, '__module__', None) == 'app')
+
+
+def regra_da_rota(app, rota):
+    return next(regra.rule for regra in app.url_map.iter_rules() if regra.endpoint == rota)
+
+
+# ---------------------------------------------------------------------------
+# execução
+
+class ContadorSQL:
+    """Conta os comandos SQL executados pela thread atual."""
+
+    def __init__(self, engines):
+        self.local = threading.local()
+        from sqlalchemy import event
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._contar)
+
+    def _contar(self, *args):
+        self.local.total = getattr(self.local, 'total', 0) + 1
+
+    def atual(self):
+        return getattr(self.local, 'total', 0)
+
+
+def resumo(latencias, duracao, status, comandos=None):
+    dados = {
+        'requisicoes': len(latencias),
+        'p50_ms': percentil(latencias, 50),
+        'p95_ms': percentil(latencias, 95),
+        'p99_ms': percentil(latencias, 99),
+        'vazao_rps': round(len(latencias) / duracao, 1) if duracao else None,
+        'status': {str(k): status.count(k) for k in sorted(set(status))},
+    }
+    if comandos is not None:
+        dados['sql_por_requisicao'] = round(sum(comandos) / len(comandos), 2) if comandos else None
+    return dados
+
+
+def rodar_cliente(app, rotas, estado, requisicoes, contador):
+    cliente = app.test_client()
+    resultados = {}
+    for rota in rotas:
+        latencias, status, comandos = [], [], []
+        inicio_rota = time.perf_counter()
+        for _ in range(requisicoes):
+            metodo, caminho, corpo, tipo = CENARIOS[rota](estado)
+            antes = contador.atual()
+            inicio = time.perf_counter()
+            if tipo:
+                resposta = cliente.open(caminho, method=metodo, data=corpo, content_type=tipo, headers=CABECALHOS)
+            else:
+                resposta = cliente.open(caminho, method=metodo, json=corpo, headers=CABECALHOS)
+            if resposta.mimetype == 'text/event-stream':
+                # /eventos não termina: lê o primeiro pedaço (a linha "retry") e fecha
+                next(resposta.iter_encoded())
+                resposta.close()
+            else:
+                resposta.get_data()
+            latencias.append((time.perf_counter() - inicio) * 1000)
+            comandos.append(contador.atual() - antes)
+            status.append(resposta.status_code)
+        resultados[rota] = resumo(latencias, time.perf_counter() - inicio_rota, status, comandos)
+        print('  cliente  %-28s p95=%sms' % (rota, resultados[rota]['p95_ms']), file=sys.stderr)
+    return resultados
+
+
+def requisicao_http(url_base, metodo, caminho, corpo, tipo):
+    if corpo is not None and not tipo:
+        corpo, tipo = json.dumps(corpo), 'application/json'
+    cabecalhos = dict(CABECALHOS)
+    if tipo:
+        cabecalhos['Content-Type'] = tipo
+    pedido = urllib.request.Request(url_base + caminho, method=metodo,
+                                    data=corpo.encode('utf-8') if corpo is not None else None,
+                                    headers=cabecalhos)
+    try:
+        with urllib.request.urlopen(pedido, timeout=60) as resposta:
+            if resposta.headers.get_content_type() == 'text/event-stream':
+                resposta.readline()
+            else:
+                resposta.read()
+            return resposta.status
+    except urllib.error.HTTPError as erro:
+        return erro.code
+
+
+class SemRedirecionar(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def rodar_servidor(url_base, rotas, estado, requisicoes, concorrencia, app=None):
+    """
+    Com "app" (o servidor interno, neste processo) o SQL por requisição sai
+    do histograma das métricas; num servidor externo ele não é medido.
+    """
+    from metricas import metricas
+
+    urllib.request.install_opener(urllib.request.build_opener(SemRedirecionar))
+    resultados = {}
+    for rota in rotas:
+        pedidos = [CENARIOS[rota](estado) for _ in range(requisicoes)]
+        if app is not None:
+            chave = (regra_da_rota(app, rota), pedidos[0][0])
+            anterior = metricas.sql_por_requisicao.get(chave)
+            antes = (anterior.soma, anterior.total) if anterior else (0, 0)
+
+        def executar(pedido):
+            inicio = time.perf_counter()
+            codigo = requisicao_http(url_base, *pedido)
+            return (time.perf_counter() - inicio) * 1000, codigo
+
+        inicio_rota = time.perf_counter()
+        with ThreadPoolExecutor(concorrencia) as executor:
+            medidas = list(executor.map(executar, pedidos))
+        resultados[rota] = resumo([m[0] for m in medidas], time.perf_counter() - inicio_rota,
+                                  [m[1] for m in medidas])
+        if app is not None:
+            histograma = metricas.sql_por_requisicao.get(chave)
+            soma, total = (histograma.soma - antes[0], histograma.total - antes[1]) if histograma else (0, 0)
+            resultados[rota]['sql_por_requisicao'] = round(soma / total, 2) if total else None
+        print('  servidor %-28s p95=%sms' % (rota, resultados[rota]['p95_ms']), file=sys.stderr)
+    return resultados
+
+
+def iniciar_servidor(app):
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    servidor = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, 'http://127.0.0.1:%d' % servidor.server_port
+
+
+def comparar(atual, base, tolerancia):
+    """Lista as rotas cujo p95 subiu ou a vazão caiu mais que a tolerância."""
+    regressoes = []
+    for modo in ('cliente', 'servidor'):
+        for rota, dados in atual.get(modo, {}).items():
+            anterior = base.get(modo, {}).get(rota)
+            if not anterior:
+                continue
+            if anterior['p95_ms'] and dados['p95_ms'] > anterior['p95_ms'] * (1 + tolerancia):
+                regressoes.append('%s %s: p95 %.2fms -> %.2fms' % (modo, rota, anterior['p95_ms'], dados['p95_ms']))
+            if anterior['vazao_rps'] and dados['vazao_rps'] < anterior['vazao_rps'] * (1 - tolerancia):
+                regressoes.append('%s %s: vazão %.1f -> %.1f req/s' % (modo, rota, anterior['vazao_rps'], dados['vazao_rps']))
+            if (anterior.get('sql_por_requisicao') is not None and dados.get('sql_por_requisicao') is not None
+                    and dados['sql_por_requisicao'] > anterior['sql_por_requisicao']):
+                regressoes.append('%s %s: SQL/req %.2f -> %.2f' % (
+                    modo, rota, anterior['sql_por_requisicao'], dados['sql_por_requisicao']))
+    return regressoes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de carga das rotas do app.py')
+    parser.add_argument('--livros', type=int, default=10000)
+    parser.add_argument('--usuarios', type=int, default=2000)
+    parser.add_argument('--emprestimos', type=int, default=50000)
+    parser.add_argument('--banco', help='arquivo SQLite (criado e populado se não existir)')
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--requisicoes', type=int, default=200, help='requisições por rota em cada modo')
+    parser.add_argument('--concorrencia', type=int, default=16, help='clientes simultâneos no modo servidor')
+    parser.add_argument('--modo', choices=('cliente', 'servidor', 'ambos'), default='ambos')
+    parser.add_argument('--url', help='usa um servidor já rodando (ex.: gunicorn) em vez do servidor interno')
+    parser.add_argument('--rotas', help='lista de endpoints separados por vírgula (padrão: todos)')
+    parser.add_argument('--saida', help='arquivo JSON com os resultados')
+    parser.add_argument('--comparar', help='JSON de uma execução anterior')
+    parser.add_argument('--tolerancia', type=float, default=0.2)
+    args = parser.parse_args()
+
+    caminho = os.path.abspath(args.banco or os.path.join(tempfile.mkdtemp(prefix='bench_'), 'bench.sqlite3'))
+    os.environ['BIBLIOTECA_DB_URL'] = 'sqlite:///' + caminho
+    os.environ.setdefault('BIBLIOTECA_EXPORTACAO_DIR', caminho + '-exportacoes')
+
+    resultado = {
+        'meta': {
+            'data': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'livros': args.livros,
+            'usuarios': args.usuarios,
+            'emprestimos': args.emprestimos,
+            'requisicoes_por_rota': args.requisicoes,
+            'concorrencia': args.concorrencia,
+        },
+    }
+
+    if not os.path.exists(caminho):
+        print('populando %s ...' % caminho, file=sys.stderr)
+        inicio = time.perf_counter()
+        popular_banco(caminho, args.livros, args.usuarios, args.emprestimos, args.semente)
+        resultado['meta']['tempo_popular_s'] = round(time.perf_counter() - inicio, 1)
+
+    import exportacao
+    import models
+    from app import app
+
+    rotas = rotas_do_app(app)
+    sem_cenario = [rota for rota in rotas if rota not in CENARIOS]
+    if sem_cenario:
+        sys.exit('rotas sem cenário (adicione em CENARIOS): %s' % ', '.join(sem_cenario))
+    if args.rotas:
+        rotas = [rota for rota in rotas if rota in args.rotas.split(',')]
+
+    resposta = app.test_client().post('/login', json={'email': EMAIL_BENCH, 'senha': SENHA_BENCH})
+    CABECALHOS['Authorization'] = 'Bearer ' + resposta.get_json()['access_token']
+
+    estado = Estado(args.livros, args.usuarios, args.semente)
+    if exportacao.manifesto_com_urls() is None:
+        print('exportando um snapshot para as rotas /exportacoes ...', file=sys.stderr)
+        exportacao.exportar()
+    manifesto = exportacao.manifesto_com_urls()
+    estado.arquivos_exportados = [item['url'] for item in manifesto['arquivos']]
+    if args.modo in ('cliente', 'ambos'):
+        contador = ContadorSQL([models.engine, models.engine_leitura])
+        resultado['cliente'] = rodar_cliente(app, rotas, estado, args.requisicoes, contador)
+        resultado['rss_pico_kb_cliente'] = rss_pico_kb()
+    if args.modo in ('servidor', 'ambos'):
+        servidor = None
+        url_base = args.url
+        if not url_base:
+            servidor, url_base = iniciar_servidor(app)
+        resultado['servidor'] = rodar_servidor(url_base.rstrip('/'), rotas, estado, args.requisicoes,
+                                               args.concorrencia, app=None if args.url else app)
+        if servidor:
+            servidor.shutdown()
+    resultado['rss_pico_kb'] = rss_pico_kb()
+
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            arquivo.write(texto)
+    else:
+        print(texto)
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as arquivo:
+            regressoes = comparar(resultado, json.load(arquivo), args.tolerancia)
+        for regressao in regressoes:
+            print('REGRESSÃO: ' + regressao, file=sys.stderr)
+        if regressoes:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
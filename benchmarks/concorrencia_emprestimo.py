@@ -0,0 +1,185 @@
+"""
+Teste de concorrência dos empréstimos: muitos terminais disputando os
+mesmos livros.
+
+Sobe "--processos" servidores WSGI (app.py, um processo cada, todos no
+mesmo banco SQLite) e "--terminais" clientes que, durante "--duracao"
+segundos, tentam emprestar um dos "--quentes" livros mais procurados e,
+quando conseguem (201), devolvem em seguida. Cada livro tem
+"--exemplares" exemplares; cada disputa por um exemplar tem um vencedor e
+os outros recebem 409 na hora.
+
+No fim conta os exemplares com mais de um empréstimo em aberto e os
+livros cujo contador de disponíveis não confere com os empréstimos (os
+dois têm de ser zero) e grava vazão, p50/p95/p99 e status de empréstimos
+e devoluções. Não há mais a opção de rodar sem o índice único: o
+empréstimo é um INSERT ... ON CONFLICT sobre ele, que não funciona sem o
+índice.
+
+Uso:
+    python benchmarks/concorrencia_emprestimo.py --banco /tmp/bench.sqlite3 --processos 4 \\
+        --terminais 64 --quentes 5 --duracao 20 --saida concorrencia.json
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DUPLICADOS = '''
+    SELECT count(*) FROM (
+        SELECT id_exemplar FROM "EMPRÉSTIMOS" WHERE returned_at IS NULL AND id_livro IN (%s)
+        GROUP BY id_exemplar HAVING count(*) > 1
+    )'''
+CONTADORES_ERRADOS = '''
+    SELECT count(*) FROM "LIVROS" l WHERE id_livro IN (%s) AND exemplares_disponiveis <> (
+        SELECT count(*) FROM "EXEMPLARES" e WHERE e.id_livro = l.id_livro AND NOT EXISTS (
+            SELECT 1 FROM "EMPRÉSTIMOS" m WHERE m.id_exemplar = e.id_exemplar AND m.returned_at IS NULL))'''
+
+
+def subir_servidores(caminho, processos):
+    import httpx
+    from asgi import porta_livre
+
+    ambiente = dict(os.environ, BIBLIOTECA_DB_URL='sqlite:///' + caminho)
+    servidores = []
+    for _ in range(processos):
+        porta = porta_livre()
+        processo = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'asgi.py'),
+                                     '--servir', 'wsgi', '--porta', str(porta)], env=ambiente)
+        servidores.append((processo, 'http://127.0.0.1:%d' % porta))
+    for processo, url_base in servidores:
+        for _ in range(300):
+            try:
+                if httpx.get(url_base + '/cache/estatisticas', timeout=1).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError('servidor %s não respondeu' % url_base)
+    return servidores
+
+
+def emprestar(url_base, corpo):
+    """POST /realizar_emprestimo; devolve (status, exemplar emprestado ou None)."""
+    pedido = urllib.request.Request(url_base + '/realizar_emprestimo', method='POST',
+                                    data=json.dumps(corpo).encode('utf-8'),
+                                    headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(pedido, timeout=60) as resposta:
+            return resposta.status, json.loads(resposta.read())['exemplar']
+    except urllib.error.HTTPError as erro:
+        return erro.code, None
+
+
+def terminal(numero, urls, quentes, args, fim, medidas):
+    from carga import requisicao_http
+
+    rnd = random.Random(args.semente * 100000 + numero)
+    url_base = urls[numero % len(urls)]
+    while time.perf_counter() < fim:
+        id_livro = rnd.choice(quentes)
+        inicio = time.perf_counter()
+        codigo, id_exemplar = emprestar(url_base, {'id_usuario': rnd.randint(1, args.usuarios), 'id_livro': id_livro})
+        medidas['emprestimo'].append(((time.perf_counter() - inicio) * 1000, codigo))
+        if codigo == 201:
+            time.sleep(args.posse_ms / 1000)
+            inicio = time.perf_counter()
+            # devolve o exemplar que pegou: pelo livro seria ambíguo com outro exemplar emprestado
+            codigo = requisicao_http(url_base, 'POST', '/devolver_livro', {'id_exemplar': id_exemplar}, None)
+            medidas['devolucao'].append(((time.perf_counter() - inicio) * 1000, codigo))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--livros', type=int, default=20000)
+    parser.add_argument('--usuarios', type=int, default=5000)
+    parser.add_argument('--emprestimos', type=int, default=100000)
+    parser.add_argument('--banco', help='arquivo SQLite (criado e populado se não existir)')
+    parser.add_argument('--processos', type=int, default=4, help='servidores WSGI no mesmo banco')
+    parser.add_argument('--terminais', type=int, default=32)
+    parser.add_argument('--quentes', type=int, default=5, help='quantos livros os terminais disputam')
+    parser.add_argument('--exemplares', type=int, default=2, help='exemplares de cada livro disputado')
+    parser.add_argument('--duracao', type=float, default=15, help='segundos')
+    parser.add_argument('--posse-ms', type=float, default=0, help='espera entre emprestar e devolver')
+    parser.add_argument('--semente', type=int, default=1)
+    parser.add_argument('--saida', help='grava o resultado em JSON neste arquivo')
+    args = parser.parse_args()
+
+    import tempfile
+    caminho = os.path.abspath(args.banco or os.path.join(tempfile.mkdtemp(prefix='bench_conc_'), 'bench.sqlite3'))
+    os.environ['BIBLIOTECA_DB_URL'] = 'sqlite:///' + caminho
+    if not os.path.exists(caminho):
+        from carga import popular_banco
+        print('populando %s ...' % caminho, file=sys.stderr)
+        popular_banco(caminho, args.livros, args.usuarios, args.emprestimos, args.semente)
+    import migracoes
+    from carga import resumo
+    migracoes.migrar()
+
+    quentes = random.Random(args.semente).sample(range(1, args.livros + 1), args.quentes)
+    conexao = sqlite3.connect(caminho, isolation_level=None, timeout=30)
+    # começa com os livros disputados disponíveis
+    conexao.execute('UPDATE "EMPRÉSTIMOS" SET returned_at = ? WHERE returned_at IS NULL AND id_livro IN (%s)'
+                    % ','.join('?' * len(quentes)), [time.strftime('%Y-%m-%d %H:%M:%S.000000')] + quentes)
+    # completa os exemplares dos livros disputados (os triggers atualizam os contadores)
+    conexao.executemany(
+        'INSERT INTO "EXEMPLARES" (id_livro, codigo_barras) SELECT ?, ? '
+        'WHERE (SELECT count(*) FROM "EXEMPLARES" WHERE id_livro = ?) < ?',
+        [(id_livro, 'BENCH-%d-%d' % (id_livro, numero), id_livro, numero)
+         for id_livro in quentes for numero in range(1, args.exemplares + 1)])
+
+    servidores = subir_servidores(caminho, args.processos)
+    medidas = {'emprestimo': [], 'devolucao': []}
+    try:
+        print('%d terminais em %d processos disputando %d livros por %ss ...' % (
+            args.terminais, args.processos, args.quentes, args.duracao), file=sys.stderr)
+        inicio = time.perf_counter()
+        fim = inicio + args.duracao
+        terminais = [threading.Thread(target=terminal, args=(i, [u for _, u in servidores], quentes, args, fim, medidas))
+                     for i in range(args.terminais)]
+        for thread in terminais:
+            thread.start()
+        for thread in terminais:
+            thread.join()
+        duracao = time.perf_counter() - inicio
+    finally:
+        for processo, _ in servidores:
+            processo.terminate()
+            processo.wait(timeout=30)
+
+    marcadores = ','.join('?' * len(quentes))
+    duplicados = conexao.execute(DUPLICADOS % marcadores, quentes).fetchone()[0]
+    contadores_errados = conexao.execute(CONTADORES_ERRADOS % marcadores, quentes).fetchone()[0]
+    conexao.close()
+
+    resultado = {
+        'parametros': {k: v for k, v in vars(args).items() if k != 'saida'},
+        'exemplares_com_emprestimo_duplicado': duplicados,
+        'livros_com_contador_errado': contadores_errados,
+    }
+    for tipo, lista in medidas.items():
+        resultado[tipo] = resumo([m[0] for m in lista], duracao, [m[1] for m in lista])
+        dados = resultado[tipo]
+        print('%-10s %7.1f req/s  p50=%sms p95=%sms p99=%sms  status=%s' % (
+            tipo, dados['vazao_rps'], dados['p50_ms'], dados['p95_ms'], dados['p99_ms'], dados['status']))
+    print('exemplares com mais de um empréstimo em aberto: %d' % duplicados)
+    print('livros com contador de disponíveis errado: %d' % contadores_errados)
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump(resultado, arquivo, indent=2, ensure_ascii=False)
+    if duplicados or contadores_errados:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark de login: mede a vazão de /login e a latência de GET /livros
+durante uma rajada de logins.
+
+Roda num banco temporário, então não mexe no banco da aplicação.
+
+Uso:
+    python benchmarks/login.py --usuarios 50 --logins 400 --threads 16
+
+Compare BIBLIOTECA_HASH_WORKERS=0 (hash na thread da requisição) com o
+padrão (pool de processos) para ver o efeito na latência do catálogo.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentil(valores, p):
+    if not valores:
+        return None
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def medir_catalogo(app, parar, latencias):
+    cliente = app.test_client()
+    while not parar.is_set():
+        inicio = time.perf_counter()
+        cliente.get('/livros?limit=20')
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        time.sleep(0.005)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--usuarios', type=int, default=50)
+    parser.add_argument('--logins', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+
+    pasta = tempfile.mkdtemp(prefix='bench_login_')
+    os.environ.setdefault('BIBLIOTECA_DB_URL', 'sqlite:///' + os.path.join(pasta, 'bench.sqlite3'))
+
+    import migracoes
+    migracoes.migrar()
+    from app import app
+
+    cliente = app.test_client()
+    for i in range(args.usuarios):
+        cliente.post('/cadastrar_users', json={'nome': 'u%d' % i, 'email': 'u%d@bench' % i, 'senha': 'senha%d' % i})
+    cliente.post('/novo_livro', json={'titulo': 'bench', 'autor': 'bench', 'isbn': '1', 'resumo': 'bench'})
+
+    # latência do catálogo sem carga
+    sozinho = []
+    parar = threading.Event()
+    medidor = threading.Thread(target=medir_catalogo, args=(app, parar, sozinho))
+    medidor.start()
+    time.sleep(1)
+    parar.set()
+    medidor.join()
+
+    def logar(i):
+        u = i % args.usuarios
+        resposta = app.test_client().post('/login', json={'email': 'u%d@bench' % u, 'senha': 'senha%d' % u})
+        return resposta.status_code
+
+    durante = []
+    parar = threading.Event()
+    medidor = threading.Thread(target=medir_catalogo, args=(app, parar, durante))
+    medidor.start()
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as executor:
+        status = list(executor.map(logar, range(args.logins)))
+    duracao = time.perf_counter() - inicio
+    parar.set()
+    medidor.join()
+
+    print(json.dumps({
+        'hash_workers': os.environ.get('BIBLIOTECA_HASH_WORKERS', 'padrão'),
+        'logins': args.logins,
+        'logins_ok': status.count(200),
+        'logins_503': status.count(503),
+        'logins_por_segundo': round(args.logins / duracao, 1),
+        'catalogo_sem_carga_ms': {'p50': percentil(sozinho, 50), 'p95': percentil(sozinho, 95)},
+        'catalogo_durante_logins_ms': {
+            'p50': percentil(durante, 50),
+            'p95': percentil(durante, 95),
+            'p99': percentil(durante, 99),
+            'media': statistics.mean(durante) if durante else None,
+        },
+    }, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark de serialização das listagens: CPU por linha e memória por página.
+
+Compara, para uma página de livros e outra de empréstimos:
+
+- orm: objetos do ORM + serialize_* + provedor JSON padrão (caminho antigo);
+- core: colunas rotuladas (linhas Core) + provedor JSON padrão;
+- core+orjson: colunas rotuladas + orjson (se estiver instalado);
+- fields: só dois campos (?fields=), com o melhor provedor disponível.
+
+Cada cenário monta o corpo JSON da página completo, numa sessão nova a cada
+repetição (o mapa de identidade do ORM não é reaproveitado). A CPU vem do
+time.process_time e o pico de memória do tracemalloc.
+
+Uso:
+    python benchmarks/serializacao.py --livros 20000 --pagina 1000 --repeticoes 30
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def medir(montar, linhas, repeticoes, limpar):
+    montar()
+    limpar()
+    inicio = time.process_time()
+    for _ in range(repeticoes):
+        montar()
+        limpar()
+    cpu = time.process_time() - inicio
+
+    tracemalloc.start()
+    montar()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    limpar()
+    return {
+        'us_cpu_por_linha': round(cpu / (repeticoes * linhas) * 1e6, 3),
+        'pico_kib_por_pagina': round(pico / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--livros', type=int, default=20000)
+    parser.add_argument('--pagina', type=int, default=1000)
+    parser.add_argument('--repeticoes', type=int, default=30)
+    parser.add_argument('--saida', help='grava o resultado em JSON neste arquivo')
+    args = parser.parse_args()
+
+    pasta = tempfile.mkdtemp(prefix='bench_serializacao_')
+    caminho = os.path.join(pasta, 'bench.sqlite3')
+    os.environ.setdefault('BIBLIOTECA_DB_URL', 'sqlite:///' + caminho)
+    os.environ.setdefault('BIBLIOTECA_HASH_WORKERS', '0')
+
+    from carga import popular_banco
+    popular_banco(caminho, args.livros, max(1, args.livros // 5), args.livros, semente=1)
+
+    from sqlalchemy import select
+    from app import (app, CAMPOS_LIVRO, CAMPOS_EMPRESTIMO, livro_para_dict, emprestimo_para_dict,
+                     linhas_listagem)
+    from models import Livro, Emprestimo, db_session_leitura
+    from provedor_json import ProvedorJSON, ProvedorOrjson, orjson
+
+    provedores = {'padrao': ProvedorJSON(app)}
+    if orjson is not None:
+        provedores['orjson'] = ProvedorOrjson(app)
+    melhor = provedores.get('orjson', provedores['padrao'])
+
+    def pagina(sql, chave, provedor, serializar=None):
+        def montar():
+            resultado = db_session_leitura.execute(sql.limit(args.pagina))
+            return provedor.dumps({chave: list(linhas_listagem(resultado, serializar)), 'proximo': None})
+        return montar
+
+    def colunas(campos, nomes=None):
+        return [campos[nome].label(nome) for nome in (nomes or campos)]
+
+    cenarios = {
+        'livros': {
+            'orm': pagina(select(Livro), 'livros', provedores['padrao'], livro_para_dict),
+            'core': pagina(select(*colunas(CAMPOS_LIVRO)), 'livros', provedores['padrao']),
+            'fields': pagina(select(*colunas(CAMPOS_LIVRO, ['id_livro', 'titulo', 'autor'])), 'livros', melhor),
+        },
+        'emprestimos': {
+            'orm': pagina(select(Emprestimo), 'historico_de_emprestimo', provedores['padrao'],
+                          emprestimo_para_dict),
+            'core': pagina(select(*colunas(CAMPOS_EMPRESTIMO)), 'historico_de_emprestimo', provedores['padrao']),
+            'fields': pagina(select(*colunas(CAMPOS_EMPRESTIMO, ['id_emprestimo', 'livro', 'data de devolucao'])),
+                             'historico_de_emprestimo', melhor),
+        },
+    }
+    if 'orjson' in provedores:
+        cenarios['livros']['core+orjson'] = pagina(select(*colunas(CAMPOS_LIVRO)), 'livros', provedores['orjson'])
+        cenarios['emprestimos']['core+orjson'] = pagina(
+            select(*colunas(CAMPOS_EMPRESTIMO)), 'historico_de_emprestimo', provedores['orjson'])
+
+    resultado = {'pagina': args.pagina, 'repeticoes': args.repeticoes, 'cenarios': {}}
+    with app.app_context():
+        for listagem, variantes in cenarios.items():
+            for nome, montar in variantes.items():
+                medida = medir(montar, args.pagina, args.repeticoes, db_session_leitura.remove)
+                resultado['cenarios']['%s/%s' % (listagem, nome)] = medida
+                print('%-26s %8.3f us/linha  %8.1f KiB/página' % (
+                    '%s/%s' % (listagem, nome), medida['us_cpu_por_linha'], medida['pico_kib_por_pagina']))
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump(resultado, arquivo, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
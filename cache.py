@@ -0,0 +1,201 @@
+"""
+Cache em memória das respostas de listagem do catálogo.
+
+Cada tabela tem um contador de versão que é incrementado pelos métodos
+save/update/delete dos modelos. A chave do cache inclui as versões das
+tabelas usadas pela rota, então qualquer escrita invalida as respostas
+antigas sem precisar varrer o cache.
+
+O instante da última escrita em cada tabela fica no banco, na tabela
+MODIFICACOES, atualizado por triggers do SQLite na mesma transação de
+qualquer escrita (de qualquer worker, do app_async ou direto no banco).
+Cada processo guarda em memória o último instante que conhece por tabela:
+o das próprias escritas (incrementar_versao) e o lido de MODIFICACOES, que
+só é consultada quando a resposta não está no cache e a rota vai ao banco
+de qualquer jeito. A resposta guardada leva esse instante como
+Last-Modified, então um acerto no cache, inclusive o 304, não toca no
+SQLite. A escrita de outro worker aparece aqui quando a entrada vence
+(BIBLIOTECA_CACHE_TTL).
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import Response, make_response, request
+from sqlalchemy import column, select, table
+
+_versoes = {}
+_lock_versoes = threading.Lock()
+# tabela -> instante (time.time()) da última escrita conhecida pelo processo
+_modificacoes_conhecidas = {}
+
+TABELA_MODIFICACOES = 'MODIFICACOES'
+_modificacoes = table(TABELA_MODIFICACOES, column('tabela'), column('modificado_em'))
+# segundos desde 1970, com fração, pelo relógio do próprio SQLite
+_AGORA = "(julianday('now') - 2440587.5) * 86400.0"
+TABELAS_MODIFICACOES = {'LIVROS': 'livros', 'USUARIOS': 'usuarios', 'EMPRÉSTIMOS': 'emprestimos'}
+
+GATILHOS_MODIFICACOES = {
+    'MODIFICACOES_%s_%s' % (apelido, sufixo): 'AFTER %s ON "%s" BEGIN\n'
+    '    UPDATE "%s" SET modificado_em = %s WHERE tabela = \'%s\';\nEND' % (
+        operacao, tabela, TABELA_MODIFICACOES, _AGORA, tabela)
+    for tabela, apelido in TABELAS_MODIFICACOES.items()
+    for operacao, sufixo in (('INSERT', 'ai'), ('UPDATE', 'au'), ('DELETE', 'ad'))
+}
+
+
+def criar_gatilhos_modificacoes(conexao):
+    """
+    Cria os triggers que faltam e marca todas as tabelas como modificadas
+    agora (o que foi escrito sem os triggers também conta como mudança).
+    """
+    for nome, ddl in GATILHOS_MODIFICACOES.items():
+        conexao.exec_driver_sql('CREATE TRIGGER IF NOT EXISTS "%s" %s' % (nome, ddl))
+    for tabela in TABELAS_MODIFICACOES:
+        conexao.exec_driver_sql(
+            'INSERT INTO "%s" (tabela, modificado_em) VALUES (?, %s) '
+            'ON CONFLICT (tabela) DO UPDATE SET modificado_em = excluded.modificado_em' % (TABELA_MODIFICACOES, _AGORA),
+            (tabela,))
+
+
+def incrementar_versao(tabela):
+    with _lock_versoes:
+        _versoes[tabela] = _versoes.get(tabela, 0) + 1
+        _modificacoes_conhecidas[tabela] = time.time()
+
+
+def versao(tabela):
+    return _versoes.get(tabela, 0)
+
+
+def sql_modificacoes(tabelas):
+    return select(_modificacoes.c.tabela, _modificacoes.c.modificado_em).where(_modificacoes.c.tabela.in_(tabelas))
+
+
+def registrar_modificacoes(linhas):
+    """Junta as linhas (tabela, modificado_em) lidas de MODIFICACOES ao que o processo já conhece."""
+    with _lock_versoes:
+        for tabela, instante in linhas:
+            if instante > _modificacoes_conhecidas.get(tabela, 0):
+                _modificacoes_conhecidas[tabela] = instante
+
+
+def modificacao_conhecida(tabelas):
+    """Instante da escrita mais recente nas tabelas que o processo conhece (None: nenhuma)."""
+    return max((_modificacoes_conhecidas[t] for t in tabelas if t in _modificacoes_conhecidas), default=None)
+
+
+def quer_stream(args):
+    """?stream=1 (ou true, sim): as rotas respondem em streaming e o cache fica de fora."""
+    return args.get('stream', '').lower() in ('1', 'true', 'sim')
+
+
+def ultima_modificacao(instante):
+    """
+    Last-Modified (UTC, em segundos inteiros, como no HTTP) da escrita feita
+    em "instante" (de modificacao_conhecida), ou None enquanto aquele segundo
+    não terminou: outra escrita no mesmo segundo teria o mesmo
+    Last-Modified, e o If-Modified-Since daria 304 com os dados velhos.
+    """
+    if instante is None or int(instante) >= int(time.time()):
+        return None
+    return datetime.fromtimestamp(int(instante), timezone.utc)
+
+
+class CacheCatalogo:
+    """Cache LRU com TTL e contadores de acerto/erro/remoção."""
+
+    def __init__(self, max_itens=256, ttl=30):
+        self.max_itens = max_itens
+        self.ttl = ttl
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+        self.acertos = 0
+        self.erros = 0
+        self.remocoes = 0
+
+    def buscar(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None or item[2] < time.monotonic():
+                if item is not None:
+                    del self._itens[chave]
+                    self.remocoes += 1
+                self.erros += 1
+                return None
+            self._itens.move_to_end(chave)
+            self.acertos += 1
+            return item
+
+    def guardar(self, chave, corpo, instante=None):
+        etag = hashlib.sha1(corpo).hexdigest()
+        item = (corpo, etag, time.monotonic() + self.ttl, instante)
+        with self._lock:
+            self._itens[chave] = item
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+                self.remocoes += 1
+        return item
+
+    def limpar(self):
+        with self._lock:
+            self._itens.clear()
+
+    def estatisticas(self):
+        return {
+            'itens': len(self._itens),
+            'max_itens': self.max_itens,
+            'ttl': self.ttl,
+            'acertos': self.acertos,
+            'erros': self.erros,
+            'remocoes': self.remocoes,
+        }
+
+
+cache = CacheCatalogo(
+    max_itens=int(os.environ.get('BIBLIOTECA_CACHE_ITENS', 256)),
+    ttl=float(os.environ.get('BIBLIOTECA_CACHE_TTL', 30)),
+)
+
+
+def cache_catalogo(*tabelas):
+    """
+    Guarda a resposta JSON da rota enquanto as tabelas informadas não mudarem.
+
+    As respostas saem com ETag forte e Last-Modified; um If-None-Match igual
+    (ou, sem ele, um If-Modified-Since não anterior à última escrita) recebe
+    304 sem consultar o banco. Respostas em streaming e com erro não são
+    guardadas.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if quer_stream(request.args):
+                return fn(*args, **kwargs)
+
+            chave = (request.path, request.query_string, tuple(versao(t) for t in tabelas))
+            item = cache.buscar(chave)
+            if item is None:
+                # importado aqui porque o models importa este módulo
+                from models import db_session_leitura
+
+                # lido antes da rota: o corpo gerado depois é no mínimo desse instante
+                registrar_modificacoes(db_session_leitura.execute(sql_modificacoes(tabelas)))
+                instante = modificacao_conhecida(tabelas)
+                resposta = make_response(fn(*args, **kwargs))
+                if resposta.status_code != 200 or resposta.is_streamed:
+                    return resposta
+                item = cache.guardar(chave, resposta.get_data(), instante)
+
+            corpo, etag, _, instante = item
+            resposta = Response(corpo, mimetype='application/json')
+            resposta.set_etag(etag)
+            resposta.last_modified = ultima_modificacao(instante)
+            return resposta.make_conditional(request)
+        return wrapper
+    return decorator
@@ -0,0 +1,271 @@
+"""
+Compressão das respostas negociada pelo Accept-Encoding (zstd, br, gzip).
+
+As listagens são JSON grande e repetitivo (as mesmas chaves em todas as
+linhas), então comprimem muito bem; vale para as bibliotecas com link
+lento. Só são comprimidas respostas 200 de tipos de texto (JSON, NDJSON,
+CSV) a partir de BIBLIOTECA_COMPRESSAO_MINIMO bytes. text/event-stream,
+arquivos (send_file) e respostas que já têm Content-Encoding passam direto.
+
+Respostas em streaming são comprimidas conforme são geradas: a saída do
+compressor é descarregada a cada BIBLIOTECA_COMPRESSAO_BLOCO bytes de
+entrada, então o cliente continua recebendo a lista aos poucos.
+
+Configuração:
+- BIBLIOTECA_COMPRESSAO: codificações aceitas, em ordem de preferência
+  (padrão "zstd,br,gzip"; vazio desliga). br e zstd só entram se o
+  brotli/zstandard estiverem instalados;
+- BIBLIOTECA_COMPRESSAO_NIVEL_GZIP/_BR/_ZSTD: nível de cada uma.
+
+Um corpo comprimido muda a representação, então o ETag forte vira fraco
+(W/"...") e o If-None-Match continua dando 304. Os corpos comprimidos das
+respostas com ETag forte (as do cache do catálogo) ficam num LRU pequeno,
+para não comprimir de novo a mesma página a cada acerto do cache.
+"""
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depende do ambiente
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - depende do ambiente
+    zstandard = None
+
+MINIMO_COMPRESSAO = int(os.environ.get('BIBLIOTECA_COMPRESSAO_MINIMO', 1024))  # bytes
+BLOCO_STREAM = int(os.environ.get('BIBLIOTECA_COMPRESSAO_BLOCO', 16 * 1024))  # bytes
+NIVEIS = {
+    'gzip': int(os.environ.get('BIBLIOTECA_COMPRESSAO_NIVEL_GZIP', 6)),
+    'br': int(os.environ.get('BIBLIOTECA_COMPRESSAO_NIVEL_BR', 5)),
+    'zstd': int(os.environ.get('BIBLIOTECA_COMPRESSAO_NIVEL_ZSTD', 3)),
+}
+TIPOS_COMPRIMIVEIS = {'application/json', 'application/x-ndjson', 'text/csv', 'text/plain', 'text/html'}
+ITENS_CACHE_COMPRIMIDOS = int(os.environ.get('BIBLIOTECA_COMPRESSAO_CACHE', 64))
+
+
+class _Gzip:
+    def __init__(self, nivel):
+        self._c = zlib.compressobj(nivel, zlib.DEFLATED, 31)
+
+    def comprimir(self, dados):
+        return self._c.compress(dados)
+
+    def descarregar(self):
+        return self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def finalizar(self):
+        return self._c.flush()
+
+
+class _Brotli:
+    def __init__(self, nivel):
+        self._c = brotli.Compressor(quality=nivel)
+
+    def comprimir(self, dados):
+        return self._c.process(dados)
+
+    def descarregar(self):
+        return self._c.flush()
+
+    def finalizar(self):
+        return self._c.finish()
+
+
+class _Zstd:
+    def __init__(self, nivel):
+        self._c = zstandard.ZstdCompressor(level=nivel).compressobj()
+
+    def comprimir(self, dados):
+        return self._c.compress(dados)
+
+    def descarregar(self):
+        return self._c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finalizar(self):
+        return self._c.flush()
+
+
+COMPRESSORES = {'gzip': _Gzip}
+if brotli is not None:
+    COMPRESSORES['br'] = _Brotli
+if zstandard is not None:
+    COMPRESSORES['zstd'] = _Zstd
+
+CODIFICACOES = [c.strip() for c in os.environ.get('BIBLIOTECA_COMPRESSAO', 'zstd,br,gzip').split(',')
+                if c.strip() in COMPRESSORES]
+
+_comprimidos = OrderedDict()
+_lock_comprimidos = threading.Lock()
+
+
+def escolher_codificacao(accept_encoding):
+    """A codificação de maior q no Accept-Encoding; no empate vale a ordem de CODIFICACOES."""
+    if not CODIFICACOES or not accept_encoding:
+        return None
+    return parse_accept_header(accept_encoding).best_match(CODIFICACOES)
+
+
+def comprimivel(status, mimetype, content_encoding=None):
+    return status == 200 and not content_encoding and mimetype in TIPOS_COMPRIMIVEIS
+
+
+def comprimir(codificacao, dados, etag=None):
+    """Comprime o corpo inteiro; com "etag" (forte) o resultado fica no LRU."""
+    chave = (etag, codificacao)
+    if etag is not None:
+        with _lock_comprimidos:
+            corpo = _comprimidos.get(chave)
+            if corpo is not None:
+                _comprimidos.move_to_end(chave)
+                return corpo
+    compressor = COMPRESSORES[codificacao](NIVEIS[codificacao])
+    corpo = compressor.comprimir(dados) + compressor.finalizar()
+    if etag is not None:
+        with _lock_comprimidos:
+            _comprimidos[chave] = corpo
+            while len(_comprimidos) > ITENS_CACHE_COMPRIMIDOS:
+                _comprimidos.popitem(last=False)
+    return corpo
+
+
+def comprimir_pedacos(pedacos, codificacao):
+    """Comprime um iterável de str/bytes, descarregando a cada BLOCO_STREAM bytes de entrada."""
+    compressor = COMPRESSORES[codificacao](NIVEIS[codificacao])
+    pendente = 0
+    try:
+        for pedaco in pedacos:
+            if isinstance(pedaco, str):
+                pedaco = pedaco.encode('utf-8')
+            saida = compressor.comprimir(pedaco)
+            pendente += len(pedaco)
+            if pendente >= BLOCO_STREAM:
+                saida += compressor.descarregar()
+                pendente = 0
+            if saida:
+                yield saida
+        yield compressor.finalizar()
+    finally:
+        fechar = getattr(pedacos, 'close', None)
+        if fechar is not None:
+            fechar()
+
+
+def etag_fraco(etag):
+    if etag and not etag.startswith('W/'):
+        return 'W/' + etag
+    return etag
+
+
+# ---------------------------------------------------------------------------
+# Flask
+
+def comprimir_resposta(resposta):
+    from flask import request
+
+    if request.method == 'HEAD' or resposta.direct_passthrough or not comprimivel(
+            resposta.status_code, resposta.mimetype, resposta.headers.get('Content-Encoding')):
+        return resposta
+    if not resposta.is_streamed and len(resposta.get_data()) < MINIMO_COMPRESSAO:
+        return resposta
+    resposta.vary.add('Accept-Encoding')
+    codificacao = escolher_codificacao(request.headers.get('Accept-Encoding'))
+    if codificacao is None:
+        return resposta
+
+    etag, fraco = resposta.get_etag()
+    if resposta.is_streamed:
+        resposta.response = comprimir_pedacos(resposta.response, codificacao)
+        resposta.headers.pop('Content-Length', None)
+    else:
+        resposta.set_data(comprimir(codificacao, resposta.get_data(), etag if etag and not fraco else None))
+    resposta.headers['Content-Encoding'] = codificacao
+    if etag:
+        resposta.set_etag(etag, weak=True)
+    return resposta
+
+
+def instrumentar_app(app):
+    app.after_request(comprimir_resposta)
+
+
+# ---------------------------------------------------------------------------
+# ASGI
+
+def comprimir_asgi(app_asgi):
+    """Middleware ASGI com as mesmas regras de comprimir_resposta (usado pelo app_async)."""
+    async def middleware(scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] == 'HEAD' or not CODIFICACOES:
+            return await app_asgi(scope, receive, send)
+        aceitas = next((v.decode('latin-1') for k, v in scope['headers'] if k == b'accept-encoding'), None)
+        codificacao = escolher_codificacao(aceitas)
+        estado = {'inicio': None, 'compressor': None, 'pendente': 0}
+
+        async def enviar(mensagem):
+            if mensagem['type'] == 'http.response.start':
+                # só decide ao ver o primeiro pedaço do corpo (tamanho e se há mais)
+                estado['inicio'] = mensagem
+                return
+            if mensagem['type'] != 'http.response.body':
+                return await send(mensagem)
+
+            inicio, estado['inicio'] = estado['inicio'], None
+            if inicio is not None:
+                mensagem = await iniciar(inicio, mensagem)
+            elif estado['compressor'] is not None:
+                mensagem = continuar(mensagem)
+            await send(mensagem)
+
+        async def iniciar(inicio, mensagem):
+            cabecalhos = [(k, v) for k, v in inicio['headers']]
+            valores = {k.lower(): v.decode('latin-1') for k, v in cabecalhos}
+            mimetype = valores.get(b'content-type', '').split(';')[0].strip()
+            corpo = mensagem.get('body', b'')
+            mais = mensagem.get('more_body', False)
+            if not comprimivel(inicio['status'], mimetype, valores.get(b'content-encoding')) or (
+                    not mais and len(corpo) < MINIMO_COMPRESSAO):
+                await send(inicio)
+                return mensagem
+
+            vary = valores.get(b'vary')
+            cabecalhos = [(k, v) for k, v in cabecalhos if k.lower() != b'vary']
+            cabecalhos.append((b'vary', (vary + ', Accept-Encoding' if vary else 'Accept-Encoding').encode('latin-1')))
+            if codificacao is None:
+                await send(dict(inicio, headers=cabecalhos))
+                return mensagem
+
+            etag = valores.get(b'etag')
+            cabecalhos = [(k, v) for k, v in cabecalhos if k.lower() not in (b'content-length', b'etag')]
+            cabecalhos.append((b'content-encoding', codificacao.encode('latin-1')))
+            if etag:
+                cabecalhos.append((b'etag', etag_fraco(etag).encode('latin-1')))
+            if mais:
+                estado['compressor'] = COMPRESSORES[codificacao](NIVEIS[codificacao])
+                await send(dict(inicio, headers=cabecalhos))
+                return continuar(mensagem)
+            forte = etag.strip('"') if etag and not etag.startswith('W/') else None
+            corpo = comprimir(codificacao, corpo, forte)
+            cabecalhos.append((b'content-length', str(len(corpo)).encode('latin-1')))
+            await send(dict(inicio, headers=cabecalhos))
+            return {'type': 'http.response.body', 'body': corpo}
+
+        def continuar(mensagem):
+            compressor = estado['compressor']
+            pedaco = mensagem.get('body', b'')
+            saida = compressor.comprimir(pedaco)
+            estado['pendente'] += len(pedaco)
+            if not mensagem.get('more_body', False):
+                saida += compressor.finalizar()
+            elif estado['pendente'] >= BLOCO_STREAM:
+                saida += compressor.descarregar()
+                estado['pendente'] = 0
+            return dict(mensagem, body=saida)
+
+        await app_asgi(scope, receive, enviar)
+    return middleware
@@ -0,0 +1,180 @@
+"""
+Estatísticas de circulação mantidas junto com os empréstimos.
+
+Quatro tabelas de resumo guardam, por livro, por usuário, por autor e por
+mês, quantos empréstimos e devoluções houve. Elas são atualizadas por
+triggers do SQLite em EMPRÉSTIMOS, como o índice de busca: cada empréstimo
+(INSERT) e cada devolução (UPDATE de returned_at) soma nos resumos na mesma
+transação, seja pelo ORM, pelos lotes com Core, pelo app_async ou direto no
+banco. Assim os relatórios (/relatorios/...) leem só o resumo, em vez de
+agregar o histórico inteiro.
+
+O autor é o atual do livro: os triggers de LIVROS movem as contagens
+quando o autor muda e as tiram quando o livro é apagado.
+
+reconstruir_estatisticas recalcula tudo a partir de EMPRÉSTIMOS e
+verificar_estatisticas aponta as diferenças entre o resumo e o histórico
+(usados por "flask reconciliar-estatisticas").
+"""
+from sqlalchemy import Column, Integer, String, Index
+
+from models import Base, engine
+
+
+class EstatisticaLivro(Base):
+    __tablename__ = 'ESTATISTICAS_LIVROS'
+    __table_args__ = (Index('ix_ESTATISTICAS_LIVROS_ranking', 'emprestimos', 'id_livro'),)
+    id_livro = Column(Integer, primary_key=True)
+    emprestimos = Column(Integer, nullable=False, default=0)
+    devolucoes = Column(Integer, nullable=False, default=0)
+
+
+class EstatisticaUsuario(Base):
+    __tablename__ = 'ESTATISTICAS_USUARIOS'
+    __table_args__ = (Index('ix_ESTATISTICAS_USUARIOS_ranking', 'emprestimos', 'id_usuario'),)
+    id_usuario = Column(Integer, primary_key=True)
+    emprestimos = Column(Integer, nullable=False, default=0)
+    devolucoes = Column(Integer, nullable=False, default=0)
+
+
+class EstatisticaAutor(Base):
+    __tablename__ = 'ESTATISTICAS_AUTORES'
+    __table_args__ = (Index('ix_ESTATISTICAS_AUTORES_ranking', 'emprestimos', 'autor'),)
+    autor = Column(String(30), primary_key=True)
+    emprestimos = Column(Integer, nullable=False, default=0)
+    devolucoes = Column(Integer, nullable=False, default=0)
+
+
+class EstatisticaMes(Base):
+    __tablename__ = 'ESTATISTICAS_MESES'
+    mes = Column(String(7), primary_key=True)  # AAAA-MM
+    # empréstimos contam no mês do data_emprestimo; devoluções no mês do returned_at
+    emprestimos = Column(Integer, nullable=False, default=0)
+    devolucoes = Column(Integer, nullable=False, default=0)
+
+
+MODELOS_ESTATISTICAS = (EstatisticaLivro, EstatisticaUsuario, EstatisticaAutor, EstatisticaMes)
+
+
+def _somar(tabela, chave, selecao):
+    """UPSERT que soma (emprestimos, devolucoes) de "selecao" na linha de "chave"."""
+    return ('INSERT INTO "%s" (%s, emprestimos, devolucoes) %s '
+            'ON CONFLICT(%s) DO UPDATE SET emprestimos = emprestimos + excluded.emprestimos, '
+            'devolucoes = devolucoes + excluded.devolucoes;' % (tabela, chave, selecao, chave))
+
+
+def _aplicar(linha, sinal):
+    """Comandos que somam (sinal '') ou tiram (sinal '-') o empréstimo "linha" (new/old) dos resumos."""
+    valores = {'l': linha, 's': sinal}
+    devolvido = '%(s)s(%(l)s.returned_at IS NOT NULL)' % valores
+    return [
+        _somar('ESTATISTICAS_LIVROS', 'id_livro', 'SELECT %(l)s.id_livro, %(s)s1, ' % valores + devolvido
+               + ' WHERE %(l)s.id_livro IS NOT NULL' % valores),
+        _somar('ESTATISTICAS_USUARIOS', 'id_usuario', 'SELECT %(l)s.id_usuario, %(s)s1, ' % valores + devolvido
+               + ' WHERE %(l)s.id_usuario IS NOT NULL' % valores),
+        _somar('ESTATISTICAS_AUTORES', 'autor', 'SELECT autor, %(s)s1, ' % valores + devolvido
+               + ' FROM "LIVROS" WHERE id_livro = %(l)s.id_livro' % valores),
+        _somar('ESTATISTICAS_MESES', 'mes', 'SELECT substr(%(l)s.data_emprestimo, 1, 7), %(s)s1, 0 '
+               'WHERE %(l)s.data_emprestimo IS NOT NULL' % valores),
+        _somar('ESTATISTICAS_MESES', 'mes', 'SELECT substr(%(l)s.returned_at, 1, 7), 0, %(s)s1 '
+               'WHERE %(l)s.returned_at IS NOT NULL' % valores),
+    ]
+
+
+def _devolucao():
+    """Comandos da devolução simples: só devolucoes + 1, sem mexer nos empréstimos."""
+    return [
+        _somar('ESTATISTICAS_LIVROS', 'id_livro', 'SELECT new.id_livro, 0, 1 WHERE new.id_livro IS NOT NULL'),
+        _somar('ESTATISTICAS_USUARIOS', 'id_usuario', 'SELECT new.id_usuario, 0, 1 WHERE new.id_usuario IS NOT NULL'),
+        _somar('ESTATISTICAS_AUTORES', 'autor', 'SELECT autor, 0, 1 FROM "LIVROS" WHERE id_livro = new.id_livro'),
+        _somar('ESTATISTICAS_MESES', 'mes', 'SELECT substr(new.returned_at, 1, 7), 0, 1 WHERE true'),
+    ]
+
+
+def _mover_autor(livro, autor, sinal):
+    """Soma/tira do "autor" as contagens que o livro já tem."""
+    return _somar('ESTATISTICAS_AUTORES', 'autor',
+                  'SELECT %s, %semprestimos, %sdevolucoes FROM "ESTATISTICAS_LIVROS" WHERE id_livro = %s'
+                  % (autor, sinal, sinal, livro))
+
+
+# a devolução é o UPDATE mais comum: tem um trigger próprio, mais curto
+_SO_DEVOLUCAO = ('old.returned_at IS NULL AND new.returned_at IS NOT NULL AND old.id_livro IS new.id_livro '
+                 'AND old.id_usuario IS new.id_usuario AND old.data_emprestimo IS new.data_emprestimo')
+
+GATILHOS_ESTATISTICAS = {
+    'ESTATISTICAS_emprestimo_ai': ('AFTER INSERT ON "EMPRÉSTIMOS"', _aplicar('new', '')),
+    'ESTATISTICAS_emprestimo_ad': ('AFTER DELETE ON "EMPRÉSTIMOS"', _aplicar('old', '-')),
+    'ESTATISTICAS_emprestimo_devolucao': (
+        'AFTER UPDATE OF returned_at ON "EMPRÉSTIMOS" WHEN ' + _SO_DEVOLUCAO, _devolucao()),
+    'ESTATISTICAS_emprestimo_au': (
+        'AFTER UPDATE OF id_livro, id_usuario, data_emprestimo, returned_at ON "EMPRÉSTIMOS" '
+        'WHEN NOT (%s)' % _SO_DEVOLUCAO, _aplicar('old', '-') + _aplicar('new', '')),
+    'ESTATISTICAS_livro_ai': ('AFTER INSERT ON "LIVROS"', [_mover_autor('new.id_livro', 'new.autor', '')]),
+    'ESTATISTICAS_livro_ad': ('AFTER DELETE ON "LIVROS"', [_mover_autor('old.id_livro', 'old.autor', '-')]),
+    'ESTATISTICAS_livro_au': ('AFTER UPDATE OF autor ON "LIVROS" WHEN old.autor IS NOT new.autor', [
+        _mover_autor('old.id_livro', 'old.autor', '-'), _mover_autor('new.id_livro', 'new.autor', '')]),
+}
+
+# o resumo calculado direto do histórico: a referência da reconciliação
+ESPERADO = {
+    'ESTATISTICAS_LIVROS': ('id_livro', '''
+        SELECT id_livro, count(*), count(returned_at) FROM "EMPRÉSTIMOS"
+        WHERE id_livro IS NOT NULL GROUP BY id_livro'''),
+    'ESTATISTICAS_USUARIOS': ('id_usuario', '''
+        SELECT id_usuario, count(*), count(returned_at) FROM "EMPRÉSTIMOS"
+        WHERE id_usuario IS NOT NULL GROUP BY id_usuario'''),
+    'ESTATISTICAS_AUTORES': ('autor', '''
+        SELECT l.autor, count(*), count(e.returned_at) FROM "EMPRÉSTIMOS" e
+        JOIN "LIVROS" l ON l.id_livro = e.id_livro GROUP BY l.autor'''),
+    'ESTATISTICAS_MESES': ('mes', '''
+        SELECT mes, sum(emprestimos), sum(devolucoes) FROM (
+            SELECT substr(data_emprestimo, 1, 7) AS mes, 1 AS emprestimos, 0 AS devolucoes
+            FROM "EMPRÉSTIMOS" WHERE data_emprestimo IS NOT NULL
+            UNION ALL
+            SELECT substr(returned_at, 1, 7), 0, 1 FROM "EMPRÉSTIMOS" WHERE returned_at IS NOT NULL
+        ) GROUP BY mes'''),
+}
+
+
+def criar_gatilhos_estatisticas(conexao):
+    for nome, (quando, comandos) in GATILHOS_ESTATISTICAS.items():
+        conexao.exec_driver_sql('CREATE TRIGGER IF NOT EXISTS "%s" %s BEGIN\n    %s\nEND' % (
+            nome, quando, '\n    '.join(comandos)))
+
+
+def reconstruir_estatisticas(conexao=None):
+    """Recalcula os resumos a partir de EMPRÉSTIMOS (e recria os triggers, se faltarem)."""
+    if conexao is None:
+        with engine.begin() as conexao:
+            return reconstruir_estatisticas(conexao)
+    criar_gatilhos_estatisticas(conexao)
+    for tabela, (chave, esperado) in ESPERADO.items():
+        conexao.exec_driver_sql('DELETE FROM "%s"' % tabela)
+        conexao.exec_driver_sql('INSERT INTO "%s" (%s, emprestimos, devolucoes) %s' % (tabela, chave, esperado))
+
+
+def verificar_estatisticas(conexao=None):
+    """
+    Compara os resumos com o histórico. Devolve {tabela: [(chave, (emprestimos,
+    devolucoes) no resumo, (emprestimos, devolucoes) no histórico)]} só com as
+    tabelas que divergem.
+    """
+    if conexao is None:
+        with engine.connect() as conexao:
+            return verificar_estatisticas(conexao)
+    divergencias = {}
+    for tabela, (chave, esperado) in ESPERADO.items():
+        # linhas zeradas (livro que só teve empréstimos apagados, autor antigo) equivalem a não ter linha
+        guardado = 'SELECT %s, emprestimos, devolucoes FROM "%s" WHERE emprestimos <> 0 OR devolucoes <> 0' % (
+            chave, tabela)
+        linhas = conexao.exec_driver_sql('''
+            WITH g(c, e, d) AS (%s), h(c, e, d) AS (%s)
+            SELECT g.c, g.e, g.d, h.e, h.d FROM g LEFT JOIN h ON h.c = g.c
+            WHERE g.e IS NOT h.e OR g.d IS NOT h.d
+            UNION ALL
+            SELECT h.c, NULL, NULL, h.e, h.d FROM h LEFT JOIN g ON g.c = h.c WHERE g.c IS NULL''' % (
+            guardado, esperado)).all()
+        if linhas:
+            divergencias[tabela] = [(c, (ge, gd), (ee, ed)) for c, ge, gd, ee, ed in linhas]
+    return divergencias
@@ -0,0 +1,244 @@
+"""
+Feed de mudanças do catálogo para os terminais (Server-Sent Events em /eventos).
+
+Em vez de consultar /livro_status a cada poucos segundos, o terminal abre
+/eventos e recebe um evento curto a cada mudança:
+
+- livro_criado, livro_atualizado (título, autor, ISBN, resumo ou
+  quantidade de exemplares), livro_removido;
+- emprestimo_aberto, emprestimo_fechado, com os exemplares disponíveis do
+  livro depois da mudança.
+
+Os eventos são gravados na tabela EVENTOS por triggers do SQLite em LIVROS
+e EMPRÉSTIMOS, como o índice de busca e as estatísticas: saem na mesma
+transação de qualquer escrita (rotas, lotes com Core, app_async ou direto
+no banco) e o id_evento (AUTOINCREMENT) é a sequência, crescente e única
+entre todos os workers. A tabela guarda só os últimos
+BIBLIOTECA_EVENTOS_MAX eventos.
+
+Em cada processo uma thread lê os eventos novos a cada
+BIBLIOTECA_EVENTOS_INTERVALO_MS e guarda os últimos
+BIBLIOTECA_EVENTOS_BUFFER em memória, de onde as conexões abertas são
+atendidas sem consultar o banco. Cada evento sai com "id:", então o
+EventSource, ao reconectar, manda o Last-Event-ID e recebe o que perdeu
+(do buffer, ou da tabela se já saiu dele). Se nem a tabela tem mais os
+eventos pedidos, o cliente recebe "reiniciar" e deve recarregar o que
+acompanha.
+
+No app Flask cada conexão aberta ocupa uma thread do servidor enquanto
+espera; o app_async espera no event loop, então é o indicado para muitos
+terminais conectados.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque, namedtuple
+
+from sqlalchemy import Column, Integer, String, func, select, text
+
+from models import Base, engine, engine_leitura
+
+MAX_EVENTOS = int(os.environ.get('BIBLIOTECA_EVENTOS_MAX', 10000))
+TAMANHO_BUFFER = int(os.environ.get('BIBLIOTECA_EVENTOS_BUFFER', 1000))
+INTERVALO = float(os.environ.get('BIBLIOTECA_EVENTOS_INTERVALO_MS', 250)) / 1000
+# comentário enviado nas conexões paradas, para proxies não as derrubarem
+MANTER_VIVO = 15
+# espera sugerida ao EventSource antes de reconectar ("retry:")
+RECONEXAO_MS = 3000
+LIMITE_LEITURA = 1000
+
+logger = logging.getLogger('biblioteca.eventos')
+
+
+class Evento(Base):
+    __tablename__ = 'EVENTOS'
+    __table_args__ = {'sqlite_autoincrement': True}  # ids nunca reutilizados, nem depois de apagar
+    id_evento = Column(Integer, primary_key=True)
+    tipo = Column(String(30), nullable=False)
+    id_livro = Column(Integer)
+    id_exemplar = Column(Integer)
+    id_emprestimo = Column(Integer)
+    disponiveis = Column(Integer)
+    criado_em = Column(String(26), nullable=False,
+                       server_default=text("(strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))"))
+
+
+def _evento(tipo, linha, id_exemplar='NULL', id_emprestimo='NULL', disponiveis=None):
+    return ('INSERT INTO "EVENTOS" (tipo, id_livro, id_exemplar, id_emprestimo, disponiveis) '
+            "VALUES ('%s', %s.id_livro, %s, %s, %s);" % (
+                tipo, linha, id_exemplar, id_emprestimo, disponiveis or '%s.exemplares_disponiveis' % linha))
+
+
+# contado aqui, e não lido de LIVROS, porque a ordem entre este trigger e o
+# do contador de exemplares não é garantida
+_DISPONIVEIS = '''(SELECT count(*) FROM "EXEMPLARES" e WHERE e.id_livro = new.id_livro AND NOT EXISTS (
+            SELECT 1 FROM "EMPRÉSTIMOS" m WHERE m.id_exemplar = e.id_exemplar AND m.returned_at IS NULL))'''
+
+GATILHOS_EVENTOS = {
+    'EVENTOS_livro_ai': ('AFTER INSERT ON "LIVROS"', _evento('livro_criado', 'new')),
+    'EVENTOS_livro_au': (
+        'AFTER UPDATE OF titulo, autor, ISBN, resumo, exemplares_total ON "LIVROS" WHEN '
+        'old.titulo IS NOT new.titulo OR old.autor IS NOT new.autor OR old.ISBN IS NOT new.ISBN '
+        'OR old.resumo IS NOT new.resumo OR old.exemplares_total IS NOT new.exemplares_total',
+        _evento('livro_atualizado', 'new')),
+    'EVENTOS_livro_ad': ('AFTER DELETE ON "LIVROS"', _evento('livro_removido', 'old', disponiveis='NULL')),
+    'EVENTOS_emprestimo_ai': (
+        'AFTER INSERT ON "EMPRÉSTIMOS" WHEN new.returned_at IS NULL',
+        _evento('emprestimo_aberto', 'new', 'new.id_exemplar', 'new.id_emprestimo', _DISPONIVEIS)),
+    'EVENTOS_emprestimo_devolucao': (
+        'AFTER UPDATE OF returned_at ON "EMPRÉSTIMOS" WHEN old.returned_at IS NULL AND new.returned_at IS NOT NULL',
+        _evento('emprestimo_fechado', 'new', 'new.id_exemplar', 'new.id_emprestimo', _DISPONIVEIS)),
+    # a tabela é o buffer de replay de todos os workers: fica só com os últimos MAX_EVENTOS
+    'EVENTOS_limite': ('AFTER INSERT ON "EVENTOS"',
+                       'DELETE FROM "EVENTOS" WHERE id_evento <= new.id_evento - %d;' % MAX_EVENTOS),
+}
+
+
+def criar_gatilhos_eventos(conexao=None):
+    """Cria os triggers que faltam (o limite da tabela é o MAX_EVENTOS de quando foram criados)."""
+    if conexao is None:
+        with engine.begin() as conexao:
+            return criar_gatilhos_eventos(conexao)
+    for nome, (quando, comando) in GATILHOS_EVENTOS.items():
+        conexao.exec_driver_sql('CREATE TRIGGER IF NOT EXISTS "%s" %s BEGIN\n    %s\nEND' % (nome, quando, comando))
+
+
+# ---------------------------------------------------------------------------
+# leitura e formato SSE
+
+# "quadro" é o evento já no formato do text/event-stream
+EventoSSE = namedtuple('EventoSSE', 'id_evento id_livro quadro')
+
+COLUNAS = (Evento.id_evento, Evento.tipo, Evento.id_livro, Evento.id_exemplar, Evento.id_emprestimo,
+           Evento.disponiveis, Evento.criado_em)
+
+
+def quadro_sse(evento, nome, dados):
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (evento, nome, json.dumps(dados, separators=(',', ':')))
+
+
+def para_sse(linha):
+    dados = {'id_livro': linha.id_livro, 'disponiveis': linha.disponiveis, 'em': linha.criado_em}
+    if linha.id_emprestimo is not None:
+        dados.update(id_emprestimo=linha.id_emprestimo, id_exemplar=linha.id_exemplar)
+    return EventoSSE(linha.id_evento, linha.id_livro, quadro_sse(linha.id_evento, linha.tipo, dados))
+
+
+def ler_eventos(conexao, depois_de, limite=LIMITE_LEITURA):
+    linhas = conexao.execute(select(*COLUNAS).where(Evento.id_evento > depois_de)
+                             .order_by(Evento.id_evento).limit(limite))
+    return [para_sse(linha) for linha in linhas]
+
+
+class FeedEventos:
+    """Últimos eventos em memória, atualizados por uma thread que lê a tabela EVENTOS."""
+
+    def __init__(self, tamanho=TAMANHO_BUFFER, intervalo=INTERVALO):
+        self.intervalo = intervalo
+        self._buffer = deque(maxlen=tamanho)
+        self._condicao = threading.Condition()
+        self._thread = None
+        self.ultimo = 0
+
+    def iniciar(self):
+        """Começa a acompanhar a tabela a partir do último evento (na primeira conexão do processo)."""
+        with self._condicao:
+            if self._thread is not None:
+                return
+            with engine_leitura.connect() as conexao:
+                self.ultimo = conexao.execute(select(func.coalesce(func.max(Evento.id_evento), 0))).scalar()
+            self._thread = threading.Thread(target=self._acompanhar, name='biblioteca-eventos', daemon=True)
+            self._thread.start()
+
+    def _acompanhar(self):
+        while True:
+            novos = []
+            try:
+                with engine_leitura.connect() as conexao:
+                    novos = ler_eventos(conexao, self.ultimo)
+            except Exception:
+                logger.exception('erro ao ler os eventos novos')
+            if novos:
+                with self._condicao:
+                    self._buffer.extend(novos)
+                    self.ultimo = novos[-1].id_evento
+                    self._condicao.notify_all()
+            # leitura cheia: ainda tem mais, sem esperar
+            if len(novos) < LIMITE_LEITURA:
+                time.sleep(self.intervalo)
+
+    def esperar(self, depois_de, timeout):
+        """Espera até haver evento depois de "depois_de"; False se o tempo acabou antes."""
+        with self._condicao:
+            return self._condicao.wait_for(lambda: self.ultimo > depois_de, timeout)
+
+    def proximos(self, depois_de, livros=None):
+        """
+        (texto, cursor): os quadros SSE dos eventos depois de "depois_de" (só
+        dos "livros", se informados) e o id do último evento visto. Quando os
+        eventos pedidos já não existem, o texto é o quadro "reiniciar" e o
+        cursor pula para o evento mais recente.
+        """
+        with self._condicao:
+            ultimo = self.ultimo
+            if depois_de == ultimo:
+                return '', depois_de
+            if depois_de > ultimo:
+                eventos = None
+            elif self._buffer and depois_de >= self._buffer[0].id_evento - 1:
+                eventos = [e for e in self._buffer if e.id_evento > depois_de]
+            else:
+                eventos = []
+        if eventos is None:
+            # cursor à frente deste processo: normal se veio de outro worker
+            # (a thread daqui ainda não leu); só reinicia se o banco também
+            # não tem esse evento (banco recriado)
+            with engine_leitura.connect() as conexao:
+                if (conexao.execute(select(func.max(Evento.id_evento))).scalar() or 0) >= depois_de:
+                    return '', depois_de
+        elif not eventos:
+            # fora do buffer: da tabela, se ela ainda tiver o seguinte ao cursor
+            with engine_leitura.connect() as conexao:
+                eventos = ler_eventos(conexao, depois_de, min(ultimo - depois_de, LIMITE_LEITURA))
+            if not eventos or eventos[0].id_evento != depois_de + 1:
+                eventos = None
+        if eventos is None:
+            return quadro_sse(ultimo, 'reiniciar', {'ultimo': ultimo}), ultimo
+        cursor = eventos[-1].id_evento
+        if livros:
+            eventos = [e for e in eventos if e.id_livro in livros]
+        return ''.join(e.quadro for e in eventos), cursor
+
+
+feed = FeedEventos()
+
+
+def parametros_eventos(last_event_id, args):
+    """
+    (depois_de, livros, erro) a partir do Last-Event-ID (ou ?desde=) e de
+    ?livros=1,2,3. Sem nenhum dos dois, começa pelos eventos novos.
+    """
+    desde = last_event_id or args.get('desde')
+    livros = args.get('livros')
+    try:
+        desde = int(desde) if desde else None
+        livros = {int(i) for i in livros.split(',') if i.strip()} if livros else None
+    except ValueError:
+        return None, None, 'desde/Last-Event-ID e livros devem ser números'
+    if desde is not None and desde < 0:
+        return None, None, 'desde/Last-Event-ID e livros devem ser números'
+    feed.iniciar()
+    return feed.ultimo if desde is None else desde, livros, None
+
+
+def transmitir(depois_de, livros):
+    """Gera o text/event-stream (app Flask): eventos conforme chegam e um comentário a cada MANTER_VIVO."""
+    yield 'retry: %d\n\n' % RECONEXAO_MS
+    while True:
+        texto, depois_de = feed.proximos(depois_de, livros)
+        if texto:
+            yield texto
+        elif not feed.esperar(depois_de, MANTER_VIVO):
+            yield ': \n\n'
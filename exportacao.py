@@ -0,0 +1,208 @@
+"""
+Snapshots do catálogo e do histórico em arquivos, para as integrações
+noturnas (catálogo coletivo, BI) não rasparem a API.
+
+"flask exportar" (ou "python exportacao.py") lê LIVROS, USUARIOS e
+EMPRÉSTIMOS numa única transação de leitura, então as três tabelas saem do
+mesmo instante, e grava cada uma em blocos num arquivo NDJSON ou CSV
+comprimido com gzip, sem montar a tabela em memória. Junto vai o
+manifesto.json, com a quantidade de linhas, o tamanho e o sha256 de cada
+arquivo.
+
+Cada snapshot fica num diretório próprio dentro de
+BIBLIOTECA_EXPORTACAO_DIR (padrão: exportacoes/ ao lado do app), escrito
+num diretório temporário e renomeado no fim; o arquivo ULTIMA aponta para
+o mais recente. Os BIBLIOTECA_EXPORTACAO_MANTER mais recentes são
+mantidos, para um download em andamento não perder o arquivo quando sai o
+próximo.
+
+A API serve o manifesto do último snapshot em /exportacoes/ultima e os
+arquivos em /exportacoes/<snapshot>/<arquivo> com send_file: Range (para
+retomar downloads), ETag e, com um servidor que oferece wsgi.file_wrapper
+(gunicorn, por exemplo), sendfile sem passar os bytes pelo Python. Nada
+disso abre conexão com o banco.
+"""
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+from datetime import date, datetime, timezone
+
+from sqlalchemy import select
+
+from models import Livro, Usuario, Emprestimo, engine_leitura
+
+DIRETORIO = os.environ.get('BIBLIOTECA_EXPORTACAO_DIR',
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exportacoes'))
+MANTER = int(os.environ.get('BIBLIOTECA_EXPORTACAO_MANTER', 3))
+TAMANHO_BLOCO = 5000
+ARQUIVO_ULTIMA = 'ULTIMA'
+ARQUIVO_MANIFESTO = 'manifesto.json'
+PREFIXO_TEMPORARIO = '.tmp-'
+TABELAS = (('livros', Livro), ('usuarios', Usuario), ('emprestimos', Emprestimo))
+FORMATOS = ('ndjson', 'csv')
+# os arquivos de um snapshot nunca mudam: podem ficar em cache à vontade
+MAX_AGE_ARQUIVOS = 365 * 24 * 3600
+
+
+def _valor(valor):
+    if isinstance(valor, (date, datetime)):
+        return valor.isoformat()
+    return valor
+
+
+class _EscritorNdjson:
+    def __init__(self, arquivo, colunas):
+        self.arquivo = arquivo
+        self.colunas = colunas
+
+    def escrever(self, linhas):
+        self.arquivo.writelines(
+            json.dumps(dict(zip(self.colunas, map(_valor, linha))), ensure_ascii=False) + '\n' for linha in linhas)
+
+
+class _EscritorCsv:
+    def __init__(self, arquivo, colunas):
+        self.csv = csv.writer(arquivo)
+        self.csv.writerow(colunas)
+
+    def escrever(self, linhas):
+        self.csv.writerows([_valor(valor) for valor in linha] for linha in linhas)
+
+
+ESCRITORES = {'ndjson': _EscritorNdjson, 'csv': _EscritorCsv}
+
+
+def _sha256(caminho):
+    resumo = hashlib.sha256()
+    with open(caminho, 'rb') as arquivo:
+        for bloco in iter(lambda: arquivo.read(1024 * 1024), b''):
+            resumo.update(bloco)
+    return resumo.hexdigest()
+
+
+def exportar_tabela(conexao, modelo, caminho, formato):
+    """Grava a tabela do "modelo" em "caminho" (gzip), em blocos de TAMANHO_BLOCO linhas; devolve as linhas."""
+    tabela = modelo.__table__
+    resultado = conexao.execution_options(yield_per=TAMANHO_BLOCO).execute(
+        select(*tabela.columns).order_by(*tabela.primary_key.columns))
+    total = 0
+    # mtime=0: o mesmo conteúdo gera o mesmo arquivo (e o mesmo sha256)
+    with gzip.GzipFile(caminho, 'wb', mtime=0) as comprimido, \
+            io.TextIOWrapper(comprimido, encoding='utf-8', newline='') as arquivo:
+        escritor = ESCRITORES[formato](arquivo, [coluna.name for coluna in tabela.columns])
+        for bloco in resultado.partitions():
+            escritor.escrever(bloco)
+            total += len(bloco)
+    return total
+
+
+def exportar(formato='ndjson', diretorio=None, engine_alvo=None):
+    """Gera um snapshot novo, aponta ULTIMA para ele e devolve (nome, manifesto)."""
+    if formato not in FORMATOS:
+        raise ValueError('formato deve ser um de: %s' % ', '.join(FORMATOS))
+    diretorio = diretorio or DIRETORIO
+    os.makedirs(diretorio, exist_ok=True)
+    agora = datetime.now(timezone.utc)
+    nome = agora.strftime('%Y%m%dT%H%M%S%fZ')
+    temporario = os.path.join(diretorio, PREFIXO_TEMPORARIO + nome)
+    os.mkdir(temporario)
+    try:
+        arquivos = []
+        with (engine_alvo or engine_leitura).connect() as conexao:
+            # o pysqlite só abre a transação sozinho antes de escrever; aberta
+            # aqui, as três tabelas são lidas do mesmo snapshot do WAL
+            conexao.exec_driver_sql('BEGIN')
+            for tabela, modelo in TABELAS:
+                arquivo = '%s.%s.gz' % (tabela, formato)
+                caminho = os.path.join(temporario, arquivo)
+                linhas = exportar_tabela(conexao, modelo, caminho, formato)
+                arquivos.append({'tabela': modelo.__tablename__, 'arquivo': arquivo, 'linhas': linhas,
+                                 'bytes': os.path.getsize(caminho), 'sha256': _sha256(caminho)})
+        manifesto = {'snapshot': nome, 'gerado_em': agora.isoformat(), 'formato': formato,
+                     'compressao': 'gzip', 'arquivos': arquivos}
+        with open(os.path.join(temporario, ARQUIVO_MANIFESTO), 'w', encoding='utf-8') as arquivo:
+            json.dump(manifesto, arquivo, indent=2, ensure_ascii=False)
+        os.rename(temporario, os.path.join(diretorio, nome))
+    except BaseException:
+        shutil.rmtree(temporario, ignore_errors=True)
+        raise
+
+    ponteiro = os.path.join(diretorio, ARQUIVO_ULTIMA)
+    with open(ponteiro + '.tmp', 'w', encoding='utf-8') as arquivo:
+        arquivo.write(nome)
+    os.replace(ponteiro + '.tmp', ponteiro)
+    remover_antigos(diretorio)
+    return nome, manifesto
+
+
+def snapshots(diretorio=None):
+    """Nomes dos snapshots completos, do mais antigo para o mais recente."""
+    diretorio = diretorio or DIRETORIO
+    if not os.path.isdir(diretorio):
+        return []
+    return sorted(nome for nome in os.listdir(diretorio)
+                  if not nome.startswith(PREFIXO_TEMPORARIO)
+                  and os.path.isfile(os.path.join(diretorio, nome, ARQUIVO_MANIFESTO)))
+
+
+def remover_antigos(diretorio=None, manter=None):
+    """Apaga os snapshots além dos "manter" mais recentes (0 mantém todos)."""
+    diretorio = diretorio or DIRETORIO
+    manter = MANTER if manter is None else manter
+    if manter <= 0:
+        return
+    for nome in snapshots(diretorio)[:-manter]:
+        shutil.rmtree(os.path.join(diretorio, nome), ignore_errors=True)
+
+
+def manifesto(nome, diretorio=None):
+    """O manifesto do snapshot "nome", ou None se ele não existir."""
+    diretorio = diretorio or DIRETORIO
+    if nome not in snapshots(diretorio):
+        return None
+    with open(os.path.join(diretorio, nome, ARQUIVO_MANIFESTO), encoding='utf-8') as arquivo:
+        return json.load(arquivo)
+
+
+def ultimo_snapshot(diretorio=None):
+    """Nome do snapshot apontado por ULTIMA, ou None se ainda não houver exportação."""
+    try:
+        with open(os.path.join(diretorio or DIRETORIO, ARQUIVO_ULTIMA), encoding='utf-8') as arquivo:
+            return arquivo.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def manifesto_com_urls(prefixo='/exportacoes'):
+    """O manifesto do último snapshot, com a "url" de cada arquivo; None se ainda não houver exportação."""
+    nome = ultimo_snapshot()
+    dados = manifesto(nome) if nome else None
+    if dados is not None:
+        for item in dados['arquivos']:
+            item['url'] = '%s/%s/%s' % (prefixo, nome, item['arquivo'])
+    return dados
+
+
+def arquivo_do_snapshot(nome, arquivo, diretorio=None):
+    """Diretório do snapshot se "arquivo" está no manifesto dele; None caso contrário."""
+    dados = manifesto(nome, diretorio)
+    if dados is None or arquivo not in {a['arquivo'] for a in dados['arquivos']} | {ARQUIVO_MANIFESTO}:
+        return None
+    return os.path.join(diretorio or DIRETORIO, nome)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Gera um snapshot de LIVROS, USUARIOS e EMPRÉSTIMOS.')
+    parser.add_argument('--formato', choices=FORMATOS, default='ndjson')
+    parser.add_argument('--diretorio', help='padrão: BIBLIOTECA_EXPORTACAO_DIR')
+    args = parser.parse_args()
+    nome, dados = exportar(args.formato, args.diretorio)
+    for item in dados['arquivos']:
+        print('%s: %d linhas, %d bytes' % (item['arquivo'], item['linhas'], item['bytes']))
+    print('snapshot %s' % nome)
@@ -0,0 +1,302 @@
+"""
+Idempotency-Key nas rotas POST que criam ou devolvem.
+
+Com Wi-Fi instável os terminais repetem /realizar_emprestimo, /novo_livro,
+/novo_usuario e /devolver_livro sem saber se a primeira tentativa chegou.
+Quando a requisição traz o cabeçalho Idempotency-Key, a primeira execução
+guarda a resposta (status e corpo) e as repetições com a mesma chave
+recebem essa resposta de volta, com "Idempotent-Replayed: true", sem
+consultar nem escrever no banco.
+
+- Uma repetição que chega enquanto a primeira ainda está executando espera
+  por ela (no máximo BIBLIOTECA_IDEMPOTENCIA_ESPERA_MS; depois disso, 409
+  com Retry-After) em vez de executar de novo.
+- A chave vale para a rota e para o corpo enviado: reusá-la com outro
+  corpo dá 422.
+- Respostas 5xx não são guardadas, para a repetição poder dar certo. Por
+  isso as rotas decoradas respondem 500, e não 400, quando quem falhou foi
+  o banco (travado, commit que não passou); 4xx fica para erros do pedido,
+  que a repetição com o mesmo corpo repetiria.
+
+As respostas ficam num cache LRU por processo (BIBLIOTECA_IDEMPOTENCIA_ITENS
+entradas, expirando em BIBLIOTECA_IDEMPOTENCIA_TTL segundos). Com
+BIBLIOTECA_IDEMPOTENCIA_BANCO=1 também vão para a tabela
+RESPOSTAS_IDEMPOTENTES, então uma repetição atendida por outro worker
+também é respondida sem executar de novo. A espera pela execução em
+andamento continua sendo só dentro do processo.
+
+O app Flask usa o decorator "idempotente"; o app_async, o
+idempotente_async de lá, com as mesmas peças daqui.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+from flask import jsonify, make_response, request, Response
+from sqlalchemy import Column, Float, Integer, LargeBinary, String, delete, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from metricas import metricas
+from models import Base, db_session, db_session_leitura
+
+CABECALHO = 'Idempotency-Key'
+TAMANHO_MAXIMO_CHAVE = 255
+TTL = float(os.environ.get('BIBLIOTECA_IDEMPOTENCIA_TTL', 24 * 3600))
+MAX_ITENS = int(os.environ.get('BIBLIOTECA_IDEMPOTENCIA_ITENS', 10000))
+ESPERA_MAXIMA = float(os.environ.get('BIBLIOTECA_IDEMPOTENCIA_ESPERA_MS', 10000)) / 1000
+USAR_BANCO = os.environ.get('BIBLIOTECA_IDEMPOTENCIA_BANCO', '0') == '1'
+# a cada quantas respostas guardadas no banco as expiradas são apagadas
+INTERVALO_LIMPEZA = 256
+
+ERRO_CHAVE_INVALIDA = 'Idempotency-Key deve ter de 1 a %d caracteres' % TAMANHO_MAXIMO_CHAVE
+ERRO_CHAVE_EM_USO = 'Idempotency-Key já usada em outra requisição'
+ERRO_EM_ANDAMENTO = 'Requisição com esta Idempotency-Key ainda em andamento, tente novamente'
+
+logger = logging.getLogger('biblioteca.idempotencia')
+
+
+class RespostaIdempotente(Base):
+    __tablename__ = 'RESPOSTAS_IDEMPOTENTES'
+    rota = Column(String(100), primary_key=True)
+    chave = Column(String(TAMANHO_MAXIMO_CHAVE), primary_key=True)
+    impressao = Column(String(64), nullable=False)
+    status = Column(Integer, nullable=False)
+    corpo = Column(LargeBinary, nullable=False)
+    tipo = Column(String(100))
+    expira_em = Column(Float, nullable=False, index=True)  # time.time()
+
+
+# "impressao" é o sha256 da requisição original; expira_em, em time.time()
+RespostaGuardada = namedtuple('RespostaGuardada', 'impressao status corpo tipo expira_em')
+
+
+class ChaveEmUso(Exception):
+    """A chave já foi usada com outra rota ou outro corpo."""
+
+
+class AindaEmAndamento(Exception):
+    """A primeira execução com a chave não terminou dentro da espera máxima."""
+
+
+class RespostasIdempotentes:
+    """
+    Respostas guardadas por (rota, chave), LRU com TTL, e as execuções em
+    andamento, cada uma com o Event que as repetições esperam.
+    """
+
+    def __init__(self, max_itens=MAX_ITENS, ttl=TTL):
+        self.max_itens = max_itens
+        self.ttl = ttl
+        self._guardadas = OrderedDict()
+        self._em_andamento = {}
+        self._lock = threading.Lock()
+        self.contagens = {'executadas': 0, 'repetidas': 0, 'esperas': 0, 'conflitos': 0, 'espera_esgotada': 0}
+
+    def _conferir(self, impressao_guardada, impressao):
+        if impressao_guardada != impressao:
+            self.contagens['conflitos'] += 1
+            raise ChaveEmUso(ERRO_CHAVE_EM_USO)
+
+    def tentar(self, chave, impressao):
+        """
+        Devolve (guardada, None) para repetir a resposta, (None, None) quando
+        quem chamou ficou com a execução (e tem de chamar concluir ou
+        abandonar) ou (None, evento) quando é preciso esperar a execução em
+        andamento e tentar de novo.
+        """
+        with self._lock:
+            guardada = self._guardadas.get(chave)
+            if guardada is not None and guardada.expira_em < time.time():
+                del self._guardadas[chave]
+                guardada = None
+            if guardada is not None:
+                self._conferir(guardada.impressao, impressao)
+                self._guardadas.move_to_end(chave)
+                self.contagens['repetidas'] += 1
+                return guardada, None
+            andamento = self._em_andamento.get(chave)
+            if andamento is None:
+                self._em_andamento[chave] = (impressao, threading.Event())
+                self.contagens['executadas'] += 1
+                return None, None
+            self._conferir(andamento[0], impressao)
+            self.contagens['esperas'] += 1
+            return None, andamento[1]
+
+    def esgotou_espera(self):
+        with self._lock:
+            self.contagens['espera_esgotada'] += 1
+        return AindaEmAndamento(ERRO_EM_ANDAMENTO)
+
+    def concluir(self, chave, guardada):
+        """Guarda a resposta da execução e libera quem estava esperando."""
+        with self._lock:
+            self._guardadas[chave] = guardada
+            self._guardadas.move_to_end(chave)
+            while len(self._guardadas) > self.max_itens:
+                self._guardadas.popitem(last=False)
+            andamento = self._em_andamento.pop(chave, None)
+        if andamento is not None:
+            andamento[1].set()
+
+    def repetir_do_banco(self, chave, impressao, guardada):
+        """Conclui a execução reservada com a resposta que outro worker guardou no banco."""
+        self.concluir(chave, guardada)
+        with self._lock:
+            self.contagens['executadas'] -= 1
+            self._conferir(guardada.impressao, impressao)
+            self.contagens['repetidas'] += 1
+        return guardada
+
+    def abandonar(self, chave):
+        """Execução sem resposta para guardar (5xx ou exceção): a próxima tentativa executa de novo."""
+        with self._lock:
+            andamento = self._em_andamento.pop(chave, None)
+        if andamento is not None:
+            andamento[1].set()
+
+    def estatisticas(self):
+        with self._lock:
+            return len(self._guardadas), len(self._em_andamento), dict(self.contagens)
+
+
+respostas = RespostasIdempotentes()
+_guardadas_no_banco = [0]
+
+
+def chave_da_requisicao(rota, valor):
+    """(rota, chave) para o cabeçalho "valor", ou None se ele for inválido."""
+    if not valor or len(valor) > TAMANHO_MAXIMO_CHAVE:
+        return None
+    return rota, valor
+
+
+def impressao_requisicao(metodo, rota, query_string, corpo):
+    return hashlib.sha256(b'\n'.join((metodo.encode(), rota.encode(), query_string, corpo))).hexdigest()
+
+
+def nova_resposta(impressao, status, corpo, tipo):
+    return RespostaGuardada(impressao, status, corpo, tipo, time.time() + respostas.ttl)
+
+
+def guardar_status(status):
+    """2xx e 4xx (erros do próprio pedido) são guardados; 5xx não."""
+    return status < 500
+
+
+# ---------------------------------------------------------------------------
+# tabela RESPOSTAS_IDEMPOTENTES (BIBLIOTECA_IDEMPOTENCIA_BANCO=1)
+
+def sql_buscar(chave):
+    rota, valor = chave
+    return (select(RespostaIdempotente.impressao, RespostaIdempotente.status, RespostaIdempotente.corpo,
+                   RespostaIdempotente.tipo, RespostaIdempotente.expira_em)
+            .where(RespostaIdempotente.rota == rota, RespostaIdempotente.chave == valor,
+                   RespostaIdempotente.expira_em >= time.time()))
+
+
+def sqls_guardar(chave, guardada):
+    """O UPSERT da resposta (mantendo a de outro worker, se ainda valer) e, de tempos em tempos, a limpeza."""
+    rota, valor = chave
+    upsert = sqlite_insert(RespostaIdempotente).values(rota=rota, chave=valor, **guardada._asdict())
+    comandos = [upsert.on_conflict_do_update(
+        index_elements=[RespostaIdempotente.rota, RespostaIdempotente.chave],
+        set_={campo: upsert.excluded[campo] for campo in RespostaGuardada._fields},
+        where=RespostaIdempotente.expira_em < time.time())]
+    _guardadas_no_banco[0] += 1
+    if _guardadas_no_banco[0] % INTERVALO_LIMPEZA == 0:
+        comandos.append(delete(RespostaIdempotente).where(RespostaIdempotente.expira_em < time.time()))
+    return comandos
+
+
+# ---------------------------------------------------------------------------
+# Flask
+
+def _reservar(chave, impressao):
+    limite = time.monotonic() + ESPERA_MAXIMA
+    while True:
+        guardada, evento = respostas.tentar(chave, impressao)
+        if evento is None:
+            break
+        if not evento.wait(max(limite - time.monotonic(), 0)):
+            raise respostas.esgotou_espera()
+    if guardada is None and USAR_BANCO:
+        # ficou com a execução: outro worker pode já ter guardado a resposta
+        try:
+            linha = db_session_leitura.execute(sql_buscar(chave)).first()
+        except Exception:
+            respostas.abandonar(chave)
+            raise
+        if linha is not None:
+            guardada = respostas.repetir_do_banco(chave, impressao, RespostaGuardada(*linha))
+    return guardada
+
+
+def _guardar_no_banco(chave, guardada):
+    try:
+        for comando in sqls_guardar(chave, guardada):
+            db_session.execute(comando)
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        logger.exception('não foi possível guardar a resposta idempotente no banco')
+
+
+def resposta_repetida(guardada):
+    resposta = Response(guardada.corpo, guardada.status, content_type=guardada.tipo)
+    resposta.headers['Idempotent-Replayed'] = 'true'
+    return resposta
+
+
+def idempotente(fn):
+    """Respeita o Idempotency-Key da requisição (ver o docstring do módulo)."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        valor = request.headers.get(CABECALHO)
+        if valor is None:
+            return fn(*args, **kwargs)
+        chave = chave_da_requisicao(request.path, valor)
+        if chave is None:
+            return jsonify({'erro': ERRO_CHAVE_INVALIDA}), 400
+        impressao = impressao_requisicao(request.method, request.path, request.query_string, request.get_data())
+        try:
+            guardada = _reservar(chave, impressao)
+        except ChaveEmUso as e:
+            return jsonify({'erro': str(e)}), 422
+        except AindaEmAndamento as e:
+            return jsonify({'erro': str(e)}), 409, {'Retry-After': '1'}
+        if guardada is not None:
+            return resposta_repetida(guardada)
+
+        try:
+            resposta = make_response(fn(*args, **kwargs))
+        except BaseException:
+            respostas.abandonar(chave)
+            raise
+        if not guardar_status(resposta.status_code) or resposta.is_streamed:
+            respostas.abandonar(chave)
+            return resposta
+        guardada = nova_resposta(impressao, resposta.status_code, resposta.get_data(), resposta.content_type)
+        if USAR_BANCO:
+            _guardar_no_banco(chave, guardada)
+        respostas.concluir(chave, guardada)
+        return resposta
+    return wrapper
+
+
+def metricas_idempotencia():
+    itens, em_andamento, contagens = respostas.estatisticas()
+    linhas = ['# TYPE biblioteca_idempotencia_itens gauge', 'biblioteca_idempotencia_itens %d' % itens,
+              '# TYPE biblioteca_idempotencia_em_andamento gauge',
+              'biblioteca_idempotencia_em_andamento %d' % em_andamento,
+              '# TYPE biblioteca_idempotencia_total counter']
+    linhas += ['biblioteca_idempotencia_total{resultado="%s"} %d' % (resultado, total)
+               for resultado, total in contagens.items()]
+    return linhas
+
+
+metricas.registrar_coletor(metricas_idempotencia)
@@ -0,0 +1,217 @@
+"""
+Métricas da API no formato de texto do Prometheus.
+
+- latência (histograma), status e requisições em andamento por rota;
+- quantidade e tempo dos comandos SQL, no total e por requisição, a partir
+  dos eventos before/after_cursor_execute das engines;
+- log dos comandos SQL mais lentos que BIBLIOTECA_SQL_LENTO_MS.
+
+As rotas são identificadas pelo padrão da URL (ex.: /editar_livro/<int:id>),
+então o número de séries não cresce com os ids. O app Flask é instrumentado
+por instrumentar_app e o app_async por instrumentar_asgi.
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+from flask import Response, g, request
+
+LIMITES_LATENCIA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LIMITES_SQL_POR_REQUISICAO = (0, 1, 2, 5, 10, 20, 50, 100)
+SQL_LENTO_MS = float(os.environ.get('BIBLIOTECA_SQL_LENTO_MS', 100))
+
+logger_sql_lento = logging.getLogger('biblioteca.sql_lento')
+
+# [comandos SQL, caminho] da requisição atual; vale para a thread do Flask e
+# para a task do asyncio
+_requisicao_atual = ContextVar('biblioteca_metricas_requisicao', default=None)
+
+
+class Histograma:
+    def __init__(self, limites):
+        self.limites = limites
+        self.contagens = [0] * len(limites)
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        self.soma += valor
+        self.total += 1
+        posicao = bisect.bisect_left(self.limites, valor)
+        if posicao < len(self.contagens):
+            self.contagens[posicao] += 1
+
+    def linhas(self, nome, rotulos):
+        acumulado = 0
+        for limite, contagem in zip(self.limites, self.contagens):
+            acumulado += contagem
+            yield '%s_bucket{%sle="%s"} %d' % (nome, rotulos, limite, acumulado)
+        yield '%s_bucket{%sle="+Inf"} %d' % (nome, rotulos, self.total)
+        sufixo = '{%s}' % rotulos.rstrip(',') if rotulos else ''
+        yield '%s_sum%s %s' % (nome, sufixo, self.soma)
+        yield '%s_count%s %d' % (nome, sufixo, self.total)
+
+
+def _rotulos(**valores):
+    partes = []
+    for chave, valor in valores.items():
+        valor = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        partes.append('%s="%s",' % (chave, valor))
+    return ''.join(partes)
+
+
+class Metricas:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencia = {}
+        self.sql_por_requisicao = {}
+        self.respostas = {}
+        self.em_andamento = 0
+        self.sql_total = 0
+        self.sql_segundos = Histograma(LIMITES_LATENCIA)
+        self.sql_lentos = 0
+        self._coletores = []
+
+    def registrar_coletor(self, coletor):
+        """Registra uma função sem argumentos que devolve linhas extras no formato Prometheus."""
+        self._coletores.append(coletor)
+
+    # requisições -----------------------------------------------------------
+
+    def observar(self, rota, metodo, status, duracao, comandos_sql):
+        chave = (rota, metodo)
+        with self._lock:
+            self.latencia.setdefault(chave, Histograma(LIMITES_LATENCIA)).observar(duracao)
+            self.sql_por_requisicao.setdefault(chave, Histograma(LIMITES_SQL_POR_REQUISICAO)).observar(comandos_sql)
+            chave_status = (rota, metodo, status)
+            self.respostas[chave_status] = self.respostas.get(chave_status, 0) + 1
+
+    def _inicio_requisicao(self):
+        g.metricas_inicio = time.perf_counter()
+        g.metricas_requisicao = [0, request.path]
+        _requisicao_atual.set(g.metricas_requisicao)
+        with self._lock:
+            self.em_andamento += 1
+
+    def _fim_requisicao(self, resposta):
+        inicio = g.pop('metricas_inicio', None)
+        if inicio is None:
+            return resposta
+        rota = request.url_rule.rule if request.url_rule else 'desconhecida'
+        self.observar(rota, request.method, resposta.status_code, time.perf_counter() - inicio,
+                      g.metricas_requisicao[0])
+        return resposta
+
+    def _encerrar_requisicao(self, exception=None):
+        with self._lock:
+            self.em_andamento -= 1
+
+    def instrumentar_app(self, app):
+        app.before_request(self._inicio_requisicao)
+        app.after_request(self._fim_requisicao)
+        app.teardown_request(self._encerrar_requisicao)
+
+    def instrumentar_asgi(self, app_asgi):
+        """Envolve um app ASGI (Starlette) com as mesmas métricas de instrumentar_app."""
+        async def middleware(scope, receive, send):
+            if scope['type'] != 'http':
+                return await app_asgi(scope, receive, send)
+            inicio = time.perf_counter()
+            requisicao = [0, scope['path']]
+            _requisicao_atual.set(requisicao)
+            status = [500]
+
+            async def enviar(mensagem):
+                if mensagem['type'] == 'http.response.start':
+                    status[0] = mensagem['status']
+                await send(mensagem)
+
+            with self._lock:
+                self.em_andamento += 1
+            try:
+                await app_asgi(scope, receive, enviar)
+            finally:
+                # o roteador do Starlette grava a rota encontrada no próprio scope
+                rota = getattr(scope.get('route'), 'path', None) or 'desconhecida'
+                self.observar(rota, scope['method'], status[0], time.perf_counter() - inicio, requisicao[0])
+                self._encerrar_requisicao()
+        return middleware
+
+    # SQL -------------------------------------------------------------------
+
+    def _antes_sql(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metricas_inicio_sql', []).append(time.perf_counter())
+
+    def _depois_sql(self, conn, cursor, statement, parameters, context, executemany):
+        duracao = time.perf_counter() - conn.info['metricas_inicio_sql'].pop()
+        with self._lock:
+            self.sql_total += 1
+            self.sql_segundos.observar(duracao)
+            lento = duracao * 1000 >= SQL_LENTO_MS
+            if lento:
+                self.sql_lentos += 1
+        requisicao = _requisicao_atual.get()
+        if requisicao is not None:
+            requisicao[0] += 1
+        if lento:
+            logger_sql_lento.warning('SQL lento (%.1f ms) em %s: %s', duracao * 1000,
+                                     requisicao[1] if requisicao else '-', statement[:500])
+
+    def instrumentar_engine(self, engine):
+        from sqlalchemy import event
+        # numa AsyncEngine os eventos ficam na engine síncrona que ela envolve
+        engine = getattr(engine, 'sync_engine', engine)
+        event.listen(engine, 'before_cursor_execute', self._antes_sql)
+        event.listen(engine, 'after_cursor_execute', self._depois_sql)
+
+    # exportação ------------------------------------------------------------
+
+    def texto_prometheus(self):
+        with self._lock:
+            linhas = [
+                '# HELP biblioteca_requisicao_segundos Latência das requisições por rota.',
+                '# TYPE biblioteca_requisicao_segundos histogram',
+            ]
+            for (rota, metodo), histograma in sorted(self.latencia.items()):
+                linhas.extend(histograma.linhas('biblioteca_requisicao_segundos', _rotulos(rota=rota, metodo=metodo)))
+            linhas += [
+                '# HELP biblioteca_respostas_total Respostas por rota e status.',
+                '# TYPE biblioteca_respostas_total counter',
+            ]
+            for (rota, metodo, status), total in sorted(self.respostas.items()):
+                linhas.append('biblioteca_respostas_total{%s} %d' % (
+                    _rotulos(rota=rota, metodo=metodo, status=status).rstrip(','), total))
+            linhas += [
+                '# HELP biblioteca_requisicoes_em_andamento Requisições sendo atendidas agora.',
+                '# TYPE biblioteca_requisicoes_em_andamento gauge',
+                'biblioteca_requisicoes_em_andamento %d' % self.em_andamento,
+                '# HELP biblioteca_sql_por_requisicao Comandos SQL executados por requisição.',
+                '# TYPE biblioteca_sql_por_requisicao histogram',
+            ]
+            for (rota, metodo), histograma in sorted(self.sql_por_requisicao.items()):
+                linhas.extend(histograma.linhas('biblioteca_sql_por_requisicao', _rotulos(rota=rota, metodo=metodo)))
+            linhas += [
+                '# HELP biblioteca_sql_total Comandos SQL executados.',
+                '# TYPE biblioteca_sql_total counter',
+                'biblioteca_sql_total %d' % self.sql_total,
+                '# HELP biblioteca_sql_segundos Duração dos comandos SQL.',
+                '# TYPE biblioteca_sql_segundos histogram',
+            ]
+            linhas.extend(self.sql_segundos.linhas('biblioteca_sql_segundos', ''))
+            linhas += [
+                '# HELP biblioteca_sql_lentos_total Comandos SQL acima de %s ms.' % SQL_LENTO_MS,
+                '# TYPE biblioteca_sql_lentos_total counter',
+                'biblioteca_sql_lentos_total %d' % self.sql_lentos,
+            ]
+        for coletor in self._coletores:
+            linhas.extend(coletor())
+        return '\n'.join(linhas) + '\n'
+
+    def resposta(self):
+        return Response(self.texto_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+metricas = Metricas()
@@ -0,0 +1,382 @@
+"""
+Migrações versionadas do schema.
+
+Cada migração tem um número, um nome e uma função que recebe a conexão. As
+aplicadas ficam registradas na tabela VERSAO_SCHEMA, então cada uma roda
+uma única vez por banco. Importar models não cria nada: o schema é criado
+e atualizado por "flask migrar" (ou "python migracoes.py"), de preferência
+antes de subir os workers.
+
+Cada migração roda na sua própria transação, aberta com BEGIN IMMEDIATE:
+processos que migram ao mesmo tempo esperam o lock de escrita e, ao
+pegá-lo, releem a tabela de versões, então nenhuma migração roda duas
+vezes. As migrações também são idempotentes (IF NOT EXISTS, checkfirst,
+coluna só se faltar), porque os bancos criados antes desta tabela já têm
+parte do schema.
+
+Para mudar o schema, acrescente uma migração com o próximo número no fim
+da lista; nunca altere uma que já foi aplicada. Colunas novas entram
+anuláveis (ALTER TABLE ADD COLUMN) e índices com CREATE INDEX, sem
+recriar o banco. As migrações têm o próprio DDL, com nomes fixos, e não
+leem os modelos: a migração de um modelo alterado é uma migração nova.
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import inspect
+
+from cache import criar_gatilhos_modificacoes
+from estatisticas import reconstruir_estatisticas
+from eventos import criar_gatilhos_eventos
+from models import engine, FORMATO_CODIGO_BARRAS, reconstruir_busca_livros, reconstruir_contadores_exemplares
+
+TABELA_VERSAO = 'VERSAO_SCHEMA'
+
+logger = logging.getLogger('biblioteca.migracoes')
+
+MIGRACOES = []
+
+
+def migracao(numero, nome):
+    """Registra a função decorada como a migração "numero"."""
+    def registrar(funcao):
+        if MIGRACOES and numero <= MIGRACOES[-1][0]:
+            raise ValueError('migração %d fora de ordem' % numero)
+        MIGRACOES.append((numero, nome, funcao))
+        return funcao
+    return registrar
+
+
+# ---------------------------------------------------------------------------
+# utilitários das migrações
+
+def executar_ddl(conexao, comandos):
+    """Executa os comandos separados por ";" (não serve para triggers, que têm ";" no corpo)."""
+    for comando in comandos.split(';'):
+        if comando.strip():
+            conexao.exec_driver_sql(comando)
+
+
+def criar_tabela(conexao, tabela, ddl):
+    """Cria a tabela e os índices dela, se a tabela ainda não existir."""
+    if not inspect(conexao).has_table(tabela):
+        executar_ddl(conexao, ddl)
+
+
+def adicionar_coluna(conexao, tabela, coluna, definicao):
+    """ALTER TABLE ADD COLUMN, se a coluna ainda não existir (NOT NULL só com DEFAULT)."""
+    existentes = {c['name'] for c in inspect(conexao).get_columns(tabela)}
+    if coluna not in existentes:
+        conexao.exec_driver_sql('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (tabela, coluna, definicao))
+
+
+# ---------------------------------------------------------------------------
+# migrações
+#
+# O DDL fica escrito aqui, como era quando cada migração foi criada, e não é
+# lido dos modelos: se fosse, mudar um modelo mudaria o que as migrações
+# antigas fazem, e um banco novo passaria por passos diferentes de um banco
+# atualizado.
+
+DDL_USERS = """
+CREATE TABLE users (
+    id INTEGER NOT NULL,
+    nome VARCHAR NOT NULL,
+    email VARCHAR NOT NULL,
+    senha_hash VARCHAR NOT NULL,
+    papel VARCHAR NOT NULL,
+    PRIMARY KEY (id)
+)"""
+
+DDL_LIVROS = """
+CREATE TABLE "LIVROS" (
+    id_livro INTEGER NOT NULL,
+    titulo VARCHAR(40) NOT NULL,
+    autor VARCHAR(30) NOT NULL,
+    "ISBN" INTEGER NOT NULL,
+    resumo VARCHAR(200) NOT NULL,
+    PRIMARY KEY (id_livro)
+);
+CREATE INDEX "ix_LIVROS_ISBN" ON "LIVROS" ("ISBN");
+CREATE INDEX "ix_LIVROS_autor" ON "LIVROS" (autor);
+CREATE INDEX "ix_LIVROS_resumo" ON "LIVROS" (resumo);
+CREATE UNIQUE INDEX "ix_LIVROS_titulo" ON "LIVROS" (titulo)"""
+
+DDL_USUARIOS = """
+CREATE TABLE "USUARIOS" (
+    id_usuario INTEGER NOT NULL,
+    nome VARCHAR(40) NOT NULL,
+    "CPF" VARCHAR(11) NOT NULL,
+    endereco VARCHAR(50) NOT NULL,
+    PRIMARY KEY (id_usuario)
+);
+CREATE UNIQUE INDEX "ix_USUARIOS_CPF" ON "USUARIOS" ("CPF");
+CREATE INDEX "ix_USUARIOS_endereco" ON "USUARIOS" (endereco);
+CREATE INDEX "ix_USUARIOS_nome" ON "USUARIOS" (nome)"""
+
+# índices dos empréstimos criados pela migração 3 (e pela 1, num banco novo)
+DDL_INDICES_EMPRESTIMOS = """
+CREATE INDEX IF NOT EXISTS "ix_EMPRÉSTIMOS_ativos" ON "EMPRÉSTIMOS" (id_emprestimo) WHERE returned_at IS NULL;
+CREATE INDEX IF NOT EXISTS "ix_EMPRÉSTIMOS_ativos_livro" ON "EMPRÉSTIMOS" (id_livro) WHERE returned_at IS NULL;
+CREATE INDEX IF NOT EXISTS "ix_EMPRÉSTIMOS_ativos_devolucao_usuario" ON "EMPRÉSTIMOS" (data_devolucao, id_usuario)
+    WHERE returned_at IS NULL;
+CREATE INDEX IF NOT EXISTS "ix_EMPRÉSTIMOS_usuario_data" ON "EMPRÉSTIMOS" (id_usuario, data_emprestimo);
+CREATE INDEX IF NOT EXISTS "ix_EMPRÉSTIMOS_livro_data" ON "EMPRÉSTIMOS" (id_livro, data_emprestimo);
+CREATE INDEX IF NOT EXISTS "ix_EMPRÉSTIMOS_data_emprestimo" ON "EMPRÉSTIMOS" (data_emprestimo)"""
+
+DDL_EMPRESTIMOS = """
+CREATE TABLE "EMPRÉSTIMOS" (
+    id_emprestimo INTEGER NOT NULL,
+    data_emprestimo DATE NOT NULL,
+    data_devolucao DATE NOT NULL,
+    returned_at DATETIME,
+    id_usuario INTEGER,
+    id_livro INTEGER,
+    PRIMARY KEY (id_emprestimo),
+    FOREIGN KEY(id_usuario) REFERENCES "USUARIOS" (id_usuario),
+    FOREIGN KEY(id_livro) REFERENCES "LIVROS" (id_livro)
+);""" + DDL_INDICES_EMPRESTIMOS
+
+DDL_ESTATISTICAS = {
+    'ESTATISTICAS_LIVROS': """
+CREATE TABLE "ESTATISTICAS_LIVROS" (
+    id_livro INTEGER NOT NULL,
+    emprestimos INTEGER NOT NULL,
+    devolucoes INTEGER NOT NULL,
+    PRIMARY KEY (id_livro)
+);
+CREATE INDEX "ix_ESTATISTICAS_LIVROS_ranking" ON "ESTATISTICAS_LIVROS" (emprestimos, id_livro)""",
+    'ESTATISTICAS_USUARIOS': """
+CREATE TABLE "ESTATISTICAS_USUARIOS" (
+    id_usuario INTEGER NOT NULL,
+    emprestimos INTEGER NOT NULL,
+    devolucoes INTEGER NOT NULL,
+    PRIMARY KEY (id_usuario)
+);
+CREATE INDEX "ix_ESTATISTICAS_USUARIOS_ranking" ON "ESTATISTICAS_USUARIOS" (emprestimos, id_usuario)""",
+    'ESTATISTICAS_AUTORES': """
+CREATE TABLE "ESTATISTICAS_AUTORES" (
+    autor VARCHAR(30) NOT NULL,
+    emprestimos INTEGER NOT NULL,
+    devolucoes INTEGER NOT NULL,
+    PRIMARY KEY (autor)
+);
+CREATE INDEX "ix_ESTATISTICAS_AUTORES_ranking" ON "ESTATISTICAS_AUTORES" (emprestimos, autor)""",
+    'ESTATISTICAS_MESES': """
+CREATE TABLE "ESTATISTICAS_MESES" (
+    mes VARCHAR(7) NOT NULL,
+    emprestimos INTEGER NOT NULL,
+    devolucoes INTEGER NOT NULL,
+    PRIMARY KEY (mes)
+)""",
+}
+
+DDL_EXEMPLARES = """
+CREATE TABLE "EXEMPLARES" (
+    id_exemplar INTEGER NOT NULL,
+    id_livro INTEGER NOT NULL,
+    codigo_barras VARCHAR(30) NOT NULL,
+    PRIMARY KEY (id_exemplar),
+    FOREIGN KEY(id_livro) REFERENCES "LIVROS" (id_livro),
+    UNIQUE (codigo_barras)
+);
+CREATE INDEX "ix_EXEMPLARES_id_livro" ON "EXEMPLARES" (id_livro)"""
+
+DDL_RESPOSTAS_IDEMPOTENTES = """
+CREATE TABLE "RESPOSTAS_IDEMPOTENTES" (
+    rota VARCHAR(100) NOT NULL,
+    chave VARCHAR(255) NOT NULL,
+    impressao VARCHAR(64) NOT NULL,
+    status INTEGER NOT NULL,
+    corpo BLOB NOT NULL,
+    tipo VARCHAR(100),
+    expira_em FLOAT NOT NULL,
+    PRIMARY KEY (rota, chave)
+);
+CREATE INDEX "ix_RESPOSTAS_IDEMPOTENTES_expira_em" ON "RESPOSTAS_IDEMPOTENTES" (expira_em)"""
+
+DDL_EVENTOS = """
+CREATE TABLE "EVENTOS" (
+    id_evento INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    tipo VARCHAR(30) NOT NULL,
+    id_livro INTEGER,
+    id_exemplar INTEGER,
+    id_emprestimo INTEGER,
+    disponiveis INTEGER,
+    criado_em VARCHAR(26) DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')) NOT NULL
+)"""
+
+
+@migracao(1, 'tabelas_iniciais')
+def tabelas_iniciais(conexao):
+    criar_tabela(conexao, 'users', DDL_USERS)
+    criar_tabela(conexao, 'LIVROS', DDL_LIVROS)
+    criar_tabela(conexao, 'USUARIOS', DDL_USUARIOS)
+    criar_tabela(conexao, 'EMPRÉSTIMOS', DDL_EMPRESTIMOS)
+
+
+@migracao(2, 'emprestimos_returned_at')
+def emprestimos_returned_at(conexao):
+    # devolução passou a guardar a data em vez de apagar o empréstimo
+    adicionar_coluna(conexao, 'EMPRÉSTIMOS', 'returned_at', 'DATETIME')
+
+
+@migracao(3, 'indices_parciais_emprestimos')
+def indices_parciais_emprestimos(conexao):
+    # substituídos pelos índices parciais/compostos de Emprestimo
+    for nome in ('ix_EMPRÉSTIMOS_id_livro', 'ix_EMPRÉSTIMOS_data_devolucao', 'ix_EMPRÉSTIMOS_devolucao_usuario'):
+        conexao.exec_driver_sql('DROP INDEX IF EXISTS "%s"' % nome)
+    executar_ddl(conexao, DDL_INDICES_EMPRESTIMOS)
+
+
+@migracao(4, 'busca_livros')
+def busca_livros(conexao):
+    # cria a tabela FTS e os triggers e indexa os livros que já existem
+    if not inspect(conexao).has_table('LIVROS_FTS'):
+        reconstruir_busca_livros(conexao)
+
+
+@migracao(5, 'estatisticas_circulacao')
+def estatisticas_circulacao(conexao):
+    # tabelas de resumo + triggers, preenchidas com o histórico que já existe
+    for tabela, ddl in DDL_ESTATISTICAS.items():
+        criar_tabela(conexao, tabela, ddl)
+    reconstruir_estatisticas(conexao)
+
+@migracao(6, 'emprestimo_unico_por_livro')
+def emprestimo_unico_por_livro(conexao):
+    # antes não havia verificação e o mesmo livro podia ficar emprestado duas
+    # vezes. Fica valendo o empréstimo mais antigo; os outros são encerrados
+    # na própria data do empréstimo, sem apagar o histórico.
+    duplicados = conexao.exec_driver_sql("""
+        UPDATE "EMPRÉSTIMOS" SET returned_at = data_emprestimo || ' 00:00:00.000000'
+        WHERE returned_at IS NULL AND id_emprestimo NOT IN (
+            SELECT min(id_emprestimo) FROM "EMPRÉSTIMOS" WHERE returned_at IS NULL GROUP BY id_livro
+        )""").rowcount
+    if duplicados:
+        logger.warning('%d empréstimo(s) em aberto duplicado(s) encerrado(s) antes de criar o índice único',
+                       duplicados)
+    conexao.exec_driver_sql('DROP INDEX IF EXISTS "ix_EMPRÉSTIMOS_ativos_livro"')
+    conexao.exec_driver_sql('CREATE UNIQUE INDEX IF NOT EXISTS "ux_EMPRÉSTIMOS_livro_em_aberto" '
+                            'ON "EMPRÉSTIMOS" (id_livro) WHERE returned_at IS NULL')
+
+
+@migracao(7, 'exemplares')
+def exemplares(conexao):
+    # cada livro ganha um exemplar, e os empréstimos (inclusive o histórico)
+    # passam a apontar para ele; a unicidade do empréstimo em aberto passa do
+    # livro para o exemplar
+    adicionar_coluna(conexao, 'LIVROS', 'exemplares_total', 'INTEGER DEFAULT 0 NOT NULL')
+    adicionar_coluna(conexao, 'LIVROS', 'exemplares_disponiveis', 'INTEGER DEFAULT 0 NOT NULL')
+    criar_tabela(conexao, 'EXEMPLARES', DDL_EXEMPLARES)
+    adicionar_coluna(conexao, 'EMPRÉSTIMOS', 'id_exemplar', 'INTEGER')
+    conexao.exec_driver_sql('''
+        INSERT INTO "EXEMPLARES" (id_livro, codigo_barras)
+        SELECT id_livro, printf('%s', id_livro, 1) FROM "LIVROS" l
+        WHERE NOT EXISTS (SELECT 1 FROM "EXEMPLARES" e WHERE e.id_livro = l.id_livro)''' % FORMATO_CODIGO_BARRAS)
+    conexao.exec_driver_sql('''
+        UPDATE "EMPRÉSTIMOS" SET id_exemplar = (
+            SELECT min(id_exemplar) FROM "EXEMPLARES" e WHERE e.id_livro = "EMPRÉSTIMOS".id_livro
+        ) WHERE id_exemplar IS NULL''')
+    conexao.exec_driver_sql('DROP INDEX IF EXISTS "ux_EMPRÉSTIMOS_livro_em_aberto"')
+    executar_ddl(conexao, '''
+        CREATE UNIQUE INDEX IF NOT EXISTS "ux_EMPRÉSTIMOS_exemplar_em_aberto" ON "EMPRÉSTIMOS" (id_exemplar)
+            WHERE returned_at IS NULL;
+        CREATE INDEX IF NOT EXISTS "ix_EMPRÉSTIMOS_ativos_livro" ON "EMPRÉSTIMOS" (id_livro)
+            WHERE returned_at IS NULL''')
+    # triggers dos contadores + contagem dos exemplares que já existem
+    reconstruir_contadores_exemplares(conexao)
+
+
+@migracao(8, 'respostas_idempotentes')
+def respostas_idempotentes(conexao):
+    # usada só com BIBLIOTECA_IDEMPOTENCIA_BANCO=1, mas criada sempre
+    criar_tabela(conexao, 'RESPOSTAS_IDEMPOTENTES', DDL_RESPOSTAS_IDEMPOTENTES)
+
+
+@migracao(9, 'eventos')
+def eventos(conexao):
+    # feed do /eventos: começa vazio, só com as mudanças daqui em diante
+    criar_tabela(conexao, 'EVENTOS', DDL_EVENTOS)
+    criar_gatilhos_eventos(conexao)
+
+
+@migracao(10, 'versao_token_usuarios')
+def versao_token_usuarios(conexao):
+    # revogação de tokens no banco, vista por todos os workers e mantida
+    # depois de reiniciar; o email indexado é a leitura de cada requisição
+    # autenticada
+    adicionar_coluna(conexao, 'users', 'versao_token', 'INTEGER DEFAULT 0 NOT NULL')
+    conexao.exec_driver_sql('CREATE INDEX IF NOT EXISTS "ix_users_email" ON users (email)')
+    conexao.exec_driver_sql('''
+        CREATE TRIGGER IF NOT EXISTS "users_versao_token_au" AFTER UPDATE OF papel, senha_hash, email ON users
+        WHEN old.papel IS NOT new.papel OR old.senha_hash IS NOT new.senha_hash OR old.email IS NOT new.email
+        BEGIN
+            UPDATE users SET versao_token = versao_token + 1 WHERE id = new.id;
+        END''')
+
+
+@migracao(11, 'modificacoes')
+def modificacoes(conexao):
+    # instante da última escrita em cada tabela do catálogo, para o
+    # Last-Modified e a chave do cache valerem entre workers
+    criar_tabela(conexao, 'MODIFICACOES', """
+        CREATE TABLE "MODIFICACOES" (
+            tabela VARCHAR(30) NOT NULL,
+            modificado_em FLOAT NOT NULL,
+            PRIMARY KEY (tabela)
+        )""")
+    criar_gatilhos_modificacoes(conexao)
+
+
+# ---------------------------------------------------------------------------
+# execução
+
+def versoes_aplicadas(conexao):
+    if not inspect(conexao).has_table(TABELA_VERSAO):
+        return set()
+    return {versao for (versao,) in conexao.exec_driver_sql('SELECT versao FROM "%s"' % TABELA_VERSAO)}
+
+
+def pendentes(engine_alvo=None):
+    """Migrações ainda não aplicadas no banco, em ordem."""
+    with (engine_alvo or engine).connect() as conexao:
+        aplicadas = versoes_aplicadas(conexao)
+    return [(numero, nome) for numero, nome, _ in MIGRACOES if numero not in aplicadas]
+
+
+def migrar(engine_alvo=None, ate=None):
+    """
+    Aplica as migrações pendentes (até a versão "ate", se informada) e
+    devolve a lista de (numero, nome) aplicados agora. Com o banco em dia
+    só lê a tabela de versões, sem pegar o lock de escrita.
+    """
+    engine_alvo = engine_alvo or engine
+    with engine_alvo.connect() as conexao:
+        aplicadas = versoes_aplicadas(conexao)
+    aplicadas_agora = []
+    for numero, nome, funcao in MIGRACOES:
+        if numero in aplicadas:
+            continue
+        if ate is not None and numero > ate:
+            break
+        with engine_alvo.connect() as conexao:
+            conexao.exec_driver_sql('BEGIN IMMEDIATE')
+            conexao.exec_driver_sql(
+                'CREATE TABLE IF NOT EXISTS "%s" ('
+                'versao INTEGER PRIMARY KEY, nome VARCHAR NOT NULL, aplicada_em DATETIME NOT NULL)' % TABELA_VERSAO)
+            # outro processo pode ter aplicado enquanto esperávamos o lock
+            if numero in versoes_aplicadas(conexao):
+                conexao.rollback()
+                continue
+            funcao(conexao)
+            conexao.exec_driver_sql('INSERT INTO "%s" (versao, nome, aplicada_em) VALUES (?, ?, ?)' % TABELA_VERSAO,
+                                    (numero, nome, datetime.now().isoformat(sep=' ', timespec='seconds')))
+            conexao.commit()
+        aplicadas_agora.append((numero, nome))
+    return aplicadas_agora
+
+
+if __name__ == '__main__':
+    for numero, nome in migrar():
+        print('migração %d aplicada: %s' % (numero, nome))
@@ -1,10 +1,78 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Date, DateTime, Float
+import os
+from datetime import datetime
+
+from sqlalchemy import create_engine, event, inspect, text, Index, Column, Integer, String, ForeignKey, Date, DateTime, Float
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship
 from sqlalchemy.orm import sessionmaker, declarative_base
-from werkzeug.security import generate_password_hash, check_password_hash
-
-engine = create_engine('sqlite:///Biblioteca')
+from cache import incrementar_versao
+from senhas import gerar_hash, verificar_senha, precisa_rehash
+
+# Perfil do SQLite, configurável por variáveis de ambiente.
+# WAL deixa as leituras rodarem em paralelo com a escrita; o busy_timeout
+# faz a conexão esperar pelo lock em vez de falhar com "database is locked".
+DATABASE_URL = os.environ.get('BIBLIOTECA_DB_URL', 'sqlite:///Biblioteca')
+PERFIL_ENGINE = {
+    'journal_mode': os.environ.get('BIBLIOTECA_SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('BIBLIOTECA_SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.environ.get('BIBLIOTECA_SQLITE_BUSY_TIMEOUT', 5000)),  # ms
+    'mmap_size': int(os.environ.get('BIBLIOTECA_SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),  # bytes
+    'cache_size': int(os.environ.get('BIBLIOTECA_SQLITE_CACHE_SIZE', -64000)),  # negativo = KiB
+    # uma única conexão de escrita: as escritas são serializadas no pool
+    # em vez de disputarem o lock do arquivo
+    'pool_escrita': int(os.environ.get('BIBLIOTECA_POOL_ESCRITA', 1)),
+    'pool_leitura': int(os.environ.get('BIBLIOTECA_POOL_LEITURA', 8)),
+    'pool_overflow_leitura': int(os.environ.get('BIBLIOTECA_POOL_OVERFLOW_LEITURA', 8)),
+    'pool_timeout': float(os.environ.get('BIBLIOTECA_POOL_TIMEOUT', 30)),
+}
+
+
+def criar_engine(url=DATABASE_URL, somente_leitura=False, perfil=PERFIL_ENGINE, assincrona=False):
+    """
+    Cria a engine aplicando os pragmas do perfil a cada nova conexão.
+
+    Com "somente_leitura" o arquivo é aberto com mode=ro, então a conexão
+    nunca pega o lock de escrita. Com "assincrona" devolve uma AsyncEngine
+    do SQLAlchemy sobre o aiosqlite (usada pelo app_async.py), com o mesmo
+    perfil.
+    """
+    url = make_url(url)
+    if somente_leitura and url.database and url.database != ':memory:':
+        url = url.set(database='file:' + url.database, query={**url.query, 'mode': 'ro', 'uri': 'true'})
+
+    if somente_leitura:
+        opcoes_pool = {'pool_size': perfil['pool_leitura'], 'max_overflow': perfil['pool_overflow_leitura']}
+    else:
+        opcoes_pool = {'pool_size': perfil['pool_escrita'], 'max_overflow': 0}
+    if assincrona:
+        from sqlalchemy.ext.asyncio import create_async_engine
+        nova_engine = create_async_engine(url.set(drivername='sqlite+aiosqlite'),
+                                          pool_timeout=perfil['pool_timeout'], **opcoes_pool)
+        engine_sincrona = nova_engine.sync_engine
+    else:
+        nova_engine = engine_sincrona = create_engine(url, pool_timeout=perfil['pool_timeout'], **opcoes_pool)
+
+    @event.listens_for(engine_sincrona, 'connect')
+    def aplicar_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not somente_leitura:
+            # o journal_mode fica gravado no arquivo; só a conexão de escrita pode mudá-lo
+            cursor.execute('PRAGMA journal_mode=%s' % perfil['journal_mode'])
+        cursor.execute('PRAGMA synchronous=%s' % perfil['synchronous'])
+        cursor.execute('PRAGMA busy_timeout=%d' % perfil['busy_timeout'])
+        cursor.execute('PRAGMA mmap_size=%d' % perfil['mmap_size'])
+        cursor.execute('PRAGMA cache_size=%d' % perfil['cache_size'])
+        cursor.close()
+
+    return nova_engine
+
+
+engine = criar_engine()
 db_session = scoped_session(sessionmaker(bind=engine))
+
+# usada pelas rotas GET: várias conexões só de leitura em paralelo
+engine_leitura = criar_engine(somente_leitura=True)
+db_session_leitura = scoped_session(sessionmaker(bind=engine_leitura))
 Base = declarative_base()
 Base.query = db_session.query_property()
 
@@ -12,15 +80,21 @@ class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
     nome = Column(String, nullable=False)
-    email = Column(String, nullable=False)
+    email = Column(String, nullable=False, index=True)
     senha_hash = Column(String, nullable=False) #senha com proteção
     papel = Column(String, nullable=False) #cargo das pessoas
+    # vai na claim "ver" do token; um trigger soma 1 quando papel, senha ou
+    # email mudam, e os tokens emitidos antes deixam de valer (autorizacao.py)
+    versao_token = Column(Integer, nullable=False, default=0, server_default=text('0'))
 
     def set_senha_hash(self, senha):
-        self.senha_hash = generate_password_hash(senha)
+        self.senha_hash = gerar_hash(senha)
 
     def check_password(self, senha):
-        return check_password_hash(self.senha_hash, senha)
+        return verificar_senha(self.senha_hash, senha)
+
+    def precisa_rehash(self):
+        return precisa_rehash(self.senha_hash)
 
     def serialize(self):
         dados = {
@@ -39,6 +113,10 @@ class Livro(Base):
     autor = Column(String(30), nullable=False, index=True)
     ISBN = Column(Integer, nullable=False, index=True)
     resumo = Column(String(200), nullable=False, index=True)
+    # contadores de EXEMPLARES mantidos pelos triggers de GATILHOS_EXEMPLARES:
+    # a disponibilidade do título é uma leitura da própria linha
+    exemplares_total = Column(Integer, nullable=False, default=0, server_default=text('0'))
+    exemplares_disponiveis = Column(Integer, nullable=False, default=0, server_default=text('0'))
 
     def __repr__(self):
         return '<Livro: {} {} {} {} {}'.format(self.id_livro, self.titulo, self.autor, self.ISBN, self.resumo)
@@ -46,10 +124,12 @@ class Livro(Base):
     def save(self):
         db_session.add(self)
         db_session.commit()
+        incrementar_versao(self.__tablename__)
 
     def delete(self):
         db_session.delete(self)
         db_session.commit()
+        incrementar_versao(self.__tablename__)
 
     def update(self, titulo=None, autor=None, ISBN=None, resumo=None):
         if titulo:
@@ -61,15 +141,149 @@ class Livro(Base):
         if resumo:
             self.resumo = resumo
         db_session.commit()
+        incrementar_versao(self.__tablename__)
 
     def serialize_livro(self):
         return {
             "titulo": self.titulo,
             "autor": self.autor,
             "isbn": self.ISBN,
-            "resumo": self.resumo
+            "resumo": self.resumo,
+            "exemplares": self.exemplares_total,
+            "disponiveis": self.exemplares_disponiveis,
         }
 
+
+# código de barras dado aos exemplares cadastrados sem um: id do livro e
+# número do exemplar (o mesmo formato serve para o printf do SQLite)
+FORMATO_CODIGO_BARRAS = 'L%07d-%02d'
+
+
+class Exemplar(Base):
+    """Cópia física de um Livro; os empréstimos apontam para o exemplar."""
+    __tablename__ = 'EXEMPLARES'
+    id_exemplar = Column(Integer, primary_key=True)
+    id_livro = Column(Integer, ForeignKey('LIVROS.id_livro'), nullable=False, index=True)
+    codigo_barras = Column(String(30), nullable=False, unique=True)
+    livro = relationship('Livro')
+
+    def __repr__(self):
+        return '<Exemplar: {} {} {}>'.format(self.id_exemplar, self.id_livro, self.codigo_barras)
+
+    def serialize_exemplar(self):
+        return {
+            "id_exemplar": self.id_exemplar,
+            "livro": self.id_livro,
+            "codigo_barras": self.codigo_barras,
+        }
+
+# Busca textual (FTS5) sobre titulo, autor e resumo.
+# A tabela virtual usa LIVROS como conteúdo externo e é mantida pelos
+# triggers abaixo, então qualquer escrita em LIVROS (inclusive em lote)
+# atualiza o índice na mesma transação.
+DDL_BUSCA_LIVROS = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS "LIVROS_FTS" USING fts5(
+        titulo, autor, resumo,
+        content='LIVROS', content_rowid='id_livro',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS "LIVROS_FTS_ai" AFTER INSERT ON "LIVROS" BEGIN
+        INSERT INTO "LIVROS_FTS"(rowid, titulo, autor, resumo)
+        VALUES (new.id_livro, new.titulo, new.autor, new.resumo);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "LIVROS_FTS_ad" AFTER DELETE ON "LIVROS" BEGIN
+        INSERT INTO "LIVROS_FTS"("LIVROS_FTS", rowid, titulo, autor, resumo)
+        VALUES ('delete', old.id_livro, old.titulo, old.autor, old.resumo);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "LIVROS_FTS_au" AFTER UPDATE OF titulo, autor, resumo ON "LIVROS" BEGIN
+        INSERT INTO "LIVROS_FTS"("LIVROS_FTS", rowid, titulo, autor, resumo)
+        VALUES ('delete', old.id_livro, old.titulo, old.autor, old.resumo);
+        INSERT INTO "LIVROS_FTS"(rowid, titulo, autor, resumo)
+        VALUES (new.id_livro, new.titulo, new.autor, new.resumo);
+    END""",
+    # ranking padrão (coluna "rank"): bm25 com título > autor > resumo
+    """INSERT INTO "LIVROS_FTS"("LIVROS_FTS", rank) VALUES ('rank', 'bm25(10.0, 5.0, 1.0)')""",
+]
+
+
+# Contadores de exemplares em LIVROS, na mesma transação de cada escrita em
+# EXEMPLARES ou EMPRÉSTIMOS (ORM, lotes com Core, app_async ou direto no banco).
+# Um exemplar está disponível enquanto não tem empréstimo em aberto; o índice
+# único de Emprestimo garante no máximo um por exemplar.
+_DISPONIVEL = ('NOT EXISTS (SELECT 1 FROM "EMPRÉSTIMOS" WHERE id_exemplar = %s.id_exemplar '
+               'AND returned_at IS NULL)')
+_LIVRO_DO_EXEMPLAR = '(SELECT id_livro FROM "EXEMPLARES" WHERE id_exemplar = %s.id_exemplar)'
+
+GATILHOS_EXEMPLARES = {
+    'EXEMPLARES_ai': """AFTER INSERT ON "EXEMPLARES" BEGIN
+        UPDATE "LIVROS" SET exemplares_total = exemplares_total + 1,
+            exemplares_disponiveis = exemplares_disponiveis + %s
+        WHERE id_livro = new.id_livro;
+    END""" % (_DISPONIVEL % 'new'),
+    'EXEMPLARES_ad': """AFTER DELETE ON "EXEMPLARES" BEGIN
+        UPDATE "LIVROS" SET exemplares_total = exemplares_total - 1,
+            exemplares_disponiveis = exemplares_disponiveis - %s
+        WHERE id_livro = old.id_livro;
+    END""" % (_DISPONIVEL % 'old'),
+    'EXEMPLARES_au': """AFTER UPDATE OF id_livro ON "EXEMPLARES" WHEN old.id_livro IS NOT new.id_livro BEGIN
+        UPDATE "LIVROS" SET exemplares_total = exemplares_total - 1,
+            exemplares_disponiveis = exemplares_disponiveis - %s
+        WHERE id_livro = old.id_livro;
+        UPDATE "LIVROS" SET exemplares_total = exemplares_total + 1,
+            exemplares_disponiveis = exemplares_disponiveis + %s
+        WHERE id_livro = new.id_livro;
+    END""" % (_DISPONIVEL % 'new', _DISPONIVEL % 'new'),
+    'EXEMPLARES_emprestimo_ai': """AFTER INSERT ON "EMPRÉSTIMOS"
+    WHEN new.returned_at IS NULL AND new.id_exemplar IS NOT NULL BEGIN
+        UPDATE "LIVROS" SET exemplares_disponiveis = exemplares_disponiveis - 1
+        WHERE id_livro = %s;
+    END""" % (_LIVRO_DO_EXEMPLAR % 'new'),
+    'EXEMPLARES_emprestimo_ad': """AFTER DELETE ON "EMPRÉSTIMOS"
+    WHEN old.returned_at IS NULL AND old.id_exemplar IS NOT NULL BEGIN
+        UPDATE "LIVROS" SET exemplares_disponiveis = exemplares_disponiveis + 1
+        WHERE id_livro = %s;
+    END""" % (_LIVRO_DO_EXEMPLAR % 'old'),
+    'EXEMPLARES_emprestimo_au': """AFTER UPDATE OF returned_at, id_exemplar ON "EMPRÉSTIMOS"
+    WHEN (old.returned_at IS NULL) IS NOT (new.returned_at IS NULL) OR old.id_exemplar IS NOT new.id_exemplar BEGIN
+        UPDATE "LIVROS" SET exemplares_disponiveis = exemplares_disponiveis + 1
+        WHERE old.returned_at IS NULL AND id_livro = %s;
+        UPDATE "LIVROS" SET exemplares_disponiveis = exemplares_disponiveis - 1
+        WHERE new.returned_at IS NULL AND id_livro = %s;
+    END""" % (_LIVRO_DO_EXEMPLAR % 'old', _LIVRO_DO_EXEMPLAR % 'new'),
+}
+
+
+def reconstruir_contadores_exemplares(conexao=None):
+    """Recalcula os contadores de LIVROS a partir de EXEMPLARES (e recria os triggers, se faltarem)."""
+    if conexao is None:
+        with engine.begin() as conexao:
+            return reconstruir_contadores_exemplares(conexao)
+    for nome, ddl in GATILHOS_EXEMPLARES.items():
+        conexao.exec_driver_sql('CREATE TRIGGER IF NOT EXISTS "%s" %s' % (nome, ddl))
+    conexao.exec_driver_sql(
+        'UPDATE "LIVROS" SET exemplares_total = 0, exemplares_disponiveis = 0 '
+        'WHERE exemplares_total <> 0 OR exemplares_disponiveis <> 0')
+    conexao.exec_driver_sql("""
+        UPDATE "LIVROS" SET exemplares_total = c.total, exemplares_disponiveis = c.disponiveis
+        FROM (SELECT e.id_livro, count(*) AS total, sum(%s) AS disponiveis
+              FROM "EXEMPLARES" e GROUP BY e.id_livro) AS c
+        WHERE c.id_livro = "LIVROS".id_livro""" % (_DISPONIVEL % 'e'))
+
+
+def criar_busca_livros(conexao):
+    for ddl in DDL_BUSCA_LIVROS:
+        conexao.exec_driver_sql(ddl)
+
+
+def reconstruir_busca_livros(conexao=None):
+    """Recria o índice de busca a partir do conteúdo atual de LIVROS."""
+    if conexao is None:
+        with engine.begin() as conexao:
+            return reconstruir_busca_livros(conexao)
+    criar_busca_livros(conexao)
+    conexao.exec_driver_sql("""INSERT INTO "LIVROS_FTS"("LIVROS_FTS") VALUES ('rebuild')""")
+
+
 class Usuario(Base):
     __tablename__ = 'USUARIOS'
     id_usuario = Column(Integer, primary_key=True)
@@ -83,10 +297,12 @@ class Usuario(Base):
     def save(self):
         db_session.add(self)
         db_session.commit()
+        incrementar_versao(self.__tablename__)
 
     def delete(self):
         db_session.delete(self)
         db_session.commit()
+        incrementar_versao(self.__tablename__)
 
     def update(self, nome=None, CPF=None, endereco=None):
         if nome:
@@ -96,6 +312,7 @@ class Usuario(Base):
         if endereco:
             self.endereco = endereco
         db_session.commit()
+        incrementar_versao(self.__tablename__)
 
     def serialize_usuario(self):
         return {
@@ -106,14 +323,34 @@ class Usuario(Base):
 
 class Emprestimo(Base):
     __tablename__ = 'EMPRÉSTIMOS'
+    __table_args__ = (
+        # índices parciais: só têm os empréstimos em aberto, então continuam
+        # pequenos enquanto o histórico cresce
+        Index('ix_EMPRÉSTIMOS_ativos', 'id_emprestimo', sqlite_where=text('returned_at IS NULL')),
+        # no máximo um empréstimo em aberto por exemplar: o banco recusa o
+        # segundo, sem depender de consultar antes de inserir
+        Index('ux_EMPRÉSTIMOS_exemplar_em_aberto', 'id_exemplar', unique=True,
+              sqlite_where=text('returned_at IS NULL')),
+        Index('ix_EMPRÉSTIMOS_ativos_livro', 'id_livro', sqlite_where=text('returned_at IS NULL')),
+        Index('ix_EMPRÉSTIMOS_ativos_devolucao_usuario', 'data_devolucao', 'id_usuario',
+              sqlite_where=text('returned_at IS NULL')),
+        # filtros do histórico
+        Index('ix_EMPRÉSTIMOS_usuario_data', 'id_usuario', 'data_emprestimo'),
+        Index('ix_EMPRÉSTIMOS_livro_data', 'id_livro', 'data_emprestimo'),
+    )
     id_emprestimo = Column(Integer, primary_key=True)
-    data_emprestimo = Column(String(8), nullable=False, index=True)
-    data_devolucao = Column(String(8), nullable=False, index=True)
+    # no SQLite o Date é gravado como texto AAAA-MM-DD, o mesmo formato que já era usado
+    data_emprestimo = Column(Date, nullable=False, index=True)
+    data_devolucao = Column(Date, nullable=False)
+    # preenchido na devolução; None enquanto o livro está emprestado
+    returned_at = Column(DateTime, nullable=True)
 
     id_usuario = Column(Integer, ForeignKey('USUARIOS.id_usuario'))
     usuario = relationship('Usuario')
     id_livro = Column(Integer, ForeignKey('LIVROS.id_livro'))
     livro = relationship('Livro')
+    id_exemplar = Column(Integer, ForeignKey('EXEMPLARES.id_exemplar'))
+    exemplar = relationship('Exemplar')
 
     def __repr__(self):
         return '<Emprestimo: {} {} {}>'.format(self.id_emprestimo, self.data_emprestimo, self.data_devolucao)
@@ -121,10 +358,17 @@ class Emprestimo(Base):
     def save(self):
         db_session.add(self)
         db_session.commit()
+        incrementar_versao(self.__tablename__)
 
     def delete(self):
         db_session.delete(self)
         db_session.commit()
+        incrementar_versao(self.__tablename__)
+
+    def devolver(self):
+        self.returned_at = datetime.now()
+        db_session.commit()
+        incrementar_versao(self.__tablename__)
 
     def update(self, data_emprestimo=None, data_devolucao=None):
         if data_emprestimo:
@@ -132,48 +376,20 @@ class Emprestimo(Base):
         if data_devolucao:
             self.data_devolucao = data_devolucao
         db_session.commit()
+        incrementar_versao(self.__tablename__)
 
     def serialize_emprestimo(self):
         return {
-            "data de emprestimo": self.data_emprestimo,
-            "data de devolucao": self.data_devolucao,
+            "data de emprestimo": self.data_emprestimo.isoformat(),
+            "data de devolucao": self.data_devolucao.isoformat(),
+            "data de retorno": self.returned_at.isoformat() if self.returned_at else None,
             'usuario': self.id_usuario,
             'livro': self.id_livro,
+            'exemplar': self.id_exemplar,
         }
 
-    class UsuarioGeral(Base):
-        __tablename__ = 'usuarios_exemplo'
-        id = Column(Integer, primary_key=True)
-        nome = Column(String, nullable=False)
-        email = Column(String, nullable=False)
-        senha_hash = Column(String, nullable=False)
-        papel = Column(String, nullable=False)
-
-        def set_senha_hash(self, senha):
-            self.senha_hash = generate_password_hash(senha)
-
-        def check_password_hash(self, senha):
-            return check_password_hash(self.senha_hash, senha)
-
-        def serialize(self):
-            dados = {
-                'id': self.id,
-                'nome': self.nome,
-                'email': self.email,
-                'papel': self.papel,  # papel não é obrigatorio
-            }
-            return dados
-
-    class NotasExemplo(Base):
-        __tablename__ = 'notas_exemplo'
-        id = Column(Integer, primary_key=True)
-        conteudo = Column(String, nullable=False)
-        # user_id = Column(Integer, ForeignKey('usuarios_exemplo.id')) # Poderia ter para associar
-
-    Base.metadata.create_all(engine)  # Cria as tabelas
-
-def init_db():
-    Base.metadata.create_all(bind=engine)
+
 if __name__ == '__main__':
-    init_db()
+    from migracoes import migrar
+    migrar()
 
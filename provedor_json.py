@@ -0,0 +1,65 @@
+"""
+Provedores de JSON do Flask.
+
+ProvedorJSON é o provedor padrão do Flask escrevendo datas no formato ISO
+(AAAA-MM-DD e AAAA-MM-DDTHH:MM:SS), o mesmo dos serialize_* dos modelos.
+Assim as linhas Core das listagens vão direto para o JSON, sem converter
+cada data em Python.
+
+ProvedorOrjson faz o mesmo com o orjson, bem mais rápido nas listagens
+grandes. O orjson é opcional: BIBLIOTECA_JSON escolhe "orjson", "padrao"
+ou "auto" (padrão: orjson se estiver instalado).
+"""
+import os
+from datetime import date
+
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depende do ambiente
+    orjson = None
+
+JSON_ESCOLHIDO = os.environ.get('BIBLIOTECA_JSON', 'auto')
+
+
+def _padrao(o):
+    if isinstance(o, date):
+        return o.isoformat()
+    return DefaultJSONProvider.default(o)
+
+
+class ProvedorJSON(DefaultJSONProvider):
+    default = staticmethod(_padrao)
+
+    def dumps_bytes(self, obj):
+        """JSON compacto em bytes, para respostas montadas fora do Flask (app_async)."""
+        return self.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+class ProvedorOrjson(JSONProvider):
+    mimetype = 'application/json'
+    opcoes = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_padrao, option=self.opcoes).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def dumps_bytes(self, obj):
+        return orjson.dumps(obj, default=_padrao, option=self.opcoes)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        # os bytes do orjson vão direto para a resposta, sem passar por str
+        return self._app.response_class(self.dumps_bytes(obj), mimetype=self.mimetype)
+
+
+def criar_provedor_json(app, escolha=None):
+    escolha = escolha or JSON_ESCOLHIDO
+    if escolha == 'orjson' and orjson is None:
+        raise RuntimeError('BIBLIOTECA_JSON=orjson, mas o orjson não está instalado')
+    if escolha == 'orjson' or (escolha == 'auto' and orjson is not None):
+        return ProvedorOrjson(app)
+    return ProvedorJSON(app)
@@ -0,0 +1,140 @@
+"""
+Hash e verificação de senhas fora da thread da requisição.
+
+O scrypt/PBKDF2 do werkzeug é puro CPU; rodando dentro da requisição ele
+segura o GIL e as rotas baratas do catálogo ficam na fila atrás dos logins.
+Aqui o trabalho vai para um pool de processos de tamanho fixo, com um
+limite de tarefas em espera: quando a fila enche, FilaHashCheia é lançada
+na hora e a rota responde 503 em vez de acumular requisições. O mesmo vale
+para um hash que passa de BIBLIOTECA_HASH_TIMEOUT segundos.
+
+Os processos do pool são criados com forkserver, que importa o módulo
+principal de novo: scripts que usam o app precisam do
+"if __name__ == '__main__'" (BIBLIOTECA_HASH_WORKERS=0 desliga o pool).
+
+As versões *_async são para o app_async.py: esperam o processo sem ocupar
+uma thread do servidor.
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as TempoEsgotado
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# método e fator de trabalho no formato do werkzeug, ex.: "scrypt:32768:8:1"
+# ou "pbkdf2:sha256:600000"
+METODO_HASH = os.environ.get('BIBLIOTECA_HASH_METODO', 'scrypt:32768:8:1')
+# 0 desliga o pool e calcula o hash na própria thread
+WORKERS_HASH = int(os.environ.get('BIBLIOTECA_HASH_WORKERS', os.cpu_count() or 1))
+FILA_HASH = int(os.environ.get('BIBLIOTECA_HASH_FILA', 64))
+TIMEOUT_HASH = float(os.environ.get('BIBLIOTECA_HASH_TIMEOUT', 10))
+
+
+class FilaHashCheia(Exception):
+    pass
+
+
+_pool = None
+_lock_pool = threading.Lock()
+_vagas = threading.BoundedSemaphore(max(WORKERS_HASH, 1) + FILA_HASH)
+_prefixo_metodo = None
+
+
+def _executor():
+    global _pool
+    with _lock_pool:
+        if _pool is None:
+            # forkserver evita fazer fork de um processo com várias threads
+            metodos = multiprocessing.get_all_start_methods()
+            contexto = multiprocessing.get_context('forkserver' if 'forkserver' in metodos else 'spawn')
+            _pool = ProcessPoolExecutor(max_workers=WORKERS_HASH, mp_context=contexto)
+        return _pool
+
+
+def _executar(fn, *args):
+    if WORKERS_HASH <= 0:
+        return fn(*args)
+    # sem vaga, 503 na hora, sem segurar a thread da requisição
+    if not _vagas.acquire(blocking=False):
+        raise FilaHashCheia('Fila de hash de senhas cheia')
+    try:
+        futuro = _executor().submit(fn, *args)
+    except BrokenProcessPool:
+        _vagas.release()
+        _descartar_pool()
+        raise
+    except Exception:
+        _vagas.release()
+        raise
+    # a vaga só é liberada quando o processo termina, mesmo se a requisição desistir antes
+    futuro.add_done_callback(lambda f: _vagas.release())
+    try:
+        return futuro.result(timeout=TIMEOUT_HASH)
+    except TempoEsgotado:
+        raise FilaHashCheia('Hash de senha demorou mais de %gs' % TIMEOUT_HASH) from None
+
+
+async def _executar_async(fn, *args):
+    if WORKERS_HASH <= 0:
+        return await asyncio.to_thread(fn, *args)
+    # o event loop não pode ficar parado no semáforo: sem vaga, 503 na hora
+    if not _vagas.acquire(blocking=False):
+        raise FilaHashCheia('Fila de hash de senhas cheia')
+    try:
+        futuro = _executor().submit(fn, *args)
+    except BrokenProcessPool:
+        _vagas.release()
+        _descartar_pool()
+        raise
+    except Exception:
+        _vagas.release()
+        raise
+    futuro.add_done_callback(lambda f: _vagas.release())
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(futuro), TIMEOUT_HASH)
+    except asyncio.TimeoutError:
+        raise FilaHashCheia('Hash de senha demorou mais de %gs' % TIMEOUT_HASH) from None
+
+
+def _descartar_pool():
+    global _pool
+    with _lock_pool:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def gerar_hash(senha):
+    return _executar(generate_password_hash, senha, METODO_HASH)
+
+
+def verificar_senha(senha_hash, senha):
+    return _executar(check_password_hash, senha_hash, senha)
+
+
+def precisa_rehash(senha_hash):
+    """Indica se o hash foi gerado com parâmetros diferentes dos atuais."""
+    global _prefixo_metodo
+    if _prefixo_metodo is None:
+        # o werkzeug completa parâmetros omitidos (ex.: "pbkdf2:sha256" ganha as
+        # iterações padrão), então o prefixo canônico vem de um hash de verdade
+        _prefixo_metodo = gerar_hash('').split('$', 1)[0]
+    return senha_hash.split('$', 1)[0] != _prefixo_metodo
+
+
+async def gerar_hash_async(senha):
+    return await _executar_async(generate_password_hash, senha, METODO_HASH)
+
+
+async def verificar_senha_async(senha_hash, senha):
+    return await _executar_async(check_password_hash, senha_hash, senha)
+
+
+async def precisa_rehash_async(senha_hash):
+    global _prefixo_metodo
+    if _prefixo_metodo is None:
+        _prefixo_metodo = (await gerar_hash_async('')).split('$', 1)[0]
+    return senha_hash.split('$', 1)[0] != _prefixo_metodo
@@ -0,0 +1,49 @@
+"""
+Os testes rodam num banco SQLite temporário, criado pelas migrações. As
+variáveis de ambiente precisam estar definidas antes de importar models.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+PASTA = tempfile.mkdtemp(prefix='biblioteca_testes_')
+os.environ['BIBLIOTECA_DB_URL'] = 'sqlite:///' + os.path.join(PASTA, 'testes.sqlite3')
+# hash na própria thread: sem pool de processos nos testes
+os.environ['BIBLIOTECA_HASH_WORKERS'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def app():
+    import migracoes
+    from app import app as app_flask
+
+    migracoes.migrar()
+    app_flask.config['TESTING'] = True
+    return app_flask
+
+
+@pytest.fixture
+def cliente(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def comandos_sql(app):
+    """Lista dos comandos SQL executados (nas duas engines) enquanto o teste roda."""
+    from sqlalchemy import event
+
+    from models import engine, engine_leitura
+
+    comandos = []
+
+    def contar(conexao, cursor, sql, parametros, contexto, executemany):
+        comandos.append(sql)
+
+    for alvo in (engine, engine_leitura):
+        event.listen(alvo, 'before_cursor_execute', contar)
+    yield comandos
+    for alvo in (engine, engine_leitura):
+        event.remove(alvo, 'before_cursor_execute', contar)
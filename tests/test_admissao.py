@@ -0,0 +1,64 @@
+"""
+Controle de admissão: sem vaga e com a fila cheia (ou sem prazo para
+esperar) a requisição sai na hora com 503 e Retry-After; quem está na
+fila recebe a vaga de quem sai, e as recusas aparecem no /metrics.
+"""
+import threading
+import time
+
+import pytest
+
+import admissao
+
+
+@pytest.fixture
+def leitura(app, monkeypatch):
+    """Orçamento de leitura com uma vaga e uma posição na fila, no lugar do configurado."""
+    orcamento = admissao.Orcamento('leitura', 1, 1)
+    monkeypatch.setitem(admissao.ORCAMENTOS, 'leitura', orcamento)
+    return orcamento
+
+
+def test_recusa_com_retry_after(cliente, leitura):
+    assert cliente.get('/livros').status_code == 200
+    leitura.entrar(0)
+    try:
+        # sem prazo para esperar na fila
+        resposta = cliente.get('/livros', headers={'X-Prazo-Ms': '0'})
+        assert resposta.status_code == 503
+        assert int(resposta.headers['Retry-After']) >= 1
+        assert leitura.recusadas == {'fila_cheia': 0, 'prazo': 1}
+        # /metrics é isento e mostra a recusa
+        metricas = cliente.get('/metrics').get_data(as_text=True)
+        assert 'biblioteca_admissao_recusadas_total{orcamento="leitura",motivo="prazo"} 1' in metricas
+        # escrita tem outro orçamento
+        assert cliente.post('/cadastrar_livro', json={}).status_code != 503
+    finally:
+        leitura.sair(0)
+    assert cliente.get('/livros').status_code == 200
+    assert leitura.estado() == (0, 0)
+
+
+def test_fila_limitada_e_vaga_passada_adiante(leitura):
+    leitura.entrar(0)
+    admitida = threading.Event()
+
+    def esperar():
+        leitura.entrar(5)
+        admitida.set()
+
+    fila = threading.Thread(target=esperar)
+    fila.start()
+    while leitura.estado() != (1, 1):
+        time.sleep(0.001)
+    # a única posição da fila está ocupada
+    with pytest.raises(admissao.ServidorSobrecarregado) as erro:
+        leitura.entrar(5)
+    assert erro.value.motivo == 'fila_cheia'
+
+    leitura.sair(0.01)
+    assert admitida.wait(5)
+    fila.join()
+    assert leitura.estado() == (1, 0)
+    leitura.sair(0.01)
+    assert leitura.estado() == (0, 0)
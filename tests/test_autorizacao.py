@@ -0,0 +1,61 @@
+"""
+Revogação de tokens: a versão do token é conferida contra a cópia em
+memória (sem SQL), relida do banco quando vence, e esquecida quando o
+próprio processo altera o User.
+"""
+import sqlite3
+
+import pytest
+from flask_jwt_extended.exceptions import RevokedTokenError
+from sqlalchemy import select, update
+
+import autorizacao
+from models import User, db_session, engine
+
+EMAIL = 'gerente.autorizacao@teste'
+
+
+@pytest.fixture
+def token(cliente):
+    cliente.post('/cadastrar_users', json={'nome': 'Gerente', 'email': EMAIL, 'senha': 'segredo', 'papel': 'gerente'})
+    db_session.execute(update(User).where(User.email == EMAIL).values(papel='gerente'))
+    db_session.commit()
+    db_session.remove()
+    return cliente.post('/login', json={'email': EMAIL, 'senha': 'segredo'}).get_json()['access_token']
+
+
+def protegida(app, token):
+    """Chama uma função com admin_required como se fosse a rota, com o token no cabeçalho."""
+    from app import admin_required
+
+    with app.test_request_context(headers={'Authorization': 'Bearer ' + token}):
+        return admin_required(lambda: 'ok')()
+
+
+def test_conferencia_sem_sql(app, token, comandos_sql):
+    for _ in range(3):
+        assert protegida(app, token) == 'ok'
+    assert comandos_sql == []
+
+
+def test_revogacao_por_outro_processo(app, token, monkeypatch):
+    assert protegida(app, token) == 'ok'
+    conexao = sqlite3.connect(engine.url.database)
+    conexao.execute("UPDATE users SET papel = 'usuario' WHERE email = ?", (EMAIL,))
+    conexao.commit()
+    conexao.close()
+    # dentro do TTL a cópia em memória ainda vale; vencida, é relida
+    assert protegida(app, token) == 'ok'
+    monkeypatch.setattr(autorizacao, 'TTL_VERSAO', 0)
+    with pytest.raises(RevokedTokenError):
+        protegida(app, token)
+
+
+def test_revogacao_pelo_proprio_processo(app, token):
+    assert protegida(app, token) == 'ok'
+    usuario = db_session.execute(select(User).where(User.email == EMAIL)).scalar()
+    usuario.set_senha_hash('outra')
+    db_session.commit()
+    db_session.remove()
+    with pytest.raises(RevokedTokenError):
+        protegida(app, token)
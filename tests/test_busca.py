@@ -0,0 +1,41 @@
+"""
+Busca textual (/buscar_livros): o índice FTS5 acompanha LIVROS pelos
+triggers e os resultados saem por relevância, título antes de autor antes
+de resumo.
+"""
+from sqlalchemy import insert, update
+
+from models import Livro, engine
+
+PALAVRA = 'zimbrafolha'
+
+
+def buscar(cliente, q):
+    resposta = cliente.get('/buscar_livros', query_string={'q': q})
+    assert resposta.status_code == 200
+    return [livro['id_livro'] for livro in resposta.get_json()['livros']]
+
+
+def test_ordem_por_relevancia(cliente):
+    with engine.begin() as conexao:
+        # ids na ordem inversa da relevância, para a ordem do rowid não passar por acerto
+        conexao.execute(insert(Livro), [
+            {'id_livro': 80201, 'titulo': 'Sem nada', 'autor': 'Fulano', 'ISBN': 80201,
+             'resumo': 'Um jardim de %s e outras plantas' % PALAVRA},
+            {'id_livro': 80202, 'titulo': 'Outro', 'autor': 'Beltrano %s' % PALAVRA.capitalize(), 'ISBN': 80202,
+             'resumo': 'Nada'},
+            {'id_livro': 80203, 'titulo': 'O livro da %s' % PALAVRA, 'autor': 'Ciclano', 'ISBN': 80203,
+             'resumo': 'Nada'},
+        ])
+    assert buscar(cliente, PALAVRA) == [80203, 80202, 80201]
+    # o fim da palavra é livre, e todas as palavras precisam aparecer
+    assert buscar(cliente, PALAVRA[:6]) == [80203, 80202, 80201]
+    assert buscar(cliente, '%s jardim' % PALAVRA) == [80201]
+
+    with engine.begin() as conexao:
+        conexao.execute(update(Livro).where(Livro.id_livro == 80203).values(titulo='Renomeado'))
+    assert buscar(cliente, PALAVRA) == [80202, 80201]
+
+
+def test_sem_q(cliente):
+    assert cliente.get('/buscar_livros?q=%20').status_code == 400
@@ -0,0 +1,49 @@
+"""
+Cache do catálogo: o 304 sai da memória, sem SQL, e o Last-Modified acompanha
+MODIFICACOES, inclusive quando outro processo escreve no banco.
+"""
+import sqlite3
+import time
+
+from cache import cache
+from models import engine
+
+
+def test_304_sem_consultar_o_banco(cliente, comandos_sql):
+    primeira = cliente.get('/livros')
+    assert primeira.status_code == 200
+    comandos_sql.clear()
+    resposta = cliente.get('/livros', headers={'If-None-Match': primeira.headers['ETag']})
+    assert resposta.status_code == 304
+    assert comandos_sql == []
+
+
+def test_last_modified_de_escrita_em_outro_processo(cliente, comandos_sql):
+    # Last-Modified só sai depois que o segundo da última escrita termina
+    time.sleep(1.1)
+    primeira = cliente.get('/livros')
+    desde = primeira.headers['Last-Modified']
+    comandos_sql.clear()
+    assert cliente.get('/livros', headers={'If-Modified-Since': desde}).status_code == 304
+    assert comandos_sql == []
+
+    conexao = sqlite3.connect(engine.url.database)
+    conexao.execute("INSERT INTO LIVROS (id_livro, titulo, autor, isbn, resumo) VALUES (90001, 'Cache', 'A', 90001, 'R')")
+    conexao.commit()
+    conexao.close()
+    time.sleep(1.1)
+    # a entrada deste processo vence (TTL) e a próxima leitura relê MODIFICACOES
+    cache.limpar()
+    resposta = cliente.get('/livros', headers={'If-Modified-Since': desde})
+    assert resposta.status_code == 200
+    assert resposta.get_data() != primeira.get_data()
+    assert resposta.last_modified > primeira.last_modified
+
+
+def test_stream_desligado_usa_o_cache(cliente):
+    for valor in ('0', 'false'):
+        cliente.get('/livros?stream=%s' % valor)
+        acertos = cache.acertos
+        resposta = cliente.get('/livros?stream=%s' % valor)
+        assert resposta.headers.get('ETag')
+        assert cache.acertos == acertos + 1
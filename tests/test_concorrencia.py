@@ -0,0 +1,66 @@
+"""
+Vários processos, cada um com o seu app e a sua conexão de escrita, pedem
+ao mesmo tempo o mesmo livro com EXEMPLARES exemplares: só EXEMPLARES
+empréstimos podem sair, nenhum exemplar fica com dois empréstimos em
+aberto e o contador de disponíveis confere com os empréstimos.
+"""
+import multiprocessing
+import os
+import sqlite3
+import sys
+
+from sqlalchemy import insert
+
+from models import Exemplar, Livro, Usuario, engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from concorrencia_emprestimo import CONTADORES_ERRADOS, DUPLICADOS  # noqa: E402
+
+ID_LIVRO = 80001
+EXEMPLARES = 3
+PROCESSOS = 4
+TENTATIVAS = 5
+
+
+def disputar(barreira, resultados):
+    from app import app
+
+    cliente = app.test_client()
+    barreira.wait()
+    for _ in range(TENTATIVAS):
+        resposta = cliente.post('/realizar_emprestimo', json={'id_usuario': ID_LIVRO, 'id_livro': ID_LIVRO})
+        resultados.put((resposta.status_code, resposta.get_json().get('exemplar')))
+
+
+def test_sem_emprestimo_duplicado(app):
+    with engine.begin() as conexao:
+        conexao.execute(insert(Livro).values(id_livro=ID_LIVRO, titulo='Disputado', autor='A', ISBN=ID_LIVRO,
+                                             resumo='R'))
+        conexao.execute(insert(Exemplar), [
+            {'id_exemplar': ID_LIVRO + numero, 'id_livro': ID_LIVRO, 'codigo_barras': 'DISPUTA-%d' % numero}
+            for numero in range(EXEMPLARES)])
+        conexao.execute(insert(Usuario).values(id_usuario=ID_LIVRO, nome='Terminal', CPF='80001', endereco='Rua'))
+
+    contexto = multiprocessing.get_context('spawn')
+    barreira = contexto.Barrier(PROCESSOS)
+    resultados = contexto.Queue()
+    processos = [contexto.Process(target=disputar, args=(barreira, resultados)) for _ in range(PROCESSOS)]
+    for processo in processos:
+        processo.start()
+    respostas = [resultados.get(timeout=120) for _ in range(PROCESSOS * TENTATIVAS)]
+    for processo in processos:
+        processo.join(timeout=30)
+        assert processo.exitcode == 0
+
+    status = sorted(codigo for codigo, _ in respostas)
+    assert status == [201] * EXEMPLARES + [409] * (PROCESSOS * TENTATIVAS - EXEMPLARES)
+    assert len({exemplar for codigo, exemplar in respostas if codigo == 201}) == EXEMPLARES
+
+    conexao = sqlite3.connect(engine.url.database)
+    try:
+        assert conexao.execute(DUPLICADOS % '?', (ID_LIVRO,)).fetchone()[0] == 0
+        assert conexao.execute(CONTADORES_ERRADOS % '?', (ID_LIVRO,)).fetchone()[0] == 0
+        assert conexao.execute('SELECT exemplares_disponiveis FROM "LIVROS" WHERE id_livro = ?',
+                               (ID_LIVRO,)).fetchone()[0] == 0
+    finally:
+        conexao.close()
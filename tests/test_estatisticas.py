@@ -0,0 +1,59 @@
+"""
+Estatísticas de circulação: os triggers de EMPRÉSTIMOS mantêm os resumos
+a cada empréstimo e devolução, pela API ou direto no banco, e o resumo
+confere com o histórico (verificar_estatisticas).
+"""
+import sqlite3
+from datetime import date
+
+from sqlalchemy import insert, select
+
+from estatisticas import EstatisticaAutor, EstatisticaLivro, EstatisticaMes, EstatisticaUsuario, verificar_estatisticas
+from models import Exemplar, Livro, Usuario, db_session_leitura, engine
+
+ID_LIVRO = 80101
+AUTOR = 'Autor Estatística'
+
+
+def contagens(modelo, chave, valor):
+    db_session_leitura.remove()
+    linha = db_session_leitura.execute(
+        select(modelo.emprestimos, modelo.devolucoes).where(chave == valor)).first()
+    return tuple(linha) if linha else (0, 0)
+
+
+def test_resumos_acompanham_emprestimos_e_devolucoes(cliente):
+    with engine.begin() as conexao:
+        conexao.execute(insert(Livro).values(id_livro=ID_LIVRO, titulo='Estatística', autor=AUTOR, ISBN=ID_LIVRO,
+                                             resumo='R'))
+        conexao.execute(insert(Exemplar), [
+            {'id_exemplar': ID_LIVRO + numero, 'id_livro': ID_LIVRO, 'codigo_barras': 'ESTAT-%d' % numero}
+            for numero in range(3)])
+        conexao.execute(insert(Usuario).values(id_usuario=ID_LIVRO, nome='Leitor', CPF=str(ID_LIVRO), endereco='Rua'))
+    mes = date.today().strftime('%Y-%m')
+    mes_antes = contagens(EstatisticaMes, EstatisticaMes.mes, mes)
+
+    for _ in range(2):
+        resposta = cliente.post('/realizar_emprestimo', json={'id_usuario': ID_LIVRO, 'id_livro': ID_LIVRO})
+        assert resposta.status_code == 201
+    resposta = cliente.post('/devolver_livro', json={'id_exemplar': resposta.get_json()['exemplar']})
+    assert resposta.status_code == 200
+
+    assert contagens(EstatisticaLivro, EstatisticaLivro.id_livro, ID_LIVRO) == (2, 1)
+    assert contagens(EstatisticaUsuario, EstatisticaUsuario.id_usuario, ID_LIVRO) == (2, 1)
+    assert contagens(EstatisticaAutor, EstatisticaAutor.autor, AUTOR) == (2, 1)
+    assert contagens(EstatisticaMes, EstatisticaMes.mes, mes) == (mes_antes[0] + 2, mes_antes[1] + 1)
+
+    # escrita direto no banco, sem passar pela API: os triggers somam do mesmo jeito
+    conexao = sqlite3.connect(engine.url.database)
+    conexao.execute('INSERT INTO "EMPRÉSTIMOS" (data_emprestimo, data_devolucao, id_usuario, id_livro, id_exemplar) '
+                    'VALUES (?, ?, ?, ?, ?)', (date.today().isoformat(), date.today().isoformat(), ID_LIVRO, ID_LIVRO,
+                                               ID_LIVRO + 2))
+    conexao.commit()
+    conexao.close()
+    assert contagens(EstatisticaLivro, EstatisticaLivro.id_livro, ID_LIVRO) == (3, 1)
+
+    assert verificar_estatisticas() == {}
+
+    ranking = cliente.get('/relatorios/autores?limit=1000').get_json()['autores']
+    assert {'autor': AUTOR, 'emprestimos': 3, 'devolucoes': 1, 'em_aberto': 2} in ranking
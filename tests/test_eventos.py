@@ -0,0 +1,69 @@
+"""
+Feed de mudanças: empréstimos e devoluções gravam eventos em EVENTOS, na
+mesma transação e em sequência crescente, e /eventos os entrega a partir
+do Last-Event-ID e conforme chegam.
+"""
+import time
+
+from sqlalchemy import func, insert, select
+
+from eventos import Evento
+from models import Exemplar, Livro, Usuario, db_session_leitura, engine
+
+ID_LIVRO = 80301
+
+
+def eventos_depois(depois_de):
+    db_session_leitura.remove()
+    return db_session_leitura.execute(
+        select(Evento.id_evento, Evento.tipo, Evento.id_livro, Evento.id_exemplar, Evento.disponiveis)
+        .where(Evento.id_evento > depois_de).order_by(Evento.id_evento)).all()
+
+
+def ler_ate(partes, nome):
+    """Junta os pedaços do text/event-stream até aparecer o evento "nome" (o feed manda algo a cada 15 s)."""
+    texto, limite = '', time.monotonic() + 30
+    while 'event: %s\n' % nome not in texto:
+        assert time.monotonic() < limite, texto
+        texto += next(partes).decode()
+    return texto
+
+
+def test_emprestimo_e_devolucao_geram_eventos(cliente):
+    with engine.begin() as conexao:
+        inicio = conexao.execute(select(func.coalesce(func.max(Evento.id_evento), 0))).scalar()
+        conexao.execute(insert(Livro).values(id_livro=ID_LIVRO, titulo='Eventos', autor='A', ISBN=ID_LIVRO,
+                                             resumo='R'))
+        conexao.execute(insert(Exemplar), [
+            {'id_exemplar': ID_LIVRO + numero, 'id_livro': ID_LIVRO, 'codigo_barras': 'EVENTO-%d' % numero}
+            for numero in range(2)])
+        conexao.execute(insert(Usuario).values(id_usuario=ID_LIVRO, nome='Leitor', CPF=str(ID_LIVRO), endereco='Rua'))
+
+    emprestimo = cliente.post('/realizar_emprestimo', json={'id_usuario': ID_LIVRO, 'id_livro': ID_LIVRO}).get_json()
+    depois_do_emprestimo = eventos_depois(inicio)[-1].id_evento
+    assert cliente.post('/devolver_livro', json={'id_exemplar': emprestimo['exemplar']}).status_code == 200
+
+    eventos = eventos_depois(inicio)
+    ids = [evento.id_evento for evento in eventos]
+    assert ids == sorted(set(ids))
+    assert eventos[0].tipo == 'livro_criado' and eventos[0].id_livro == ID_LIVRO
+    emprestimos = [(e.tipo, e.id_exemplar, e.disponiveis) for e in eventos if e.tipo.startswith('emprestimo_')]
+    assert emprestimos == [('emprestimo_aberto', emprestimo['exemplar'], 1),
+                           ('emprestimo_fechado', emprestimo['exemplar'], 2)]
+
+    # reconexão: com o Last-Event-ID recebe só o que veio depois dele
+    resposta = cliente.get('/eventos?livros=%d' % ID_LIVRO, headers={'Last-Event-ID': str(depois_do_emprestimo)})
+    assert resposta.status_code == 200
+    assert resposta.mimetype == 'text/event-stream'
+    partes = resposta.iter_encoded()
+    try:
+        texto = ler_ate(partes, 'emprestimo_fechado')
+        assert 'emprestimo_aberto' not in texto
+        assert 'id: %d\n' % eventos[-1].id_evento in texto
+
+        # evento novo com a conexão aberta
+        assert cliente.post('/realizar_emprestimo', json={'id_usuario': ID_LIVRO,
+                                                          'id_livro': ID_LIVRO}).status_code == 201
+        assert '"id_livro":%d' % ID_LIVRO in ler_ate(partes, 'emprestimo_aberto')
+    finally:
+        resposta.close()
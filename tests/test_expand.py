@@ -0,0 +1,72 @@
+"""
+?expand=livro,usuario em /emprestimos: os objetos relacionados vêm por
+selectinload, uma consulta por relação, então o número de comandos SQL da
+requisição não depende de quantos empréstimos a página tem.
+"""
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import delete, insert
+
+from metricas import metricas
+from models import Emprestimo, Exemplar, Livro, Usuario, engine
+
+MAXIMO = 50
+
+
+@pytest.fixture(scope='module')
+def acervo(app):
+    """MAXIMO livros, cada um com um exemplar, e MAXIMO usuários."""
+    with engine.begin() as conexao:
+        conexao.execute(insert(Livro), [
+            {'id_livro': i, 'titulo': 'Livro %d' % i, 'autor': 'Autor %d' % (i % 7), 'ISBN': i, 'resumo': 'Resumo'}
+            for i in range(1, MAXIMO + 1)])
+        conexao.execute(insert(Exemplar), [
+            {'id_exemplar': i, 'id_livro': i, 'codigo_barras': 'T%d' % i} for i in range(1, MAXIMO + 1)])
+        conexao.execute(insert(Usuario), [
+            {'id_usuario': i, 'nome': 'Usuário %d' % i, 'CPF': '%011d' % i, 'endereco': 'Rua %d' % i}
+            for i in range(1, MAXIMO + 1)])
+
+
+def emprestar(quantidade):
+    """Deixa exatamente "quantidade" empréstimos em aberto, cada um com livro e usuário diferentes."""
+    hoje = date.today()
+    with engine.begin() as conexao:
+        conexao.execute(delete(Emprestimo))
+        conexao.execute(insert(Emprestimo), [
+            {'id_livro': i, 'id_exemplar': i, 'id_usuario': i,
+             'data_emprestimo': hoje, 'data_devolucao': hoje + timedelta(weeks=4)}
+            for i in range(1, quantidade + 1)])
+
+
+def listar(cliente, url):
+    """(comandos SQL da requisição, empréstimos), pelo contador de SQL por requisição das métricas."""
+    anterior = metricas.sql_por_requisicao.get(('/emprestimos', 'GET'))
+    antes = anterior.soma if anterior else 0
+    resposta = cliente.get(url)
+    assert resposta.status_code == 200
+    return metricas.sql_por_requisicao[('/emprestimos', 'GET')].soma - antes, resposta.get_json()['emprestimos']
+
+
+@pytest.mark.usefixtures('acervo')
+def test_expand_nao_cresce_com_a_pagina(cliente):
+    comandos = {}
+    for quantidade in (5, MAXIMO):
+        emprestar(quantidade)
+        comandos[quantidade], emprestimos = listar(cliente, '/emprestimos?limit=100&expand=livro,usuario')
+        assert len(emprestimos) == quantidade
+        assert all(isinstance(e['livro'], dict) and isinstance(e['usuario'], dict) for e in emprestimos)
+        assert {e['livro']['titulo'] for e in emprestimos} == {'Livro %d' % i for i in range(1, quantidade + 1)}
+
+    assert comandos[5] == comandos[MAXIMO]
+
+
+@pytest.mark.usefixtures('acervo')
+def test_expand_uma_consulta_por_relacao(cliente):
+    emprestar(MAXIMO)
+    sem_expand, _ = listar(cliente, '/emprestimos?limit=100')
+    com_livro, _ = listar(cliente, '/emprestimos?limit=100&expand=livro')
+    com_os_dois, _ = listar(cliente, '/emprestimos?limit=100&expand=livro,usuario')
+
+    assert com_livro <= sem_expand + 1
+    assert com_os_dois <= sem_expand + 2
@@ -0,0 +1,45 @@
+"""
+Idempotency-Key: a repetição recebe a resposta guardada sem executar de
+novo, e uma falha do banco (5xx) não é guardada.
+"""
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+
+from models import Livro, Usuario, db_session
+
+
+def contar(modelo, **filtros):
+    total = db_session.execute(select(func.count()).select_from(modelo).filter_by(**filtros)).scalar()
+    db_session.remove()
+    return total
+
+
+def test_repeticao_devolve_a_primeira_resposta(cliente):
+    corpo = {'nome': 'Idempotente', 'cpf': '99900011122', 'endereco': 'Rua A'}
+    cabecalhos = {'Idempotency-Key': 'usuario-1'}
+    primeira = cliente.post('/novo_usuario', json=corpo, headers=cabecalhos)
+    repeticao = cliente.post('/novo_usuario', json=corpo, headers=cabecalhos)
+    assert primeira.status_code == repeticao.status_code == 201
+    assert repeticao.get_data() == primeira.get_data()
+    assert repeticao.headers.get('Idempotent-Replayed') == 'true'
+    assert contar(Usuario, CPF='99900011122') == 1
+
+    outro_corpo = dict(corpo, nome='Outro')
+    assert cliente.post('/novo_usuario', json=outro_corpo, headers=cabecalhos).status_code == 422
+
+
+def test_falha_do_banco_nao_fica_guardada(cliente, monkeypatch):
+    corpo = {'titulo': 'Idempotente', 'autor': 'A', 'isbn': '99900', 'resumo': 'R'}
+    cabecalhos = {'Idempotency-Key': 'livro-1'}
+
+    def banco_travado():
+        raise OperationalError('COMMIT', {}, Exception('database is locked'))
+
+    monkeypatch.setattr(db_session, 'commit', banco_travado)
+    assert cliente.post('/novo_livro', json=corpo, headers=cabecalhos).status_code == 500
+    monkeypatch.undo()
+
+    resposta = cliente.post('/novo_livro', json=corpo, headers=cabecalhos)
+    assert resposta.status_code == 201
+    assert resposta.headers.get('Idempotent-Replayed') is None
+    assert contar(Livro, titulo='Idempotente') == 1